@@ -0,0 +1,224 @@
+
+import time
+import json
+
+import numpy as np
+
+import instrumentation
+
+
+def _gaussian_kernel(sigma, truncate=4.0):
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _reflect_matrix(kernel, size):
+    # The blur of a short axis written as a (size, size) matrix, with the borders reflected
+    # as in scipy.ndimage's 'reflect' mode
+    radius = len(kernel) // 2
+    source = np.pad(np.arange(size), radius, mode='symmetric')
+    matrix = np.zeros((size, size), dtype=np.float32)
+    for i in range(size):
+        for k, weight in enumerate(kernel):
+            matrix[i, source[i + k]] += weight
+    return matrix
+
+
+def gaussian_blur(videos, sigma, axes=(2, 3, 4)):
+    """
+    Blurs a batch of videos with a separable gaussian kernel. Borders are handled by
+    reflection, as in scipy.ndimage.gaussian_filter
+    :param videos: Videos of shape (batch, frames, height, width, channels)
+    :param sigma: Standard deviation of the gaussian kernel
+    :param axes: The axes along which the videos are blurred
+    :return: The blurred videos as float32
+    """
+    kernel = _gaussian_kernel(sigma)
+    radius = len(kernel) // 2
+    output = videos.astype(np.float32)
+    for axis in axes:
+        size = output.shape[axis]
+        if size <= 2 * radius:
+            # Short axes such as the color channels are blurred with a matrix product
+            matrix = _reflect_matrix(kernel, size)
+            output = np.moveaxis(np.tensordot(output, matrix, axes=([axis], [1])), -1, axis)
+            continue
+        pad_width = [(0, 0)] * output.ndim
+        pad_width[axis] = (radius, radius)
+        padded = np.pad(output, pad_width, mode='symmetric')
+        window = [slice(None)] * output.ndim
+        window[axis] = slice(0, size)
+        output = kernel[0] * padded[tuple(window)]
+        for k in range(1, len(kernel)):
+            window[axis] = slice(k, k + size)
+            output += kernel[k] * padded[tuple(window)]
+    return output
+
+
+def rotate(videos, angles, order=1):
+    """
+    Rotates every frame of each video counter-clockwise around the image center. Areas outside
+    the rotated frames are set to zero
+    :param videos: Videos of shape (batch, frames, height, width, channels)
+    :param angles: Rotation angle of each video in degrees, of shape (batch,)
+    :param order: The interpolation order. 0 for nearest neighbour, 1 for bilinear
+    :return: The rotated videos as float32 for order 1, or with the input type for order 0
+    """
+    batch_size, _, height, width, _ = videos.shape
+    # Frames are zero padded by one pixel, so clipping the source coordinates to the padded
+    # frames maps every pixel outside the image to zero. Pixels are gathered from a
+    # (batch, height, width, frames, channels) layout to read contiguous memory
+    padded = np.pad(videos, [(0, 0), (0, 0), (1, 1), (1, 1), (0, 0)])
+    padded = np.ascontiguousarray(np.moveaxis(padded, 1, 3))
+    theta = np.deg2rad(np.asarray(angles, dtype=np.float32))[:, np.newaxis, np.newaxis]
+    cy, cx = height / 2. - 0.5, width / 2. - 0.5
+    dy, dx = np.mgrid[0:height, 0:width].astype(np.float32)
+    dy, dx = dy - cy, dx - cx
+    # Source coordinates in the padded frames
+    src_x = np.cos(theta) * dx - np.sin(theta) * dy + cx + 1
+    src_y = np.sin(theta) * dx + np.cos(theta) * dy + cy + 1
+
+    b = np.arange(batch_size)[:, np.newaxis, np.newaxis]
+
+    def sample(y, x):
+        return padded[b, np.clip(y, 0, height + 1), np.clip(x, 0, width + 1)]
+
+    if order == 0:
+        output = sample(np.rint(src_y).astype(int), np.rint(src_x).astype(int))
+    else:
+        x0, y0 = np.floor(src_x).astype(int), np.floor(src_y).astype(int)
+        wx = (src_x - x0)[..., np.newaxis, np.newaxis]
+        wy = (src_y - y0)[..., np.newaxis, np.newaxis]
+        top = (1 - wx) * sample(y0, x0) + wx * sample(y0, x0 + 1)
+        bottom = (1 - wx) * sample(y0 + 1, x0) + wx * sample(y0 + 1, x0 + 1)
+        output = (1 - wy) * top + wy * bottom
+    return np.moveaxis(output, 3, 1)
+
+
+class VideoAugmenter(object):
+    """
+    Batched video augmentation. Works on whole (batch, frames, height, width, channels) uint8
+    batches. Parameters are drawn per sample from a seeded generator and shared by all frames
+    of a sample. Geometric augmentations are applied to the RGB and mask streams alike,
+    intensity augmentations only to the RGB stream.
+
+    The augmentations and their order follow the vidaug Sequential used for training:
+    RandomRotate(degrees), HorizontalFlip, GaussianBlur(blur_sigma), Add(add), Multiply(multiply)
+
+    Methods:
+        sample_params: Draws the augmentation parameters of each sample
+        __call__: Augments a batch of videos
+    """
+    def __init__(self, degrees=15, flip_prob=0.5, blur_sigma=0.9,
+                 add=0, multiply=1.0, seed=42):
+        """
+        :param degrees: Videos are rotated by an angle drawn from [-degrees, degrees]
+        :param flip_prob: The probability of flipping a video horizontally
+        :param blur_sigma: Standard deviation of the gaussian blur. 0 disables blurring
+        :param add: The value added to the pixel intensities
+        :param multiply: The value the pixel intensities are multiplied with
+        :param seed: The random seed
+        """
+        self.degrees = degrees
+        self.flip_prob = flip_prob
+        self.blur_sigma = blur_sigma
+        self.add = add
+        self.multiply = multiply
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+
+    def sample_params(self, batch_size, seeds=None):
+        """
+        Draws the augmentation parameters of each sample
+        :param batch_size: The number of samples
+        :param seeds: Optional per-sample seeds. If given, the parameters of a sample only
+                      depend on its seed
+        :return: The rotation angles and flip flags, each of shape (batch_size,)
+        """
+        if seeds is None:
+            angles = self._rng.uniform(-self.degrees, self.degrees, batch_size)
+            flips = self._rng.random(batch_size) < self.flip_prob
+            return angles, flips
+        angles = np.empty(batch_size)
+        flips = np.empty(batch_size, dtype=bool)
+        for i, s in enumerate(np.asarray(seeds).ravel()):
+            rng = np.random.default_rng([self.seed, int(s) & 0xFFFFFFFF])
+            angles[i] = rng.uniform(-self.degrees, self.degrees)
+            flips[i] = rng.random() < self.flip_prob
+        return angles, flips
+
+    def __call__(self, rgb, mask=None, seeds=None):
+        """
+        Augments a batch of videos
+        :param rgb: RGB videos of shape (batch, frames, height, width, channels)
+        :param mask: Optional segmentation videos of the same shape, augmented with the same
+                     geometric parameters as rgb
+        :param seeds: Optional per-sample seeds (see sample_params())
+        :return: The augmented RGB videos as uint8, and the augmented masks if given
+        """
+        angles, flips = self.sample_params(len(rgb), seeds)
+
+        with instrumentation.span('augmentation.rotate_flip'):
+            output = rotate(rgb, angles) if self.degrees else rgb.astype(np.float32)
+            output[flips] = output[flips, :, :, ::-1]
+        if self.blur_sigma:
+            # Like vidaug, the kernel also runs across the color channels
+            with instrumentation.span('augmentation.blur'):
+                output = gaussian_blur(output, self.blur_sigma)
+        with instrumentation.span('augmentation.intensity'):
+            if self.add:
+                output = np.clip(np.trunc(output) + self.add, 0, 255)
+            if self.multiply != 1:
+                output = np.clip(output * self.multiply, 0, 255)
+            output = output.astype(np.uint8)
+        if mask is None:
+            return output
+
+        with instrumentation.span('augmentation.mask'):
+            mask = rotate(mask, angles, order=0) if self.degrees else mask.copy()
+            mask[flips] = mask[flips, :, :, ::-1]
+        return output, mask
+
+
+def benchmark(batch_size=2, seq_length=14, size=224, repeats=5, seed=42):
+    """
+    Measures the throughput of VideoAugmenter and of the per-sequence vidaug pipeline
+    it replaces (if vidaug is installed)
+    :param batch_size: The number of videos in a batch
+    :param seq_length: The number of frames of each video
+    :param size: The size of the frames
+    :param repeats: The number of timed batches
+    :param seed: The random seed
+    :return: A dictionary with the throughput of each path in videos per second
+    """
+    rng = np.random.default_rng(seed)
+    rgb = rng.integers(0, 256, (batch_size, seq_length, size, size, 3), dtype=np.uint8)
+    mask = rng.integers(0, 256, (batch_size, seq_length, size, size, 3), dtype=np.uint8)
+    augmenter = VideoAugmenter(degrees=15, flip_prob=1.0, blur_sigma=0.9, add=50, multiply=2, seed=seed)
+
+    results = {'batch_size': batch_size, 'seq_length': seq_length, 'size': size}
+    start_time = time.time()
+    for _ in range(repeats):
+        augmenter(rgb, mask)
+    results['batched_videos_per_sec'] = repeats * batch_size / (time.time() - start_time)
+
+    try:
+        from vidaug import augmentors as va
+    except ImportError:
+        return results
+    seq = va.Sequential([va.RandomRotate(degrees=15), va.HorizontalFlip(),
+                         va.GaussianBlur(0.9), va.Add(50), va.Multiply(2)])
+    start_time = time.time()
+    for _ in range(repeats):
+        # The previous data generator augmented the mask stream and discarded the result
+        for video in list(rgb.astype(np.float32)) + list(mask.astype(np.float32)):
+            np.asarray(seq(list(video)))
+    results['vidaug_videos_per_sec'] = repeats * batch_size / (time.time() - start_time)
+    results['speedup'] = results['batched_videos_per_sec'] / results['vidaug_videos_per_sec']
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(benchmark(), indent=2))
@@ -0,0 +1,322 @@
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+
+import numpy as np
+
+import instrumentation
+from benchmarks.synthetic_data import make_sequences
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ['data_sequence_balance', 'crop_and_process', 'input_pipeline',
+              'intentformer_train', 'intentformer_trainer', 'intentformer_infer', 'evaluation_metrics']
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of the current process
+    :return: The peak RSS in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024. ** 2 if sys.platform == 'darwin' else 1024.)
+
+
+def _timed(run, repeats, warmup=1):
+    # Runs the benchmark body warmup + repeats times and returns the time of the timed runs
+    for _ in range(warmup):
+        run()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    return time.perf_counter() - start_time
+
+
+def _use_random_backbone_weights():
+    # Registers the backbone with random weights, so no weights are downloaded. The throughput
+    # does not depend on the weights
+    import feature_extraction
+    for name, (factory, preprocess) in feature_extraction._BACKBONE_FACTORIES.items():
+        input_shape = (224, 224, 3)
+        convnet = factory(input_shape=input_shape, include_top=False, weights=None)
+        feature_extraction._BACKBONES[(name, input_shape)] = (convnet, preprocess)
+
+
+def bench_data_sequence_balance(data_raw, opts):
+    """
+    Measures PREPROCESS.get_data_sequence_balance(). The synthetic tracks are repeated
+    opts.track_repeats times, since no images are read
+    :return: A dictionary of results, with the throughput in tracks per second
+    """
+    from preprocessing import PREPROCESS
+    data_raw = {k: v * opts.track_repeats if isinstance(v, list) else v for k, v in data_raw.items()}
+    method_class = PREPROCESS()
+    run = lambda: method_class.get_data_sequence_balance(data_raw, obs_length=opts.obs_length,
+                                                         time_to_event=opts.time_to_event,
+                                                         normalize=True)
+    elapsed = _timed(run, opts.repeats)
+    return {'throughput': opts.repeats * len(data_raw['bbox']) / elapsed, 'unit': 'tracks/sec',
+            'seconds': elapsed / opts.repeats, 'num_tracks': len(data_raw['bbox'])}
+
+
+def bench_crop_and_process(data_raw, opts):
+    """
+    Measures PREPROCESS.load_images_crop_and_process(), i.e. reading, cropping and feature
+    extraction of every frame of the observed sequences. Features are always regenerated
+    :return: A dictionary of results, with the throughput in frames per second
+    """
+    from preprocessing import PREPROCESS
+    if not opts.imagenet_weights:
+        _use_random_backbone_weights()
+    method_class = PREPROCESS(num_workers=opts.num_workers)
+    d = method_class.get_data_sequence(data_raw, obs_length=opts.obs_length,
+                                       time_to_event=opts.time_to_event, normalize=False)
+    save_path = os.path.join(opts.work_dir, 'features')
+    num_frames = len(np.unique(d['image']))
+
+    def run():
+        shutil.rmtree(save_path, ignore_errors=True)
+        method_class.load_images_crop_and_process(d['image'], d['box_org'], d['ped_id'], save_path,
+                                                  crop_type='bbox', crop_mode='pad_resize',
+                                                  regen_data=True, num_workers=opts.num_workers)
+    elapsed = _timed(run, opts.repeats)
+    return {'throughput': opts.repeats * num_frames / elapsed, 'unit': 'frames/sec',
+            'seconds': elapsed / opts.repeats, 'num_workers': opts.num_workers}
+
+
+def bench_input_pipeline(data_raw, opts):
+    """
+    Measures an epoch of the IntentDataset training pipeline with augmentation, without and
+    with the crop cache, and with the crop cache for the RGB crops and the segmentation store
+    for the masks
+    :return: A dictionary of results, with the throughput in samples per second
+    """
+    from preprocessing import PREPROCESS
+    from input_pipeline import IntentDataset
+    from augmentation import VideoAugmenter
+    from seg_store import SegmentationStore
+    d = PREPROCESS().get_data_sequence(data_raw, obs_length=opts.obs_length,
+                                       time_to_event=opts.time_to_event, normalize=False)
+    labels = d['acts']
+    augmenter = VideoAugmenter(degrees=15, flip_prob=1.0, blur_sigma=0.9, add=50, multiply=2)
+    cache_dir = os.path.join(opts.work_dir, 'crop_cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    store_dir = os.path.join(opts.work_dir, 'seg_store')
+    shutil.rmtree(store_dir, ignore_errors=True)
+    start_time = time.perf_counter()
+    store = SegmentationStore.build(store_dir, d['image'], num_workers=opts.num_workers)
+
+    results = {'unit': 'samples/sec', 'batch_size': opts.batch_size,
+               'seg_store_build_seconds': time.perf_counter() - start_time,
+               'seg_store_mb': os.path.getsize(os.path.join(store_dir, 'labels.npy')) / 2 ** 20,
+               # The masks of a batch between loading and the last stage of the pipeline
+               'mask_batch_mb': d['image'][:opts.batch_size].size * 224 * 224 * 3 / 2 ** 20,
+               'seg_store_mask_batch_mb': d['image'][:opts.batch_size].size * 224 * 224 / 2 ** 20}
+    for name, cache, seg_store in [('uncached', None, None), ('cached', cache_dir, None),
+                                   ('seg_store', cache_dir, store)]:
+        dataset = IntentDataset(d['image'], d['box_org'], labels, batch_size=opts.batch_size,
+                                train=True, augment=augmenter, cache_dir=cache, seg_store=seg_store)
+        pipeline = dataset.as_dataset()
+        run = lambda: [batch for batch in pipeline]
+        elapsed = _timed(run, opts.repeats)
+        results[name + '_throughput'] = opts.repeats * len(dataset) * opts.batch_size / elapsed
+    results['throughput'] = results['cached_throughput']
+    return results
+
+
+def _intentformer_batch(opts):
+    from intentformer import build_intentformer
+    seq_length = opts.obs_length - 1
+    model = build_intentformer(input_shape=(seq_length, 224, 224, 3), box_shape=(seq_length, 4),
+                               label_shape=(1,), attention_mode=opts.attention_mode)
+    rng = np.random.default_rng(42)
+    inputs = [rng.random((opts.batch_size, seq_length, 224, 224, 3), dtype=np.float32),
+              rng.random((opts.batch_size, seq_length, 224, 224, 3), dtype=np.float32),
+              rng.random((opts.batch_size, seq_length, 4), dtype=np.float32),
+              rng.integers(0, 2, (opts.batch_size, 1)).astype(np.float32)]
+    return model, inputs, inputs[3]
+
+
+def bench_intentformer_train(data_raw, opts):
+    """
+    Measures a training step of IntentFormer on random inputs
+    :return: A dictionary of results, with the throughput in samples per second
+    """
+    from tensorflow import keras
+    model, inputs, labels = _intentformer_batch(opts)
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=1e-4),
+                  loss=keras.losses.SparseCategoricalCrossentropy())
+    elapsed = _timed(lambda: model.train_on_batch(inputs, labels), opts.repeats)
+    return {'throughput': opts.repeats * opts.batch_size / elapsed, 'unit': 'samples/sec',
+            'seconds': elapsed / opts.repeats, 'batch_size': opts.batch_size,
+            'attention_mode': opts.attention_mode}
+
+
+def bench_intentformer_trainer(data_raw, opts):
+    """
+    Measures a training step of IntentFormer with training.Trainer, i.e. with the CAC loss, in the
+    precision given by opts.precision
+    :return: A dictionary of results, with the throughput in samples per second
+    """
+    from tensorflow import keras
+    from training import Trainer
+    policy = keras.mixed_precision.global_policy()
+    if opts.precision == 'bfloat16':
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    try:
+        model, inputs, labels = _intentformer_batch(opts)
+    finally:
+        keras.mixed_precision.set_global_policy(policy)
+    trainer = Trainer(model, keras.optimizers.Adam(learning_rate=1e-4),
+                      accumulation_steps=opts.accumulation_steps, jit_compile=opts.jit_compile)
+    elapsed = _timed(lambda: float(trainer.train_step(inputs, labels)), opts.repeats)
+    return {'throughput': opts.repeats * opts.batch_size / elapsed, 'unit': 'samples/sec',
+            'seconds': elapsed / opts.repeats, 'batch_size': opts.batch_size,
+            'attention_mode': opts.attention_mode, 'precision': opts.precision,
+            'jit_compile': opts.jit_compile, 'accumulation_steps': opts.accumulation_steps}
+
+
+def bench_intentformer_infer(data_raw, opts):
+    """
+    Measures inference of IntentFormer on random inputs
+    :return: A dictionary of results, with the throughput in samples per second
+    """
+    model, inputs, _ = _intentformer_batch(opts)
+    elapsed = _timed(lambda: model.predict_on_batch(inputs), opts.repeats)
+    return {'throughput': opts.repeats * opts.batch_size / elapsed, 'unit': 'samples/sec',
+            'seconds': elapsed / opts.repeats, 'batch_size': opts.batch_size,
+            'attention_mode': opts.attention_mode}
+
+
+def bench_evaluation_metrics(data_raw, opts):
+    """
+    Measures evaluation.compute_metrics() on random predictions of the three heads, broken down
+    by time to event and flipping, with opts.num_tracks * opts.track_repeats samples per time
+    to event
+    :return: A dictionary of results, with the throughput in samples per second
+    """
+    from evaluation import HEADS, Predictions, compute_metrics
+    rng = np.random.default_rng(opts.seed)
+    num_samples = opts.num_tracks * opts.track_repeats
+    predictions = []
+    for time_to_event in [30, 45, 60]:
+        labels = rng.integers(0, 2, (num_samples, 1))
+        images = np.where(rng.random((num_samples, 1)) < 0.5, 'set01/video_0001/00001.png',
+                          'set01/video_0001/00001_flip.png')
+        ped_ids = np.char.add('1_1_', rng.integers(0, 100, (num_samples, 1, 1)).astype(str))
+        outputs = {name: rng.dirichlet([1, 1], num_samples) for name in HEADS}
+        predictions.append(Predictions.from_outputs(outputs, images, ped_ids, labels, time_to_event))
+    predictions = Predictions.concatenate(predictions)
+    elapsed = _timed(lambda: compute_metrics(predictions, by=('tte', 'flipped')), opts.repeats)
+    return {'throughput': opts.repeats * len(predictions) / elapsed, 'unit': 'samples/sec',
+            'seconds': elapsed / opts.repeats, 'num_samples': len(predictions)}
+
+
+def run_benchmark(name, opts):
+    """
+    Runs a benchmark in the current process
+    :param name: The name of the benchmark (see BENCHMARKS)
+    :param opts: The command line options
+    :return: A dictionary of results, including the peak RSS of the process
+    """
+    data_raw = make_sequences(os.path.join(opts.work_dir, opts.dataset), dataset=opts.dataset,
+                              num_tracks=opts.num_tracks, track_length=opts.track_length,
+                              image_size=tuple(opts.image_size), seed=opts.seed)
+    if opts.instrument:
+        instrumentation.enable()
+    results = {'benchmark': name}
+    results.update(globals()['bench_' + name](data_raw, opts))
+    results['peak_rss_mb'] = peak_rss_mb()
+    if opts.instrument:
+        results['instrumentation'] = instrumentation.snapshot()
+        instrumentation.reset()
+    return results
+
+
+def environment():
+    """
+    Collects information on the machine and library versions
+    :return: A dictionary
+    """
+    import tensorflow as tf
+    return {'python': platform.python_version(),
+            'tensorflow': tf.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the data processing and model steps '
+                                                 'on a synthetic PIE/JAAD-shaped dataset')
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--work_dir', default='data/benchmarks',
+                        help='Folder of the synthetic dataset, features and caches')
+    parser.add_argument('--output', default=None, help='Path of the JSON results (default: stdout)')
+    parser.add_argument('--dataset', default='pie', choices=['pie', 'jaad'])
+    parser.add_argument('--num_tracks', type=int, default=16)
+    parser.add_argument('--track_length', type=int, default=75)
+    parser.add_argument('--track_repeats', type=int, default=100,
+                        help='Number of times the tracks are repeated for data_sequence_balance')
+    parser.add_argument('--image_size', type=int, nargs=2, default=[1920, 1080])
+    parser.add_argument('--obs_length', type=int, default=15)
+    parser.add_argument('--time_to_event', type=int, default=60)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--attention_mode', default='window',
+                        help='Attention mode of IntentFormer. Training with full attention needs '
+                             'more than 10GB of memory at batch size 2')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'bfloat16'],
+                        help='Precision of intentformer_trainer. bfloat16 uses mixed precision')
+    parser.add_argument('--jit_compile', action='store_true', help='Compile the steps of intentformer_trainer with XLA')
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help='Number of batches per weight update of intentformer_trainer')
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--imagenet_weights', action='store_true',
+                        help='Use the ImageNet weights of the backbone instead of random weights')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Add the spans and counters of each benchmark to the results')
+    parser.add_argument('--in_process', action='store_true',
+                        help='Run all benchmarks in this process. By default each benchmark runs in '
+                             'its own process, so the peak RSS is measured per benchmark')
+    opts = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'options': vars(opts), 'benchmarks': []}
+    for name in opts.benchmarks:
+        print('Running {}'.format(name), file=sys.stderr)
+        if opts.in_process:
+            results['benchmarks'].append(run_benchmark(name, opts))
+            continue
+        args = argv if argv is not None else sys.argv[1:]
+        command = [sys.executable, '-m', 'benchmarks.run_benchmarks'] + list(args) + \
+                  ['--benchmarks', name, '--in_process', '--output', '-']
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([_REPO_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+        process = subprocess.run(command, stdout=subprocess.PIPE, env=env)
+        if process.returncode != 0:
+            # A failing benchmark, e.g. running out of memory, does not stop the others
+            results['benchmarks'].append({'benchmark': name, 'error': 'exit status {}'.format(process.returncode)})
+            continue
+        output = process.stdout.decode('utf-8').splitlines()[-1]
+        results['benchmarks'].extend(json.loads(output)['benchmarks'])
+
+    if opts.output in [None, '-']:
+        # The results are the last line of the output, after the logs of the benchmarks
+        print(json.dumps(results, indent=None if opts.output == '-' else 2))
+    else:
+        with open(opts.output, 'w') as fid:
+            json.dump(results, fid, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
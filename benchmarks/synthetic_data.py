@@ -0,0 +1,118 @@
+
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Colors of the segmentation classes drawn into the synthetic segmentation maps
+SEG_PALETTE = {'road': (128, 64, 128),
+               'sidewalk': (244, 35, 232),
+               'building': (70, 70, 70),
+               'sky': (70, 130, 180),
+               'pedestrian': (220, 20, 60)}
+
+
+def video_folder(root, dataset, video):
+    """
+    Returns the image folder of a video, following the layout of the dataset
+    :param root: The root folder of the synthetic dataset
+    :param dataset: 'pie' (<root>/images/set01/video_0001) or 'jaad' (<root>/images/video_0001)
+    :param video: The index of the video
+    :return: The path to the folder of the RGB frames. Segmentation maps are in the same path
+             with 'images' replaced by 'seg_images'
+    """
+    if dataset == 'pie':
+        return os.path.join(root, 'images', 'set01', 'video_%04d' % (video + 1))
+    return os.path.join(root, 'images', 'video_%04d' % (video + 1))
+
+
+def _write_frames(folder, num_frames, image_size, boxes, rng):
+    # Draws the RGB frames and segmentation maps of a video. The background is a fixed textured
+    # scene, so the images have the detail (and decoding cost) of camera images
+    width, height = image_size
+    texture = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    background = Image.fromarray(texture).resize((width, height), Image.BILINEAR)
+    seg_background = Image.new('RGB', (width, height), SEG_PALETTE['road'])
+    draw = ImageDraw.Draw(seg_background)
+    draw.rectangle([0, 0, width, height // 3], fill=SEG_PALETTE['sky'])
+    draw.rectangle([0, height // 3, width, height // 2], fill=SEG_PALETTE['building'])
+    draw.rectangle([0, height // 2, width, 2 * height // 3], fill=SEG_PALETTE['sidewalk'])
+
+    seg_folder = folder.replace('images', 'seg_images')
+    for path in (folder, seg_folder):
+        if not os.path.exists(path):
+            os.makedirs(path)
+    for f in range(num_frames):
+        img = background.copy()
+        seg = seg_background.copy()
+        img_draw, seg_draw = ImageDraw.Draw(img), ImageDraw.Draw(seg)
+        for box in boxes.get(f, []):
+            img_draw.rectangle(box, fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+            seg_draw.rectangle(box, fill=SEG_PALETTE['pedestrian'])
+        img.save(os.path.join(folder, '%05d.png' % f), compress_level=1)
+        seg.save(os.path.join(seg_folder, '%05d.png' % f), compress_level=1)
+
+
+def make_sequences(root, dataset='pie', num_tracks=16, track_length=75, num_videos=2,
+                   num_frames=None, image_size=(1920, 1080), pos_ratio=0.3, seed=42):
+    """
+    Generates a synthetic dataset shaped like the output of the PIE/JAAD interfaces'
+    generate_data_trajectory_sequence(). RGB frames and segmentation maps are written as PNG
+    files to <root>. Frames that already exist are not rewritten, so the data of a seed can be
+    reused across runs
+    :param root: The root folder of the synthetic dataset
+    :param dataset: 'pie' or 'jaad'. JAAD sequences have 'vehicle_act' instead of 'obd_speed'
+    :param num_tracks: The number of pedestrian tracks
+    :param track_length: The number of frames of each track
+    :param num_videos: The number of videos the tracks are distributed over
+    :param num_frames: The number of frames of each video. Defaults to twice the track length
+    :param image_size: The (width, height) of the frames
+    :param pos_ratio: The ratio of crossing tracks
+    :param seed: The random seed
+    :return: A dictionary of data sequences, as returned by generate_data_trajectory_sequence()
+    """
+    assert dataset in ['pie', 'jaad'], 'Dataset {} is invalid'.format(dataset)
+    num_frames = num_frames or 2 * track_length
+    assert num_frames >= track_length, 'Videos are shorter than the tracks'
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+
+    data_raw = {k: [] for k in ['image', 'pid', 'bbox', 'center', 'occlusion', 'activities']}
+    data_raw['obd_speed' if dataset == 'pie' else 'vehicle_act'] = []
+    data_raw['image_dimension'] = (width, height)
+    labels = rng.permutation(np.arange(num_tracks) < max(1, int(round(pos_ratio * num_tracks))))
+    video_boxes = [{} for _ in range(num_videos)]
+    for t in range(num_tracks):
+        video = t % num_videos
+        start = int(rng.integers(0, num_frames - track_length + 1))
+        frames = np.arange(start, start + track_length)
+
+        # Pedestrians walk along a straight line and grow as they get closer
+        box_height = np.linspace(rng.uniform(0.1, 0.2), rng.uniform(0.2, 0.4), track_length) * height
+        box_width = box_height * 0.4
+        x1 = np.linspace(rng.uniform(0, 0.8), rng.uniform(0, 0.8), track_length) * width
+        y2 = np.linspace(0.6, 0.9, track_length) * height
+        boxes = np.stack([x1, y2 - box_height, np.minimum(x1 + box_width, width - 1), y2], axis=1)
+        label = int(labels[t])
+
+        folder = video_folder(root, dataset, video)
+        data_raw['image'].append([os.path.join(folder, '%05d.png' % f) for f in frames])
+        data_raw['pid'].append([['%d_%d_%d' % (1, video + 1, t)]] * track_length)
+        data_raw['bbox'].append(boxes.tolist())
+        data_raw['center'].append(np.stack([(boxes[:, 0] + boxes[:, 2]) / 2,
+                                            (boxes[:, 1] + boxes[:, 3]) / 2], axis=1).tolist())
+        data_raw['occlusion'].append([[0]] * track_length)
+        data_raw['activities'].append([[label]] * track_length)
+        if dataset == 'pie':
+            data_raw['obd_speed'].append(rng.uniform(0, 40, (track_length, 1)).tolist())
+        else:
+            data_raw['vehicle_act'].append(rng.integers(0, 4, (track_length, 1)).tolist())
+        for f, box in zip(frames, boxes.tolist()):
+            video_boxes[video].setdefault(int(f), []).append(box)
+
+    for video in range(num_videos):
+        folder = video_folder(root, dataset, video)
+        if os.path.exists(os.path.join(folder.replace('images', 'seg_images'), '%05d.png' % (num_frames - 1))):
+            continue
+        _write_frames(folder, num_frames, image_size, video_boxes[video], rng)
+    return data_raw
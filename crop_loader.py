@@ -0,0 +1,159 @@
+
+import threading
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+from keras_preprocessing.image import load_img
+
+from utils import img_pad
+import instrumentation
+
+
+def load_and_crop(imp, b, crop_type='bbox', crop_mode='pad_resize', fallback_paths=(), size=224):
+    """
+    Reads an image, flips it if necessary and crops the bounding box area
+    :param imp: The path to the image. Names ending with '_flip' refer to the flipped
+                version of the image
+    :param b: The bounding box coordinates
+    :param crop_type: The method to crop the bounding boxes from the images. Options are: 'none', 'bbox'
+    :param crop_mode: How the cropped image resized and padded (see utils.py:img_pad())
+    :param fallback_paths: Paths of previously read images, most recent first. If the image
+                           cannot be read, the first readable image in this list is used instead
+    :param size: The size of the output image
+    :return: The processed image as a uint8 array
+    """
+    flip_image = False
+    if 'flip' in imp:
+        imp = imp.replace('_flip', '')
+        flip_image = True
+
+    if crop_type == 'none':
+        with instrumentation.span('image.decode'):
+            img_data = load_img(imp, target_size=(size, size))
+        if flip_image:
+            img_data = img_data.transpose(Image.FLIP_LEFT_RIGHT)
+        return np.asarray(img_data, dtype=np.uint8)
+
+    for path in (imp,) + tuple(fallback_paths):
+        try:
+            with instrumentation.span('image.decode'):
+                img_data = load_img(path)
+                # Decode now rather than on the first access
+                img_data.load()
+            break
+        except Exception as e:
+            instrumentation.count('image.decode_errors')
+            error = e
+    else:
+        raise error
+
+    if flip_image:
+        img_data = img_data.transpose(Image.FLIP_LEFT_RIGHT)
+    if crop_type == 'bbox':
+        with instrumentation.span('image.crop_pad'):
+            cropped_image = img_data.crop(list(map(int, b[0:4])))
+            img_data = img_pad(cropped_image, mode=crop_mode, size=size)
+    else:
+        raise ValueError('ERROR: Undefined value for crop_type {}!'.format(crop_type))
+    return np.asarray(img_data, dtype=np.uint8)
+
+
+# Shared image buffer of the worker processes
+_worker_buffer = None
+
+
+def _init_worker(shared_array, buffer_shape):
+    global _worker_buffer
+    _worker_buffer = np.frombuffer(shared_array, dtype=np.uint8).reshape(buffer_shape)
+
+
+def _load_into_slot(args):
+    slot, imp, b, fallback_paths, crop_type, crop_mode = args
+    img_data = load_and_crop(imp, b, crop_type, crop_mode, fallback_paths,
+                             size=_worker_buffer.shape[1])
+    if img_data.shape != _worker_buffer.shape[1:]:
+        raise ValueError('ERROR: crop_mode {} produced an image of shape {}, expected {}'.format(
+            crop_mode, img_data.shape, _worker_buffer.shape[1:]))
+    _worker_buffer[slot] = img_data
+    return slot
+
+
+class CropLoader(object):
+    """
+    Reads, crops and pads images for feature extraction. With num_workers > 0, images are
+    decoded and cropped in worker processes and passed back through a ring of shared memory
+    slots. Images are always returned in the order of the tasks, so the output is identical
+    to the serial path. Workers are not forked from the calling process, which may already run
+    TensorFlow's thread pools, but started from a fresh server ('forkserver') or interpreter
+    ('spawn').
+
+    Attributes:
+        crop_type: The method to crop the bounding boxes from the images
+        crop_mode: How the cropped image resized and padded
+        num_workers: The number of worker processes. 0 processes the images in the calling process
+        size: The size of the output images
+
+    Methods:
+        imap: Returns an iterator over the processed images
+    """
+    def __init__(self, crop_type='bbox', crop_mode='pad_resize',
+                 num_workers=0, size=224, slots_per_worker=8):
+        self.crop_type = crop_type
+        self.crop_mode = crop_mode
+        self.num_workers = num_workers
+        self.size = size
+        self._slots_per_worker = slots_per_worker
+
+    def imap(self, tasks):
+        """
+        Processes images
+        :param tasks: An iterable of (image path, bounding box, fallback paths) tuples
+        :return: An iterator over the processed images as float32 arrays of shape (size, size, 3)
+        """
+        if self.num_workers == 0:
+            for imp, b, fallback_paths in tasks:
+                yield load_and_crop(imp, b, self.crop_type, self.crop_mode,
+                                    fallback_paths, self.size).astype(np.float32)
+            return
+
+        # Forking a process with initialized TensorFlow thread pools can deadlock the children
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        num_slots = self.num_workers * self._slots_per_worker
+        buffer_shape = (num_slots, self.size, self.size, 3)
+        shared_array = context.RawArray('B', int(np.prod(buffer_shape)))
+        buffer = np.frombuffer(shared_array, dtype=np.uint8).reshape(buffer_shape)
+
+        # A slot is handed out again only after its image has been copied out. Results are
+        # consumed in task order, so slots are freed in the order they are assigned
+        free_slots = threading.Semaphore(num_slots)
+        stop = threading.Event()
+
+        def submit():
+            for i, (imp, b, fallback_paths) in enumerate(tasks):
+                free_slots.acquire()
+                if stop.is_set():
+                    return
+                yield (i % num_slots, imp, b, tuple(fallback_paths), self.crop_type, self.crop_mode)
+
+        pool = context.Pool(self.num_workers, initializer=_init_worker,
+                            initargs=(shared_array, buffer_shape))
+        try:
+            slots = pool.imap(_load_into_slot, submit())
+            while True:
+                # Time spent waiting for the workers. Spans inside the workers are not recorded
+                with instrumentation.span('crop_loader.wait'):
+                    slot = next(slots, None)
+                if slot is None:
+                    break
+                img_data = buffer[slot].astype(np.float32)
+                free_slots.release()
+                yield img_data
+        finally:
+            # Unblock the task feeder so the pool can shut down
+            stop.set()
+            for _ in range(num_slots):
+                free_slots.release()
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,226 @@
+
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import argparse
+import subprocess
+
+import tensorflow as tf
+from tensorflow import keras
+
+from input_pipeline import IntentDataset
+from augmentation import VideoAugmenter
+from sampler import BalancedSampler
+from seg_store import SegmentationStore
+from intentformer import build_intentformer
+from training import Trainer
+
+
+def task_info():
+    """
+    Returns the task of this process in the cluster described by the TF_CONFIG environment
+    variable, as set by launch()
+    :return: A tuple (task_index, num_workers). (0, 1) if TF_CONFIG is not set
+    """
+    config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if not config:
+        return 0, 1
+    return config['task']['index'], len(config['cluster']['worker'])
+
+
+def is_chief():
+    """
+    :return: Whether this process is the chief worker, which writes checkpoints and logs
+    """
+    return task_info()[0] == 0
+
+
+def make_strategy():
+    """
+    Creates the distribution strategy of this process. Must be called before any other
+    TensorFlow operation
+    :return: A MultiWorkerMirroredStrategy if TF_CONFIG describes more than one worker, else the
+             default strategy
+    """
+    if task_info()[1] == 1:
+        return tf.distribute.get_strategy()
+    # The ring all-reduce runs on CPU. The NCCL implementation requires GPUs
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def distribute_dataset(strategy, make_dataset):
+    """
+    Creates a distributed dataset with one input pipeline per worker. Each worker builds its own
+    shard, so the samples are not read by every worker, e.g.
+        distribute_dataset(strategy, lambda num_shards, shard_index: IntentDataset(
+            ..., num_shards=num_shards, shard_index=shard_index).as_dataset())
+    :param strategy: The distribution strategy
+    :param make_dataset: A function (num_shards, shard_index) -> tf.data.Dataset of the
+                         per-worker batches of a shard
+    :return: A distributed dataset
+    """
+    return strategy.distribute_datasets_from_function(
+        lambda context: make_dataset(context.num_input_pipelines, context.input_pipeline_id))
+
+
+def save_data(path, train_data, val_data):
+    """
+    Saves the training and validation data of PREPROCESS.get_data(), which the workers of
+    the training script load
+    :param path: The path of the pickle file
+    :param train_data: The (x, y) training data, e.g. (x_train, y_train) of the notebook
+    :param val_data: The (x, y) validation data
+    """
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fid:
+        pickle.dump({'train': train_data, 'val': val_data}, fid, pickle.HIGHEST_PROTOCOL)
+
+
+def _free_ports(num_ports):
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch(command, num_workers, cores_per_worker=None):
+    """
+    Runs a training script as a cluster of local worker processes. Each worker gets its task in
+    the TF_CONFIG environment variable (see make_strategy()) and, on Linux, its own set of CPU
+    cores. If a worker fails, the other workers are stopped, since they would wait for it
+    :param command: The command of a worker, e.g. [sys.executable, 'train.py']
+    :param num_workers: The number of workers
+    :param cores_per_worker: The number of CPU cores of each worker. Defaults to an equal share
+                             of the available cores
+    :return: The exit code of each worker
+    """
+    workers = ['localhost:{}'.format(port) for port in _free_ports(num_workers)]
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    cores_per_worker = cores_per_worker or max(1, len(cores) // num_workers)
+
+    processes = []
+    for task_index in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers},
+                                       'task': {'type': 'worker', 'index': task_index}})
+        worker_cores = None
+        if cores:
+            # Workers share the cores round robin if there are fewer cores than workers
+            first = task_index * cores_per_worker % len(cores)
+            worker_cores = {cores[(first + i) % len(cores)] for i in range(cores_per_worker)}
+            env['OMP_NUM_THREADS'] = str(len(worker_cores))
+        preexec_fn = (lambda c=worker_cores: os.sched_setaffinity(0, c)) if worker_cores else None
+        processes.append(subprocess.Popen(command, env=env, preexec_fn=preexec_fn))
+
+    exit_codes = [None] * num_workers
+    while None in exit_codes:
+        time.sleep(1)
+        for i, process in enumerate(processes):
+            exit_codes[i] = process.poll()
+        if any(code for code in exit_codes if code is not None):
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+            exit_codes = [process.wait() for process in processes]
+    return exit_codes
+
+
+def train(opts):
+    """
+    Trains IntentFormer as a worker of a cluster started by launch(). Every worker trains on
+    its shard of each epoch with opts.batch_size samples per step, for a global batch size of
+    opts.batch_size * num_workers. Only the chief writes checkpoints and prints progress
+    :param opts: The command line options (see main())
+    :return: The training history of the chief, None on the other workers
+    """
+    strategy = make_strategy()
+    task_index, num_workers = task_info()
+    # All workers start from the same seed, so they draw the same epochs and the model is
+    # initialized identically. The samples are split between the workers by sharding
+    tf.keras.utils.set_random_seed(opts.seed)
+
+    with open(opts.data, 'rb') as fid:
+        data = pickle.load(fid)
+    (x_train, y_train), (x_val, y_val) = data['train'], data['val']
+    augmenter = VideoAugmenter(degrees=15, flip_prob=1.0, blur_sigma=0.9, add=50, multiply=2, seed=opts.seed)
+    # Crop caches are not shared between processes
+    cache_dir = lambda split: os.path.join(opts.cache_dir, split, 'worker_{}'.format(task_index)) \
+        if opts.cache_dir else None
+    # Segmentation stores are read only, so the workers share them
+    seg_store = lambda split: SegmentationStore(os.path.join(opts.seg_store, split)) if opts.seg_store else None
+
+    traingen = distribute_dataset(strategy, lambda num_shards, shard_index: IntentDataset(
+        x_train[0], x_train[2], y_train, batch_size=opts.batch_size, train=True, augment=augmenter,
+        seed=opts.seed, cache_dir=cache_dir('train'), sampler=BalancedSampler(y_train, mode='exact', seed=opts.seed),
+        num_shards=num_shards, shard_index=shard_index, seg_store=seg_store('train')).as_dataset())
+    valgen = distribute_dataset(strategy, lambda num_shards, shard_index: IntentDataset(
+        x_val[0], x_val[2], y_val, batch_size=opts.batch_size, train=False, cache_dir=cache_dir('val'),
+        num_shards=num_shards, shard_index=shard_index, seg_store=seg_store('val')).as_dataset())
+
+    keras.mixed_precision.set_global_policy(opts.precision_policy)
+    with strategy.scope():
+        model = build_intentformer(input_shape=(opts.obs_length - 1, 224, 224, 3), box_shape=(opts.obs_length - 1, 4),
+                                   label_shape=(1,), seed=opts.seed, attention_mode=opts.attention_mode)
+        optimizer = keras.optimizers.Adam(learning_rate=opts.learning_rate)
+    trainer = Trainer(model, optimizer, accumulation_steps=opts.accumulation_steps)
+    # Dropout differs between the workers
+    tf.random.set_seed(opts.seed + task_index)
+
+    scheduler = lambda epoch, lr: lr if epoch < 7 else lr * tf.math.exp(-0.1)
+    callbacks = [keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=5),
+                 # Non-chief workers write to temporary folders, which are removed
+                 keras.callbacks.ModelCheckpoint(filepath=os.path.join(opts.checkpoint_dir, 'cp_{epoch:0d}.tf'),
+                                                 monitor='val_traj_o_accuracy', mode='max'),
+                 keras.callbacks.LearningRateScheduler(scheduler)]
+    history = trainer.fit(traingen, epochs=opts.epochs, validation_data=valgen, callbacks=callbacks,
+                          verbose=int(is_chief()))
+    if not is_chief():
+        return None
+    with open(os.path.join(opts.checkpoint_dir, 'history.json'), 'w') as fid:
+        json.dump({k: [float(v) for v in values] for k, values in history.history.items()}, fid, indent=2)
+    return history
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synchronous data parallel training of IntentFormer on local '
+                                                 'worker processes')
+    parser.add_argument('data', help='Training and validation data saved with save_data()')
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--cores_per_worker', type=int, default=None,
+                        help='CPU cores of each worker (default: an equal share of the available cores)')
+    parser.add_argument('--checkpoint_dir', default='data/models/distributed')
+    parser.add_argument('--cache_dir', default=None, help='Folder of the crop caches of the workers')
+    parser.add_argument('--seg_store', default=None,
+                        help='Folder of the segmentation stores of the splits, created with seg_store.py')
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size of each worker')
+    parser.add_argument('--accumulation_steps', type=int, default=1)
+    parser.add_argument('--learning_rate', type=float, default=1e-4)
+    parser.add_argument('--obs_length', type=int, default=15)
+    parser.add_argument('--attention_mode', default='full')
+    parser.add_argument('--precision_policy', default='float32', choices=['float32', 'mixed_bfloat16'])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--worker', action='store_true', help='Run as a worker of a launched cluster')
+    opts = parser.parse_args(argv)
+
+    if opts.worker:
+        train(opts)
+        return
+    args = argv if argv is not None else sys.argv[1:]
+    exit_codes = launch([sys.executable, os.path.abspath(__file__)] + list(args) + ['--worker'],
+                        opts.num_workers, opts.cores_per_worker)
+    if any(exit_codes):
+        sys.exit('Workers failed with exit codes {}'.format(exit_codes))
+
+
+if __name__ == '__main__':
+    main()
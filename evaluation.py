@@ -0,0 +1,373 @@
+
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+import instrumentation
+
+HEADS = ['rgb_o', 'seg_o', 'traj_o']
+METRICS = ['accuracy', 'auc', 'f1', 'precision', 'recall']
+
+
+def checkpoint_fingerprint(path):
+    """
+    Computes the fingerprint of a saved model, i.e. of its last folders and the size and
+    modification time of its files. A checkpoint written again, e.g. by ModelCheckpoint, gets a
+    new fingerprint
+    :param path: The path of the checkpoint, e.g. a SavedModel folder 'cp_8.tf' or an .h5 file
+    :return: The fingerprint as a hex string
+    """
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+    source = ['/'.join(os.path.abspath(path).split('/')[-2:])]
+    for name in files:
+        stat = os.stat(name)
+        source.append([os.path.relpath(name, path) if name != path else '', stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest()[:16]
+
+
+def split_fingerprint(images, labels):
+    """
+    Computes the fingerprint of the samples of a data split
+    :param images: The image paths of the sequences, of shape (num_samples, seq_length)
+    :param labels: The labels of shape (num_samples, 1)
+    :return: The fingerprint as a hex string
+    """
+    images = np.asarray(images)
+    digest = hashlib.sha1('\n'.join(images.ravel().tolist()).encode('utf-8'))
+    digest.update(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    digest.update(json.dumps(images.shape).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+class Predictions(object):
+    """
+    The outputs of the heads of a model on a set of samples, along with the metadata of every
+    sample. The heads are two-class softmax outputs, so only the probability of the positive
+    class (crossing) is kept. Predictions of several splits, e.g. of the test data at several
+    times to event, can be concatenated and broken down by any metadata column.
+
+    Attributes:
+        probabilities: A dictionary with the positive class probability of each head, of shape
+                       (num_samples,)
+        labels: The labels of shape (num_samples,)
+        metadata: A dictionary of per-sample arrays: 'ped_id', 'tte' (the time to event of the
+                  observation window, in frames) and 'flipped'
+
+    Methods:
+        from_outputs: Creates predictions from the model outputs and the data of a split
+        concatenate: Concatenates predictions
+        select: Returns the predictions of a subset of the samples
+        save: Saves the predictions
+        load: Loads saved predictions
+    """
+    def __init__(self, probabilities, labels, metadata):
+        self.probabilities = probabilities
+        self.labels = labels
+        self.metadata = metadata
+
+    @classmethod
+    def from_outputs(cls, outputs, images, ped_ids, labels, time_to_event):
+        """
+        Creates predictions from the model outputs and the data of a split
+        :param outputs: A dictionary with the softmax output of each head, of shape (num_samples, 2)
+        :param images: The image paths of the sequences. Flipped samples refer to '_flip' images
+        :param ped_ids: The pedestrian ids of the sequences, of shape (num_samples, seq_length, 1)
+        :param labels: The labels of shape (num_samples, 1)
+        :param time_to_event: The time to event of the split, or of each sample
+        :return: A Predictions object
+        """
+        images = np.asarray(images)
+        num_samples = len(images)
+        metadata = {'ped_id': np.asarray(ped_ids).reshape(num_samples, -1)[:, 0].astype(str),
+                    'tte': np.broadcast_to(np.asarray(time_to_event, dtype=np.int16), (num_samples,)).copy(),
+                    'flipped': np.char.find(images[:, -1].astype(str), '_flip') >= 0}
+        probabilities = {name: np.asarray(output, dtype=np.float32)[:, -1] for name, output in outputs.items()}
+        # Every sample must be scored, otherwise the metrics of checkpoints are not comparable
+        for name, p in probabilities.items():
+            if len(p) != num_samples:
+                raise ValueError('The {} outputs of {} do not match the {} samples of the split. The dataset '
+                                 'must not drop the last batch (see IntentDataset(train=False))'.format(
+                                     len(p), name, num_samples))
+        return cls(probabilities, np.asarray(labels).reshape(-1).astype(np.uint8), metadata)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def concatenate(cls, predictions):
+        """
+        Concatenates predictions with the same heads
+        :param predictions: A list of Predictions objects
+        :return: A Predictions object
+        """
+        return cls({name: np.concatenate([p.probabilities[name] for p in predictions])
+                    for name in predictions[0].probabilities},
+                   np.concatenate([p.labels for p in predictions]),
+                   {k: np.concatenate([p.metadata[k] for p in predictions]) for k in predictions[0].metadata})
+
+    def select(self, index):
+        """
+        Selects a subset of the samples
+        :param index: An index or boolean mask over the samples
+        :return: A Predictions object
+        """
+        return Predictions({name: p[index] for name, p in self.probabilities.items()}, self.labels[index],
+                           {k: v[index] for k, v in self.metadata.items()})
+
+    def save(self, path, **attributes):
+        """
+        Saves the predictions to an uncompressed .npz file
+        :param path: The path of the file
+        :param attributes: Strings saved along with the predictions, e.g. fingerprints
+        """
+        arrays = {'probabilities/' + name: p for name, p in self.probabilities.items()}
+        arrays.update({'metadata/' + k: v for k, v in self.metadata.items()})
+        arrays.update({'attributes/' + k: np.asarray(v) for k, v in attributes.items()})
+        # Written to a temporary file first, so an interrupted write does not leave a partial file
+        with open(path + '.tmp', 'wb') as fid:
+            np.savez(fid, labels=self.labels, **arrays)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads saved predictions
+        :param path: The path of the .npz file
+        :return: A tuple (Predictions, attributes)
+        """
+        with np.load(path) as arrays:
+            groups = {'probabilities': {}, 'metadata': {}, 'attributes': {}}
+            for key in arrays.files:
+                if '/' in key:
+                    group, name = key.split('/', 1)
+                    groups[group][name] = arrays[key]
+            attributes = {k: str(v) for k, v in groups['attributes'].items()}
+            return cls(groups['probabilities'], arrays['labels'], groups['metadata']), attributes
+
+
+def predict(model, dataset, outputs=None):
+    """
+    Runs a model on a dataset, in a single forward pass per batch
+    :param model: The IntentFormer model
+    :param dataset: A dataset of ((RGB, mask, box, target), target) batches of all samples in the
+                    order of the samples, e.g. IntentDataset(train=False).as_dataset()
+    :param outputs: The names of the heads. Defaults to all heads
+    :return: A dictionary with the softmax output of each head, of shape (num_samples, 2)
+    """
+    from export import inference_model
+    keras_model = inference_model(model, outputs)
+    predictions = {name: [] for name in keras_model.output_names}
+    for (rgb, mask, box, _), _ in instrumentation.timed_iter(dataset, 'evaluation.next_batch'):
+        with instrumentation.span('evaluation.predict'):
+            batch_outputs = keras_model.predict_on_batch([rgb, mask, box])
+        if not isinstance(batch_outputs, list):
+            batch_outputs = [batch_outputs]
+        for name, output in zip(keras_model.output_names, batch_outputs):
+            predictions[name].append(np.asarray(output, dtype=np.float32))
+    return {name: np.concatenate(p) for name, p in predictions.items()}
+
+
+class PredictionCache(object):
+    """
+    A cache of the predictions of checkpoints on data splits. A checkpoint is run once per
+    split and its predictions are stored in <root>/<checkpoint fingerprint>/<split>.npz, along
+    with the fingerprint of the split's samples. Metrics, breakdowns and comparisons of
+    checkpoints are then computed from the stored predictions without running the model.
+    A checkpoint that is written again, or a split with other samples, is predicted again.
+
+    Attributes:
+        root: The root folder of the cache
+
+    Methods:
+        path: Returns the path of the predictions of a checkpoint on a split
+        lookup: Returns the cached predictions of a checkpoint on a split, or None
+        predictions: Returns the predictions of a checkpoint on a split, running the model if needed
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, checkpoint, split):
+        """
+        Returns the path of the predictions of a checkpoint on a split
+        :param checkpoint: The path of the checkpoint
+        :param split: The name of the split, e.g. 'test' or 'test_tte30'
+        :return: The path of the .npz file
+        """
+        return os.path.join(self.root, checkpoint_fingerprint(checkpoint), split + '.npz')
+
+    def lookup(self, checkpoint, split, images, labels):
+        """
+        Returns the cached predictions of a checkpoint on a split
+        :param checkpoint: The path of the checkpoint
+        :param split: The name of the split
+        :param images: The image paths of the split's sequences
+        :param labels: The labels of the split
+        :return: A Predictions object, or None if the predictions are not in the cache or stale
+        """
+        path = self.path(checkpoint, split)
+        if not os.path.exists(path):
+            return None
+        predictions, attributes = Predictions.load(path)
+        if attributes.get('split_fingerprint') != split_fingerprint(images, labels):
+            return None
+        return predictions
+
+    def predictions(self, checkpoint, split, data, make_dataset, time_to_event, model=None):
+        """
+        Returns the predictions of a checkpoint on a split. If they are not cached, the checkpoint
+        is loaded and run on the split, and the predictions are stored
+        :param checkpoint: The path of the checkpoint
+        :param split: The name of the split
+        :param data: The (x, y) data of the split in the format of PREPROCESS.get_data(), with
+                     obs_input_type ['image', 'ped_id', 'box_org', ...]
+        :param make_dataset: A function (x, y) -> dataset of the batches of all of the split's
+                             samples in their order, e.g.
+                             lambda x, y: IntentDataset(x[0], x[2], y, train=False).as_dataset()
+        :param time_to_event: The time to event of the split
+        :param model: The model loaded from the checkpoint. If None, it is loaded when needed
+        :return: A Predictions object
+        """
+        (x, y) = data
+        predictions = self.lookup(checkpoint, split, x[0], y)
+        if predictions is not None:
+            return predictions
+        if model is None:
+            from tensorflow import keras
+            from intentformer import CUSTOM_OBJECTS
+            model = keras.models.load_model(checkpoint, custom_objects=CUSTOM_OBJECTS, compile=False)
+        print('Predicting {} on {}'.format(checkpoint, split))
+        outputs = predict(model, make_dataset(x, y))
+        predictions = Predictions.from_outputs(outputs, x[0], x[1], y, time_to_event)
+
+        path = self.path(checkpoint, split)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+            with open(os.path.join(os.path.dirname(path), 'checkpoint.json'), 'w') as fid:
+                json.dump({'checkpoint': os.path.abspath(checkpoint)}, fid, indent=2)
+        predictions.save(path, split_fingerprint=split_fingerprint(x[0], y))
+        return predictions
+
+
+def _group_codes(predictions, by):
+    # Integer codes of the groups of the samples and the values of the metadata columns of each group
+    if not by:
+        return np.zeros(len(predictions), dtype=np.int64), [()]
+    columns = [np.unique(predictions.metadata[k], return_inverse=True) for k in by]
+    codes = np.stack([inverse.reshape(-1) for _, inverse in columns], axis=1)
+    group_codes, codes = np.unique(codes, axis=0, return_inverse=True)
+    groups = [tuple(values[c].item() for (values, _), c in zip(columns, group)) for group in group_codes]
+    return codes.reshape(-1), groups
+
+
+def _auc(codes, labels, scores, num_groups):
+    # The area under the ROC curve of each group, from the Mann-Whitney U statistic. The samples
+    # are sorted by group and score, and tied scores get their average rank within the group
+    order = np.lexsort((scores, codes))
+    codes, labels, scores = codes[order], labels[order], scores[order]
+    num_samples = len(codes)
+    new_block = np.ones(num_samples, dtype=bool)
+    new_block[1:] = (codes[1:] != codes[:-1]) | (scores[1:] != scores[:-1])
+    blocks = np.cumsum(new_block) - 1
+    group_start = np.searchsorted(codes, np.arange(num_groups))
+    ranks = np.arange(1, num_samples + 1) - group_start[codes]
+    mean_ranks = np.bincount(blocks, weights=ranks) / np.bincount(blocks)
+    positive_ranks = np.bincount(codes, weights=mean_ranks[blocks] * labels, minlength=num_groups)
+    num_positive = np.bincount(codes, weights=labels, minlength=num_groups)
+    num_negative = np.bincount(codes, minlength=num_groups) - num_positive
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc = (positive_ranks - num_positive * (num_positive + 1) / 2) / (num_positive * num_negative)
+    # Undefined for groups of a single class
+    return np.where((num_positive > 0) & (num_negative > 0), auc, np.nan)
+
+
+def compute_metrics(predictions, by=(), heads=None, threshold=0.5):
+    """
+    Computes the metrics of the heads, overall or per group of samples. All groups and heads are
+    computed at once, from the confusion counts of each group and the ranks of the scores
+    :param predictions: A Predictions object
+    :param by: The metadata columns the samples are grouped by, e.g. ('tte',) or ('tte', 'flipped')
+    :param heads: The names of the heads. Defaults to all heads of the predictions
+    :param threshold: The probability above which a sample is predicted as crossing
+    :return: A list of rows, one per group and head, with the values of the grouping columns,
+             'head', 'num_samples', 'num_positive' and the metrics (see METRICS)
+    """
+    heads = heads or [name for name in HEADS if name in predictions.probabilities]
+    codes, groups = _group_codes(predictions, tuple(by))
+    num_groups = len(groups)
+    labels = predictions.labels.astype(np.float64)
+    num_samples = np.bincount(codes, minlength=num_groups)
+    num_positive = np.bincount(codes, weights=labels, minlength=num_groups)
+
+    rows = []
+    for head in heads:
+        scores = predictions.probabilities[head]
+        predicted = (scores > threshold).astype(np.float64)
+        true_positive = np.bincount(codes, weights=predicted * labels, minlength=num_groups)
+        predicted_positive = np.bincount(codes, weights=predicted, minlength=num_groups)
+        true_negative = num_samples - num_positive - predicted_positive + true_positive
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.nan_to_num(true_positive / predicted_positive)
+            recall = np.nan_to_num(true_positive / num_positive)
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+        metrics = {'accuracy': (true_positive + true_negative) / num_samples,
+                   'auc': _auc(codes, labels, scores, num_groups),
+                   'f1': f1, 'precision': precision, 'recall': recall}
+        for g, group in enumerate(groups):
+            row = dict(zip(by, group))
+            row.update({'head': head, 'num_samples': int(num_samples[g]), 'num_positive': int(num_positive[g])})
+            row.update({name: float(metrics[name][g]) for name in METRICS})
+            rows.append(row)
+    return rows
+
+
+def compare_checkpoints(cache, checkpoints, splits, make_dataset, by=(), heads=None):
+    """
+    Evaluates checkpoints on data splits. Each checkpoint is run at most once per split, and
+    only if its predictions are not cached
+    :param cache: A PredictionCache
+    :param checkpoints: The paths of the checkpoints
+    :param splits: A dictionary {split name: ((x, y), time_to_event)}, e.g. the test data
+                   generated at several times to event with PREPROCESS.get_window_data()
+    :param make_dataset: A function (x, y) -> dataset of the batches of a split (see
+                         PredictionCache.predictions())
+    :param by: The metadata columns the samples are grouped by, e.g. ('tte',)
+    :param heads: The names of the heads. Defaults to all heads
+    :return: A list of rows (see compute_metrics()) with the 'checkpoint' of each row. The
+             samples of all splits are pooled
+    """
+    rows = []
+    for checkpoint in checkpoints:
+        predictions = Predictions.concatenate([cache.predictions(checkpoint, split, data, make_dataset, tte)
+                                               for split, (data, tte) in splits.items()])
+        for row in compute_metrics(predictions, by, heads):
+            rows.append(dict(checkpoint=checkpoint, **row))
+    return rows
+
+
+def print_metrics(rows):
+    """
+    Prints metric rows as a table
+    :param rows: The rows of compute_metrics() or compare_checkpoints()
+    """
+    columns = list(rows[0].keys())
+    cells = [[('{:.4f}'.format(v) if isinstance(v, float) else str(v)) for v in row.values()] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Computes the metrics of cached predictions')
+    parser.add_argument('predictions', nargs='+', help='.npz files of a PredictionCache')
+    parser.add_argument('--by', nargs='*', default=['tte'], help='Metadata columns the samples are grouped by')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print_metrics(compute_metrics(Predictions.concatenate([Predictions.load(p)[0] for p in args.predictions]),
+                                  args.by, threshold=args.threshold))
@@ -0,0 +1,238 @@
+
+import os
+import time
+import json
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from intentformer import CUSTOM_OBJECTS, generic_rnn_kernels
+
+QUANTIZATION_MODES = ['none', 'dynamic', 'float16', 'int8']
+INFERENCE_INPUTS = ['RGB', 'mask', 'box']
+HEADS = ['rgb_o', 'seg_o', 'traj_o']
+
+
+def inference_model(model, outputs=None):
+    """
+    Builds the inference graph of an IntentFormer model. The 'target' input, which only feeds
+    the CAC loss during training, is removed. The layers and weights are shared with model
+    :param model: The IntentFormer model (see intentformer.build_intentformer())
+    :param outputs: The names of the heads to keep. Defaults to all heads
+    :return: A keras Model with the inputs [RGB, mask, box]
+    """
+    outputs = outputs or [name for name in model.output_names if name in HEADS]
+    return keras.Model([model.get_layer(name).output for name in INFERENCE_INPUTS],
+                       [model.get_layer(name).output for name in outputs],
+                       name='intentformer_inference')
+
+
+def _input_order(concrete_function):
+    # The names of the inputs in the order of the converted input tensors. The converter keys the
+    # inputs of the signature by the names of their TensorSpecs, in sorted order, which does not
+    # follow the order of the arguments
+    return sorted(spec.name for spec in tf.nest.flatten(concrete_function.structured_input_signature))
+
+
+def _representative_dataset(dataset, num_batches, batch_size, input_order):
+    # Yields the model inputs of the batches of an IntentDataset/FeatureDataset, i.e. the
+    # ((RGB, mask, box, target), target) tuples without the target, in the exported batch size
+    def generator():
+        for (rgb, mask, box, _), _ in dataset.unbatch().batch(batch_size, drop_remainder=True).take(num_batches):
+            inputs = dict(zip(INFERENCE_INPUTS, (rgb, mask, box)))
+            yield [tf.cast(inputs[name], tf.float32) for name in input_order]
+    return generator
+
+
+def _converter(keras_model, batch_size):
+    # Traces the inference graph with a fixed batch size. The box GRU is traced unrolled over
+    # the fixed sequence length, which avoids a while loop in the graph. Returns the converter and
+    # the traced function
+    specs = [tf.TensorSpec((batch_size,) + tuple(x.shape[1:]), tf.float32, name=name)
+             for name, x in zip(INFERENCE_INPUTS, keras_model.inputs)]
+
+    @tf.function
+    def serve(RGB, mask, box):
+        predictions = keras_model([RGB, mask, box], training=False)
+        if not isinstance(predictions, list):
+            predictions = [predictions]
+        return dict(zip(keras_model.output_names, predictions))
+
+    with generic_rnn_kernels(keras_model, unroll=True):
+        concrete_function = serve.get_concrete_function(*specs)
+    return tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], keras_model), concrete_function
+
+
+def export_tflite(model, path, quantization='dynamic', batch_size=1, calibration_data=None,
+                  num_calibration_batches=50, outputs=None):
+    """
+    Exports an IntentFormer model for CPU inference as a TFLite flatbuffer. The graph is traced
+    in inference mode, which removes the dropout layers, the weights are frozen into constants
+    and the 'target' input is removed (see inference_model()). The graph has a fixed batch size
+    and the box GRU is unrolled, so the graph only consists of builtin TFLite operators
+    :param model: The IntentFormer model
+    :param path: The path of the .tflite file
+    :param quantization: 'none' for float32, 'dynamic' for int8 weights with float activations,
+                         'float16' for float16 weights, or 'int8' for int8 weights and activations.
+                         Inputs and outputs are float32 in every mode, and operators without int8
+                         kernels fall back to float
+    :param batch_size: The batch size of the exported graph
+    :param calibration_data: A dataset of ((RGB, mask, box, target), target) batches, e.g.
+                             IntentDataset(train=False).as_dataset(), used to calibrate the
+                             activation ranges. Required for 'int8'
+    :param num_calibration_batches: The number of batches used for calibration
+    :param outputs: The names of the heads to export. Defaults to all heads
+    :return: The size of the exported model in bytes
+    """
+    assert quantization in QUANTIZATION_MODES, 'Quantization {} is invalid'.format(quantization)
+    keras_model = inference_model(model, outputs)
+    converter, concrete_function = _converter(keras_model, batch_size)
+    if quantization != 'none':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration_data is None:
+            raise ValueError('int8 quantization requires calibration_data')
+        input_order = _input_order(concrete_function)
+        converter.representative_dataset = _representative_dataset(calibration_data, num_calibration_batches,
+                                                                   batch_size, input_order)
+    tflite_model = converter.convert()
+
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fid:
+        fid.write(tflite_model)
+    print('Exported {} ({} quantization, {:.1f}MB)'.format(path, quantization, len(tflite_model) / 2 ** 20))
+    return len(tflite_model)
+
+
+class TFLitePredictor(object):
+    """
+    Runs an IntentFormer model exported with export_tflite(). Inputs are split into batches of
+    the exported batch size, and the last batch is padded
+
+    Attributes:
+        output_names: The names of the exported heads
+        batch_size: The batch size of the exported graph
+
+    Methods:
+        predict: Returns the predictions of a batch
+    """
+    def __init__(self, path, num_threads=None):
+        """
+        :param path: The path of the .tflite file
+        :param num_threads: The number of threads used by the interpreter. Defaults to all cores
+        """
+        self._interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        # The signature maps the input and output names to the tensors
+        self._runner = self._interpreter.get_signature_runner()
+        self.output_names = sorted(self._runner.get_output_details())
+        self.batch_size = int(self._runner.get_input_details()['RGB']['shape'][0])
+
+    def predict(self, rgb, mask, box):
+        """
+        Returns the predictions of a batch
+        :param rgb: RGB inputs of shape (batch_size,) + the model input shape
+        :param mask: Mask inputs of the same shape
+        :param box: Boxes of shape (batch_size, seq_length, 4)
+        :return: A dictionary with the class probabilities of each head, of shape (batch_size, 2)
+        """
+        inputs = [np.asarray(x, dtype=np.float32) for x in (rgb, mask, box)]
+        num_samples = len(inputs[0])
+        outputs = {name: [] for name in self.output_names}
+        for start in range(0, num_samples, self.batch_size):
+            batch = [x[start:start + self.batch_size] for x in inputs]
+            num_padding = self.batch_size - len(batch[0])
+            batch = [np.concatenate([x, np.zeros((num_padding,) + x.shape[1:], dtype=x.dtype)])
+                     for x in batch]
+            predictions = self._runner(**dict(zip(INFERENCE_INPUTS, batch)))
+            for name in self.output_names:
+                outputs[name].append(predictions[name][:self.batch_size - num_padding])
+        return {name: np.concatenate(outputs[name]) for name in self.output_names}
+
+
+def parity_check(model, predictor, dataset, num_batches=None):
+    """
+    Compares the predictions of an exported model with the keras model
+    :param model: The IntentFormer model
+    :param predictor: A TFLitePredictor of the exported model
+    :param dataset: A dataset of ((RGB, mask, box, target), target) batches
+    :param num_batches: The number of batches compared. Defaults to the whole dataset
+    :return: A dictionary with, per head, the maximum absolute difference of the probabilities,
+             the agreement of the predicted classes and the accuracy of both models
+    """
+    keras_model = inference_model(model, predictor.output_names)
+    results = {name: {'max_abs_diff': 0.0, 'agreement': 0, 'keras_accuracy': 0, 'tflite_accuracy': 0}
+               for name in predictor.output_names}
+    num_samples = 0
+    batches = dataset.take(num_batches) if num_batches is not None else dataset
+    for (rgb, mask, box, _), label in batches:
+        label = np.asarray(label).reshape(-1)
+        keras_outputs = keras_model.predict_on_batch([rgb, mask, box])
+        if not isinstance(keras_outputs, list):
+            keras_outputs = [keras_outputs]
+        tflite_outputs = predictor.predict(rgb, mask, box)
+        for name, keras_output in zip(predictor.output_names, keras_outputs):
+            tflite_output = tflite_outputs[name]
+            head = results[name]
+            head['max_abs_diff'] = max(head['max_abs_diff'], float(np.abs(keras_output - tflite_output).max()))
+            head['agreement'] += int(np.sum(keras_output.argmax(-1) == tflite_output.argmax(-1)))
+            head['keras_accuracy'] += int(np.sum(keras_output.argmax(-1) == label))
+            head['tflite_accuracy'] += int(np.sum(tflite_output.argmax(-1) == label))
+        num_samples += len(label)
+    for name in predictor.output_names:
+        for k in ['agreement', 'keras_accuracy', 'tflite_accuracy']:
+            results[name][k] /= max(num_samples, 1)
+    results['num_samples'] = num_samples
+    return results
+
+
+def _latency(run, repeats):
+    run()
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start_time)
+    times = np.array(times) * 1e3
+    return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90))}
+
+
+def benchmark_latency(model, predictor, batch_size=1, repeats=20, seed=42):
+    """
+    Measures the prediction latency of the keras model and an exported model on random inputs
+    :param model: The IntentFormer model
+    :param predictor: A TFLitePredictor of the exported model
+    :param batch_size: The number of samples per prediction
+    :param repeats: The number of timed predictions
+    :param seed: The random seed
+    :return: A dictionary with the latency statistics of both models
+    """
+    keras_model = inference_model(model)
+    rng = np.random.default_rng(seed)
+    inputs = [rng.random((batch_size,) + tuple(x.shape[1:]), dtype=np.float32) for x in keras_model.inputs]
+    results = {'batch_size': batch_size,
+               'keras': _latency(lambda: keras_model.predict_on_batch(inputs), repeats),
+               'tflite': _latency(lambda: predictor.predict(*inputs), repeats)}
+    results['speedup'] = results['keras']['mean_ms'] / results['tflite']['mean_ms']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports an IntentFormer checkpoint to TFLite')
+    parser.add_argument('checkpoint', help='Path of the keras checkpoint, e.g. cp_8.tf')
+    parser.add_argument('output', help='Path of the .tflite file')
+    parser.add_argument('--quantization', default='dynamic', choices=[q for q in QUANTIZATION_MODES if q != 'int8'],
+                        help='int8 quantization needs calibration data and is available through export_tflite()')
+    parser.add_argument('--benchmark', action='store_true', help='Compare the latency with the keras model')
+    parser.add_argument('--batch_size', type=int, default=1, help='Batch size of the exported graph')
+    args = parser.parse_args()
+
+    model = keras.models.load_model(args.checkpoint, custom_objects=CUSTOM_OBJECTS, compile=False)
+    export_tflite(model, args.output, args.quantization, args.batch_size)
+    if args.benchmark:
+        print(json.dumps(benchmark_latency(model, TFLitePredictor(args.output), args.batch_size), indent=2))
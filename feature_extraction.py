@@ -0,0 +1,119 @@
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import instrumentation
+
+# One backbone instance per process, keyed by (name, input_shape)
+_BACKBONES = {}
+
+_BACKBONE_FACTORIES = {
+    'efficientnetb4': (tf.keras.applications.efficientnet.EfficientNetB4,
+                       tf.keras.applications.efficientnet.preprocess_input),
+}
+
+
+def get_backbone(name='efficientnetb4', input_shape=(224, 224, 3)):
+    """
+    Returns the backbone network used for feature extraction. The network is built once
+    per process and reused by every subsequent call
+    :param name: The name of the backbone. Options are: 'efficientnetb4'
+    :param input_shape: The input shape of the network
+    :return: The backbone model and its input preprocessing function
+    """
+    if name not in _BACKBONE_FACTORIES:
+        raise ValueError('ERROR: Undefined value for backbone {}!'.format(name))
+    key = (name, tuple(input_shape))
+    if key not in _BACKBONES:
+        factory, preprocess = _BACKBONE_FACTORIES[name]
+        convnet = factory(input_shape=tuple(input_shape), include_top=False, weights='imagenet')
+        _BACKBONES[key] = (convnet, preprocess)
+    return _BACKBONES[key]
+
+
+class FeatureExtractor(object):
+    """
+    Batched feature extraction engine. Images are queued and flushed through the backbone
+    in fixed-size batches, with one forward pass per batch.
+
+    Attributes:
+        batch_size: The number of images in each forward pass
+        num_frames: The number of images processed so far
+        elapsed: The total time (in seconds) spent in forward passes
+
+    Methods:
+        add: Queues an image for feature extraction
+        flush: Runs the queued images through the backbone
+        fps: Returns the extraction throughput in frames per second
+    """
+    def __init__(self, backbone='efficientnetb4',
+                 input_shape=(224, 224, 3),
+                 batch_size=32):
+        self._convnet, self._preprocess = get_backbone(backbone, input_shape)
+        self._input_shape = tuple(input_shape)
+        self.batch_size = batch_size
+        self.num_frames = 0
+        self.elapsed = 0.0
+        self._images = []
+        self._callbacks = []
+
+    def add(self, image_array, callback):
+        """
+        Queues an image for feature extraction. The batch is flushed once it is full
+        :param image_array: The image as an array of shape input_shape
+        :param callback: A function that receives the features of the image once computed
+        """
+        self._images.append(image_array)
+        self._callbacks.append(callback)
+        if len(self._images) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Runs the queued images through the backbone and passes the features to their callbacks.
+        Partial batches are padded to batch_size so the network always sees the same input shape
+        """
+        if not self._images:
+            return
+        num_images = len(self._images)
+        batch = np.zeros((self.batch_size,) + self._input_shape, dtype=np.float32)
+        batch[:num_images] = np.stack(self._images)
+        start_time = time.time()
+        with instrumentation.span('backbone.predict'):
+            features = self._convnet.predict_on_batch(self._preprocess(batch))
+        self.elapsed += time.time() - start_time
+        self.num_frames += num_images
+        instrumentation.count('backbone.frames', num_images)
+
+        callbacks = self._callbacks
+        self._images = []
+        self._callbacks = []
+        for feat, callback in zip(features[:num_images], callbacks):
+            callback(feat[np.newaxis])
+
+    def fps(self):
+        """
+        Returns the extraction throughput
+        :return: Number of frames processed per second of forward pass time
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return self.num_frames / self.elapsed
+
+
+def pool_features(img_features, global_pooling='avg'):
+    """
+    Applies global pooling to the spatial feature map of a single image
+    :param img_features: Features of shape (1, rows, cols, channels)
+    :param global_pooling: The pooling method. Options are: 'avg', 'max', 'none' (will return
+                           flattened output)
+    :return: Pooled features
+    """
+    img_features = np.squeeze(img_features)
+    if global_pooling == 'max':
+        return np.amax(img_features, axis=(0, 1))
+    if global_pooling == 'avg':
+        return np.average(img_features, axis=(0, 1))
+    return img_features.ravel()
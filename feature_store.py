@@ -0,0 +1,318 @@
+
+import os
+import json
+import pickle
+import hashlib
+import argparse
+
+import numpy as np
+
+from feature_extraction import pool_features
+import instrumentation
+
+
+def feature_config(backbone='efficientnetb4', crop_type='bbox', crop_mode='pad_resize',
+                   crop_resize_ratio=2, global_pooling='avg', size=224):
+    """
+    Collects the parameters that affect the visual features of a frame
+    :param backbone: The name of the backbone network
+    :param crop_type: The method to crop the bounding boxes from the images
+    :param crop_mode: How the cropped image resized and padded
+    :param crop_resize_ratio: The ratio by which the image is enlarged to capture the context.
+                              Only affects crop types 'context' and 'surround'
+    :param global_pooling: The pooling method applied to the feature maps
+    :param size: The input size of the backbone
+    :return: A dictionary with the configuration
+    """
+    return {'backbone': backbone,
+            'crop_type': crop_type,
+            'crop_mode': crop_mode,
+            'crop_resize_ratio': crop_resize_ratio if crop_type in ['context', 'surround'] else None,
+            'global_pooling': global_pooling,
+            'size': size}
+
+
+def config_id(config):
+    """
+    Computes the id of a feature configuration
+    :param config: A dictionary of all parameters that affect the features
+    :return: A hash of the configuration as a hex string
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def source_fingerprint(path, bbox=None, folder_stats=None):
+    """
+    Computes the fingerprint of the input of a frame's features, i.e. the source image and the
+    cropped area. The image is identified by the last folders of its path, which tell RGB
+    images from segmentation maps, and by the modification time of its folder, which changes
+    when images of the video are added, removed or replaced. The images of a video thus share
+    one stat call, and looking up stored frames does not stat every image. Images overwritten
+    in place keep their fingerprint
+    :param path: The path to the image. '_flip' refers to the flipped version of the image
+    :param bbox: The bounding box coordinates, if the image is cropped
+    :param folder_stats: A dictionary that caches the modification times of the folders between
+                         calls, e.g. for the frames of one preprocessing run
+    :return: The fingerprint as a hex string
+    """
+    folder = os.path.dirname(path)
+    folder_stats = {} if folder_stats is None else folder_stats
+    if folder not in folder_stats:
+        try:
+            folder_stats[folder] = os.stat(folder).st_mtime_ns
+        except OSError:
+            folder_stats[folder] = None
+    box = list(map(int, bbox[0:4])) if bbox is not None else None
+    source = ['/'.join(path.split('/')[-4:]), box, folder_stats[folder]]
+    return hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest()[:16]
+
+
+class FeatureStore(object):
+    """
+    A consolidated store for per-frame visual features. Features of each set/video are kept in
+    one contiguous array (<root>/<set>/<video>.npy) together with an index that maps frame names
+    to rows (<root>/<set>/<video>.json). Arrays are read through memory mapping, so gathering
+    the features of a sequence is a fancy-indexing operation and several processes reading
+    the same store share one page cache.
+
+    Stores created with for_config() live in a folder named after the hash of the feature
+    configuration, with the configuration in its manifest.json, so features computed with
+    different settings are never mixed. Each frame can be stored with the fingerprint of its
+    input (see source_fingerprint()), and lookups with a different fingerprint treat the
+    frame as stale.
+
+    Attributes:
+        root: The root folder of the store
+        dtype: The data type of the stored features
+        max_pending: The number of queued frames after which the queue is written to disk
+
+    Methods:
+        for_config: Opens the store of a feature configuration
+        lookup: Returns the row of a frame, or None if the frame is not in the store or stale
+        put: Queues the features of a frame for writing
+        flush: Writes the queued features to disk
+        features: Returns the memory mapped feature array of a video
+        gather: Returns the features of a list of frames
+    """
+    def __init__(self, root, dtype=np.float32, max_pending=20000):
+        self.root = root
+        self.dtype = dtype
+        self._max_pending = max_pending
+        self._num_pending = 0
+        self._index = {}
+        self._fingerprints = {}
+        self._arrays = {}
+        self._pending = {}
+
+    @classmethod
+    def for_config(cls, root, config, **kwargs):
+        """
+        Opens the store of a feature configuration, located at <root>/<config id>. The
+        configuration is recorded in <root>/<config id>/manifest.json
+        :param root: The root folder of the stores
+        :param config: A dictionary of all parameters that affect the features
+        :return: A FeatureStore
+        """
+        store = cls(os.path.join(root, config_id(config)), **kwargs)
+        manifest_path = os.path.join(store.root, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            if not os.path.exists(store.root):
+                os.makedirs(store.root)
+            with open(manifest_path, 'w') as fid:
+                json.dump({'config_id': config_id(config), 'config': config}, fid, indent=2, sort_keys=True)
+        return store
+
+    def _paths(self, set_id, vid_id):
+        base_path = os.path.join(self.root, set_id, vid_id)
+        return base_path + '.npy', base_path + '.json'
+
+    def _video_index(self, set_id, vid_id):
+        video = (set_id, vid_id)
+        if video not in self._index:
+            _, index_path = self._paths(set_id, vid_id)
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as fid:
+                    video_index = json.load(fid)
+                keys = video_index['keys']
+                fingerprints = video_index.get('fingerprints', [None] * len(keys))
+            else:
+                keys, fingerprints = [], []
+            self._index[video] = {k: i for i, k in enumerate(keys)}
+            self._fingerprints[video] = dict(zip(keys, fingerprints))
+        return self._index[video]
+
+    def lookup(self, set_id, vid_id, key, fingerprint=None):
+        """
+        Finds the row of a frame in the store
+        :param set_id: The set id, e.g. set01
+        :param vid_id: The video id, e.g. video_0001
+        :param key: The name of the frame, e.g. 00015 or 00015_1_2_3 for pedestrian crops
+        :param fingerprint: The fingerprint of the frame's input. If given, frames stored with a
+                            different fingerprint are treated as stale. Frames stored without a
+                            fingerprint, e.g. converted pickles, are always valid
+        :return: The row index or None if the frame is not stored or stale
+        """
+        row = self._video_index(set_id, vid_id).get(key)
+        if row is not None and fingerprint is not None:
+            stored_fingerprint = self._fingerprints[(set_id, vid_id)][key]
+            if stored_fingerprint is not None and stored_fingerprint != fingerprint:
+                return None
+        return row
+
+    def put(self, set_id, vid_id, key, features, fingerprint=None):
+        """
+        Queues the features of a frame. Features of a frame that is already stored are replaced.
+        Queued features are not visible to readers until flush() is called. The queue is flushed
+        automatically once it holds max_pending frames
+        :param set_id: The set id
+        :param vid_id: The video id
+        :param key: The name of the frame
+        :param features: The feature vector
+        :param fingerprint: The fingerprint of the frame's input (see source_fingerprint())
+        """
+        self._pending.setdefault((set_id, vid_id), {})[key] = (np.asarray(features, dtype=self.dtype),
+                                                                fingerprint)
+        self._num_pending += 1
+        if self._num_pending >= self._max_pending:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued features to disk. Each modified video array is rewritten once and
+        replaced atomically
+        """
+        with instrumentation.span('feature_store.write'):
+            self._flush()
+
+    def _flush(self):
+        for (set_id, vid_id), new_features in self._pending.items():
+            index = self._video_index(set_id, vid_id)
+            array_path, index_path = self._paths(set_id, vid_id)
+            keys = sorted(index, key=index.get)
+            new_keys = [k for k in new_features if k not in index]
+            feat_dim = next(iter(new_features.values()))[0].shape
+            data = np.empty((len(keys) + len(new_keys),) + feat_dim, dtype=self.dtype)
+            if keys:
+                data[:len(keys)] = self.features(set_id, vid_id)[:len(keys)]
+            keys.extend(new_keys)
+            index = {k: i for i, k in enumerate(keys)}
+            fingerprints = self._fingerprints[(set_id, vid_id)]
+            for k, (feat, fingerprint) in new_features.items():
+                data[index[k]] = feat
+                fingerprints[k] = fingerprint
+
+            # Drop the memory map before replacing the file it points to
+            self._arrays.pop((set_id, vid_id), None)
+            if not os.path.exists(os.path.dirname(array_path)):
+                os.makedirs(os.path.dirname(array_path))
+            tmp_path = array_path + '.tmp'
+            with open(tmp_path, 'wb') as fid:
+                np.save(fid, data)
+            os.replace(tmp_path, array_path)
+            tmp_path = index_path + '.tmp'
+            with open(tmp_path, 'w') as fid:
+                json.dump({'keys': keys, 'fingerprints': [fingerprints[k] for k in keys]}, fid)
+            os.replace(tmp_path, index_path)
+            self._index[(set_id, vid_id)] = index
+        self._pending = {}
+        self._num_pending = 0
+
+    def features(self, set_id, vid_id):
+        """
+        Returns the feature array of a video
+        :param set_id: The set id
+        :param vid_id: The video id
+        :return: A read-only memory mapped array of shape (num_frames, feature_dim)
+        """
+        video = (set_id, vid_id)
+        if video not in self._arrays:
+            array_path, _ = self._paths(set_id, vid_id)
+            self._arrays[video] = np.load(array_path, mmap_mode='r')
+        return self._arrays[video]
+
+    def gather(self, frames):
+        """
+        Collects the features of a list of frames. Frames are grouped by video and read with
+        one fancy-indexing operation per video
+        :param frames: A list of (set_id, vid_id, key) tuples
+        :return: An array of shape (len(frames), feature_dim)
+        """
+        with instrumentation.span('feature_store.read'):
+            return self._gather(frames)
+
+    def _gather(self, frames):
+        groups = {}
+        for pos, (set_id, vid_id, key) in enumerate(frames):
+            positions, rows = groups.setdefault((set_id, vid_id), ([], []))
+            row = self.lookup(set_id, vid_id, key)
+            if row is None:
+                raise KeyError('Features for {}/{}/{} are not in the store {}'.format(
+                    set_id, vid_id, key, self.root))
+            positions.append(pos)
+            rows.append(row)
+
+        output = None
+        for (set_id, vid_id), (positions, rows) in groups.items():
+            video_features = self.features(set_id, vid_id)
+            if output is None:
+                output = np.empty((len(frames),) + video_features.shape[1:], dtype=self.dtype)
+            output[positions] = video_features[rows]
+        if output is None:
+            output = np.empty((0,), dtype=self.dtype)
+        return output
+
+
+def convert_pickle_tree(pickle_root, store_root=None, global_pooling='avg', config=None):
+    """
+    Converts a tree of per-frame feature pickles (<root>/<set>/<video>/<frame>.pkl) to a
+    FeatureStore. Spatial feature maps are pooled before they are stored. Converted frames
+    have no fingerprint and are never treated as stale
+    :param pickle_root: The root folder of the pickle files
+    :param store_root: The root folder of the store. Defaults to pickle_root
+    :param global_pooling: The pooling method applied to the feature maps. Options are: 'avg',
+                           'max', 'none'
+    :param config: The feature configuration the pickles were generated with (see feature_config()).
+                   If given, the store is created with FeatureStore.for_config()
+    :return: The feature store
+    """
+    if config is not None:
+        store = FeatureStore.for_config(store_root or pickle_root, config)
+    else:
+        store = FeatureStore(store_root or pickle_root)
+    for set_id in sorted(os.listdir(pickle_root)):
+        set_path = os.path.join(pickle_root, set_id)
+        if not os.path.isdir(set_path):
+            continue
+        for vid_id in sorted(os.listdir(set_path)):
+            vid_path = os.path.join(set_path, vid_id)
+            if not os.path.isdir(vid_path):
+                continue
+            print('Converting {}/{}'.format(set_id, vid_id))
+            for file_name in sorted(os.listdir(vid_path)):
+                if not file_name.endswith('.pkl'):
+                    continue
+                with open(os.path.join(vid_path, file_name), 'rb') as fid, \
+                        instrumentation.span('pickle.read'):
+                    try:
+                        img_features = pickle.load(fid)
+                    except:
+                        img_features = pickle.load(fid, encoding='bytes')
+                store.put(set_id, vid_id, file_name[:-len('.pkl')],
+                          pool_features(img_features, global_pooling))
+            # Flush per video to bound the memory used by the conversion
+            store.flush()
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts per-frame feature pickles to a feature store')
+    parser.add_argument('pickle_root', help='Root folder of the pickle files, e.g. data/features/pie/local_box')
+    parser.add_argument('--store_root', default=None, help='Root folder of the store (default: pickle_root)')
+    parser.add_argument('--global_pooling', default='avg', choices=['avg', 'max', 'none'])
+    parser.add_argument('--crop_type', default='bbox', help='crop_type the pickles were generated with')
+    parser.add_argument('--crop_mode', default='pad_resize', help='crop_mode the pickles were generated with')
+    parser.add_argument('--backbone', default='efficientnetb4', help='Backbone the pickles were generated with')
+    args = parser.parse_args()
+    convert_pickle_tree(args.pickle_root, args.store_root, args.global_pooling,
+                        feature_config(args.backbone, args.crop_type, args.crop_mode,
+                                       global_pooling=args.global_pooling))
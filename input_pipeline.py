@@ -0,0 +1,435 @@
+
+import os
+import json
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from keras_preprocessing.image import load_img
+
+from utils import *
+from track_table import FrameSequences, unique_frames
+import instrumentation
+
+
+def load_rgb_crop(path, bbox, size=224, flip=False):
+    """
+    Reads an image and crops the squarified bounding box area. Names ending with '_flip'
+    refer to the flipped version of the image
+    :param path: The path to the image
+    :param bbox: The bounding box coordinates
+    :param size: The size of the output image
+    :param flip: Whether to flip the image horizontally. The bounding box is given in the
+                 coordinates of the original image and flipped along with it
+    :return: The padded crop as a uint8 array of shape (size, size, 3)
+    """
+    flip_image = False
+    if 'flip' in path:
+        path = path.replace('_flip', '')
+        flip_image = True
+    with instrumentation.span('image.decode'):
+        img = load_img(path)
+        img.load()
+    box = [float(c) for c in bbox[0:4]]
+    if flip:
+        # Mirrored before rounding, as the boxes of the '_flip' images are
+        box = [img.size[0] - box[2], box[1], img.size[0] - box[0], box[3]]
+    box = list(map(int, box))
+    if flip_image or flip:
+        img = img.transpose(Image.FLIP_LEFT_RIGHT)
+    with instrumentation.span('image.crop_pad'):
+        box = squarify(box, 1, img.size[0])
+        img_data = img_pad(img.crop(box), mode='pad_resize', size=size)
+        return np.asarray(img_data, dtype=np.uint8)
+
+
+def load_mask(path, size=224, flip=False):
+    """
+    Reads the segmentation map of an image and resizes it to the model input size
+    :param path: The path to the RGB image. The segmentation map is read from 'seg_images'
+    :param size: The size of the output image
+    :param flip: Whether to flip the segmentation map horizontally
+    :return: The segmentation map as a uint8 array of shape (size, size, 3)
+    """
+    path = path.replace('images', 'seg_images')
+    flip_image = flip
+    if 'flip' in path:
+        path = path.replace('_flip', '')
+        flip_image = True
+    with instrumentation.span('mask.decode'):
+        img = load_img(path)
+        img.load()
+    with instrumentation.span('mask.resize'):
+        if flip_image:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        img_data = img_pad(img, mode='warp', size=size)
+        return np.asarray(img_data, dtype=np.uint8)
+
+
+def box_features(bbox):
+    """
+    Converts bounding boxes to center, width and height
+    :param bbox: Bounding boxes of shape (..., 4) as [x1, y1, x2, y2]
+    :return: Boxes of shape (..., 4) as [x_center, y_center, width, height]
+    """
+    bbox = np.asarray(bbox, dtype=np.float32)
+    return np.stack([(bbox[..., 0] + bbox[..., 2]) / 2,
+                     (bbox[..., 1] + bbox[..., 3]) / 2,
+                     np.abs(bbox[..., 0] - bbox[..., 2]),
+                     np.abs(bbox[..., 1] - bbox[..., 3])], axis=-1)
+
+
+class CropCache(object):
+    """
+    A persistent on-disk cache of processed uint8 images. Images are kept in a memory mapped
+    array with one row per key, and a flag per row marks the rows that are filled. The cache
+    is reset if it was created for a different list of keys, image shape or data type. Hits and
+    misses are counted as '<name>.hits' and '<name>.misses' (see instrumentation.py).
+
+    Methods:
+        get: Returns the image of a row, computing and storing it if the row is not filled
+    """
+    def __init__(self, path, keys, shape=(224, 224, 3), name='crop_cache'):
+        self._name = name
+        if not os.path.exists(path):
+            os.makedirs(path)
+        keys_path = os.path.join(path, 'keys.json')
+        data_shape = (len(keys),) + tuple(shape)
+        index = {'keys': list(keys), 'shape': list(data_shape), 'dtype': np.dtype(np.uint8).str}
+        valid = False
+        if os.path.exists(keys_path):
+            with open(keys_path, 'r') as fid:
+                valid = json.load(fid) == index
+        if valid:
+            self._data = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='r+')
+            self._filled = np.lib.format.open_memmap(os.path.join(path, 'filled.npy'), mode='r+')
+            # The arrays must also match, in case they were written by another version
+            valid = (self._data.shape == data_shape and self._data.dtype == np.uint8 and
+                     self._filled.shape == data_shape[:1])
+        if not valid:
+            self._data = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+',
+                                                   dtype=np.uint8, shape=data_shape)
+            self._filled = np.lib.format.open_memmap(os.path.join(path, 'filled.npy'), mode='w+',
+                                                     dtype=bool, shape=data_shape[:1])
+            with open(keys_path, 'w') as fid:
+                json.dump(index, fid)
+
+    def get(self, row, loader):
+        """
+        Returns the image of a row
+        :param row: The row index
+        :param loader: A function that computes the image if the row is not filled
+        :return: The image as a uint8 array
+        """
+        if self._filled[row]:
+            instrumentation.count(self._name + '.hits')
+            return np.array(self._data[row])
+        instrumentation.count(self._name + '.misses')
+        img_data = loader()
+        self._data[row] = img_data
+        self._filled[row] = True
+        return img_data
+
+
+def _frame_table(features):
+    # The features of the unique frames and the index of each sample's frames into them. Dense
+    # features of shape (num_samples, seq_length, ...) are a table with one row per frame
+    if isinstance(features, FrameSequences):
+        return np.asarray(features.table, dtype=np.float32), np.asarray(features.index)
+    features = np.asarray(features, dtype=np.float32)
+    index = np.arange(features.shape[0] * features.shape[1]).reshape(features.shape[:2])
+    return features.reshape((-1,) + features.shape[2:]), index
+
+
+def _shard(dataset, shard_size, num_shards, shard_index):
+    # Keeps every num_shards-th element of an epoch, starting at shard_index. The epoch is
+    # truncated to num_shards * shard_size elements, so all shards have shard_size elements
+    if num_shards == 1:
+        return dataset
+    return dataset.take(num_shards * shard_size).shard(num_shards, shard_index)
+
+
+class IntentDataset(object):
+    """
+    tf.data input pipeline for the IntentFormer model. Produces batches of
+    ([RGB, mask, box, target], target), where RGB are the squarified and padded pedestrian crops,
+    mask the resized segmentation maps and box the [x_center, y_center, width, height] of the
+    bounding boxes.
+
+    Every unique frame is read once per epoch, or once in total if cache_dir is set. Samples are
+    decoded, cropped and padded in parallel by interleaving their frames.
+
+    With a seg_store (see seg_store.py), the segmentation maps are read from the store as
+    single-channel labels instead of being decoded from the segmentation images. Batches carry
+    the labels up to the last stage of the pipeline, where they are expanded to RGB by a palette
+    lookup, so the masks take a third of the memory of the pipeline's buffers. Masks of samples
+    flipped by the sampler are flipped after resizing, as in augmentation.
+
+    With a sampler (see sampler.py), the samples of each epoch are drawn by the sampler, and
+    samples drawn with a flip bit are flipped horizontally when they are loaded. Inputs are
+    indexed by sample variant: variants 0 to num_samples - 1 are the samples as given, the
+    following variants the flipped versions of the sampler's flippable samples.
+
+    With num_shards > 1, every shard draws the same epoch from the seed and keeps every
+    num_shards-th sample, so the shards of an epoch are disjoint and have the same number of
+    batches.
+
+    Training data is batched into full batches only. Test data of a single shard keeps the last,
+    partial batch, so every sample is predicted once, in the order of the samples.
+
+    Methods:
+        as_dataset: Returns the tf.data.Dataset
+    """
+    def __init__(self, images, boxes, labels,
+                 batch_size,
+                 train=True,
+                 cache_dir=None,
+                 augment=None,
+                 seed=42,
+                 input_size=(224, 224, 3),
+                 num_parallel_calls=8,
+                 sampler=None,
+                 img_width=1920,
+                 num_shards=1,
+                 shard_index=0,
+                 seg_store=None):
+        """
+        :param images: Sequences of image paths of shape (num_samples, seq_length)
+        :param boxes: Sequences of bounding boxes of shape (num_samples, seq_length, 4)
+        :param labels: Labels of shape (num_samples, 1)
+        :param batch_size: The number of samples in each batch
+        :param train: Whether data is for training. Training data is shuffled every epoch and
+                      augmented. Test data is scaled to [0, 1]
+        :param cache_dir: The folder of the crop cache. If None, frames are read from the raw images
+                          in every epoch
+        :param augment: A function that augments a batch of RGB and mask videos given a seed per
+                        sample, e.g. an augmentation.VideoAugmenter. Only used for training data
+        :param seed: The random seed used for shuffling and for the per-sample augmentation seeds
+        :param input_size: The size of the frames
+        :param num_parallel_calls: The number of samples that are loaded in parallel
+        :param sampler: A sampler that draws the samples of each epoch, e.g. a
+                        sampler.BalancedSampler. If None, every sample is used once per epoch
+        :param img_width: The width of the images, used to flip the bounding boxes
+        :param num_shards: The number of shards the samples of each epoch are split into, e.g. one
+                           per worker in data parallel training (see distributed.py)
+        :param shard_index: The index of the shard of this dataset
+        :param seg_store: A seg_store.SegmentationStore with the segmentation maps of the images,
+                          of the size of the frames. If None, the segmentation images are read
+        """
+        images = np.asarray(images)
+        boxes = np.asarray(boxes)[..., :4]
+        num_samples = len(images)
+
+        flippable = sampler.flippable() if sampler is not None else np.empty(0, dtype=np.int64)
+        variant_samples = np.concatenate([np.arange(num_samples), flippable])
+        variant_flips = np.arange(len(variant_samples)) >= num_samples
+        self._flip_variants = np.full(num_samples, -1, dtype=np.int64)
+        self._flip_variants[flippable] = num_samples + np.arange(len(flippable))
+        self._sampler = sampler
+
+        self._images = images[variant_samples]
+        self._boxes = box_features(boxes[variant_samples])
+        self._boxes[variant_flips, :, 0] = img_width - self._boxes[variant_flips, :, 0]
+        self._labels = np.asarray(labels)[variant_samples]
+        self._batch_size = batch_size
+        self._train = train
+        # Shards must have the same number of batches
+        self._drop_remainder = train or num_shards > 1
+        self._augment = augment
+        self._seed = seed
+        self._input_size = tuple(input_size)
+        self._num_parallel_calls = num_parallel_calls
+        self._num_shards = num_shards
+        self._shard_index = shard_index
+
+        # RGB crops depend on the image, the bounding box and the flip, masks only on the
+        # image and the flip. Boxes are rounded after flipping, so they are kept as given
+        crop_boxes = boxes[variant_samples].astype(np.float64)
+        frame_flips = np.repeat(variant_flips[:, np.newaxis], self._images.shape[1], axis=1)
+        rgb_first, self._rgb_rows = unique_frames(self._images, crop_boxes, frame_flips)
+        mask_first, self._mask_rows = unique_frames(self._images, frame_flips)
+        self._rgb_frames = (self._images.ravel()[rgb_first],
+                            crop_boxes.reshape(-1, 4)[rgb_first],
+                            frame_flips.ravel()[rgb_first])
+        self._mask_frames = (self._images.ravel()[mask_first], frame_flips.ravel()[mask_first])
+
+        self._seg_store = seg_store
+        self._mask_shape = self._input_size
+        if seg_store is not None:
+            assert seg_store.size == self._input_size[0], \
+                'The segmentation store has maps of size {}'.format(seg_store.size)
+            self._seg_rows = seg_store.rows(self._mask_frames[0])
+            self._mask_shape = self._input_size[:2] + (1,)
+
+        self._rgb_cache = None
+        self._mask_cache = None
+        if cache_dir is not None:
+            flip_suffix = lambda f: '|flip' if f else ''
+            rgb_keys = ['{}|{}{}'.format(p, ','.join(map(str, b)), flip_suffix(f))
+                        for p, b, f in zip(*self._rgb_frames)]
+            mask_keys = [p + flip_suffix(f) for p, f in zip(*self._mask_frames)]
+            self._rgb_cache = CropCache(os.path.join(cache_dir, 'rgb'), rgb_keys, self._input_size,
+                                        name='crop_cache.rgb')
+            # The segmentation store needs no cache
+            if seg_store is None:
+                self._mask_cache = CropCache(os.path.join(cache_dir, 'mask'), mask_keys, self._input_size,
+                                             name='crop_cache.mask')
+
+    def __len__(self):
+        num_samples = len(self._sampler) if self._sampler is not None else len(self._flip_variants)
+        if not self._drop_remainder:
+            return -(-num_samples // self._batch_size)
+        return num_samples // (self._batch_size * self._num_shards)
+
+    def _load_rgb(self, row):
+        path, bbox, flip = self._rgb_frames[0][row], self._rgb_frames[1][row], self._rgb_frames[2][row]
+        loader = lambda: load_rgb_crop(path, bbox, self._input_size[0], flip)
+        if self._rgb_cache is None:
+            return loader()
+        return self._rgb_cache.get(row, loader)
+
+    def _load_mask(self, row):
+        path, flip = self._mask_frames[0][row], self._mask_frames[1][row]
+        if self._seg_store is not None:
+            labels = self._seg_store.labels(self._seg_rows[row])
+            return np.ascontiguousarray(labels[:, ::-1] if flip else labels)[..., np.newaxis]
+        loader = lambda: load_mask(path, self._input_size[0], flip)
+        if self._mask_cache is None:
+            return loader()
+        return self._mask_cache.get(row, loader)
+
+    def _load_frame(self, rgb_row, mask_row):
+        rgb, mask = tf.numpy_function(lambda r, m: (self._load_rgb(r), self._load_mask(m)),
+                                      [rgb_row, mask_row], [tf.uint8, tf.uint8])
+        rgb.set_shape(self._input_size)
+        mask.set_shape(self._mask_shape)
+        return rgb, mask
+
+    def _sample_frames(self, index):
+        seq_length = self._rgb_rows.shape[1]
+        frames = tf.data.Dataset.from_tensor_slices((tf.gather(self._rgb_rows, index),
+                                                     tf.gather(self._mask_rows, index)))
+        frames = frames.map(self._load_frame).batch(seq_length, drop_remainder=True)
+        return frames.map(lambda rgb, mask: (index, rgb, mask))
+
+    def _sample_seeds(self, index, sample_seed):
+        # Interleave the per-sample seed with the sample's frames
+        return self._sample_frames(index).map(lambda i, rgb, mask: (i, sample_seed, rgb, mask))
+
+    def _augment_batch(self, rgb, mask, sample_seed):
+        with instrumentation.span('input_pipeline.augment'):
+            return self._augment(rgb, mask, sample_seed)
+
+    def _finalize(self, index, sample_seed, rgb, mask):
+        # Works on whole batches. Augmentation runs once per batch on the uint8 videos
+        if self._train and self._augment is not None:
+            rgb, mask = tf.numpy_function(self._augment_batch, [rgb, mask, sample_seed], [tf.uint8, tf.uint8])
+            rgb.set_shape(sample_seed.shape + (None,) + self._input_size)
+            mask.set_shape(sample_seed.shape + (None,) + self._mask_shape)
+        if self._seg_store is not None:
+            mask = tf.gather(self._seg_store.palette, tf.cast(mask[..., 0], tf.int32))
+        rgb = tf.cast(rgb, tf.float32)
+        if not self._train:
+            rgb = rgb / 255
+        mask = tf.cast(mask, tf.float32) / 255
+        box = tf.gather(self._boxes, index)
+        label = tf.gather(self._labels, index)
+        return (rgb, mask, box, label), label
+
+    def _sample_epoch(self):
+        # Draws the sample variants of an epoch from the sampler
+        indices, flips = self._sampler.sample_epoch()
+        return np.where(flips, self._flip_variants[indices], indices).astype(np.int64)
+
+    def as_dataset(self):
+        """
+        Builds the input pipeline
+        :return: A tf.data.Dataset of (inputs, target) batches
+        """
+        if self._sampler is not None:
+            # The sampler is called again whenever a new epoch starts
+            sample_epoch = lambda _: tf.data.Dataset.from_tensor_slices(
+                tf.ensure_shape(tf.numpy_function(self._sample_epoch, [], tf.int64), [None]))
+            dataset = tf.data.Dataset.from_tensors(0).flat_map(sample_epoch)
+        else:
+            num_samples = len(self._flip_variants)
+            dataset = tf.data.Dataset.range(num_samples)
+            if self._train:
+                dataset = dataset.shuffle(num_samples, seed=self._seed,
+                                          reshuffle_each_iteration=True)
+        # Every sample gets its own augmentation seed, so augmentation does not depend on
+        # how samples are batched
+        dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.random(seed=self._seed)))
+        dataset = _shard(dataset, len(self) * self._batch_size, self._num_shards, self._shard_index)
+        dataset = dataset.interleave(self._sample_seeds,
+                                     cycle_length=self._num_parallel_calls,
+                                     num_parallel_calls=tf.data.AUTOTUNE,
+                                     deterministic=True)
+        dataset = dataset.batch(self._batch_size, drop_remainder=self._drop_remainder)
+        dataset = dataset.map(self._finalize, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+class FeatureDataset(object):
+    """
+    tf.data input pipeline for IntentFormer in the 'features' input mode. Produces batches of
+    ([RGB, mask, box, target], target), where RGB and mask are sequences of per-frame backbone
+    features, e.g. the 'local_box' and 'seg_box' features of PREPROCESS.get_data(), and box the
+    [x_center, y_center, width, height] of the bounding boxes. All features are held in memory.
+    Features given as FrameSequences are kept once per unique frame and gathered per batch.
+    As in IntentDataset, test data of a single shard keeps the last, partial batch.
+
+    Methods:
+        as_dataset: Returns the tf.data.Dataset
+    """
+    def __init__(self, rgb_features, mask_features, boxes, labels,
+                 batch_size,
+                 train=True,
+                 seed=42,
+                 num_shards=1,
+                 shard_index=0):
+        """
+        :param rgb_features: Features of the RGB crops of shape (num_samples, seq_length, feature_dim),
+                             as an array or as track_table.FrameSequences
+        :param mask_features: Features of the segmentation crops of the same shape
+        :param boxes: Sequences of bounding boxes of shape (num_samples, seq_length, 4)
+        :param labels: Labels of shape (num_samples, 1)
+        :param batch_size: The number of samples in each batch
+        :param train: Whether data is for training. Training data is shuffled every epoch
+        :param seed: The random seed used for shuffling
+        :param num_shards: The number of shards the samples of each epoch are split into
+        :param shard_index: The index of the shard of this dataset
+        """
+        self._rgb_table, self._rgb_index = _frame_table(rgb_features)
+        self._mask_table, self._mask_index = _frame_table(mask_features)
+        self._boxes = box_features(np.asarray(boxes)[..., :4])
+        self._labels = np.asarray(labels)
+        self._batch_size = batch_size
+        self._train = train
+        self._drop_remainder = train or num_shards > 1
+        self._seed = seed
+        self._num_shards = num_shards
+        self._shard_index = shard_index
+
+    def __len__(self):
+        if not self._drop_remainder:
+            return -(-len(self._labels) // self._batch_size)
+        return len(self._labels) // (self._batch_size * self._num_shards)
+
+    def as_dataset(self):
+        """
+        Builds the input pipeline
+        :return: A tf.data.Dataset of (inputs, target) batches
+        """
+        dataset = tf.data.Dataset.from_tensor_slices((self._rgb_index, self._mask_index,
+                                                      self._boxes, self._labels))
+        if self._train:
+            dataset = dataset.shuffle(len(self._labels), seed=self._seed,
+                                      reshuffle_each_iteration=True)
+        dataset = _shard(dataset, len(self) * self._batch_size, self._num_shards, self._shard_index)
+        dataset = dataset.batch(self._batch_size, drop_remainder=self._drop_remainder)
+        rgb_table = tf.constant(self._rgb_table)
+        mask_table = tf.constant(self._mask_table)
+        dataset = dataset.map(lambda rgb, mask, box, label: ((tf.gather(rgb_table, rgb),
+                                                              tf.gather(mask_table, mask), box, label), label))
+        return dataset.prefetch(tf.data.AUTOTUNE)
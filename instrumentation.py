@@ -0,0 +1,378 @@
+
+import os
+import csv
+import math
+import sys
+import json
+import time
+import threading
+from collections import Counter
+
+
+# Instrumentation is disabled by default. While disabled, span() returns a shared no-op context
+# manager and count() returns immediately, so instrumented code only pays for a function call
+_enabled = False
+_lock = threading.Lock()
+_histograms = {}
+_counters = Counter()
+# The names of the open spans of each thread, innermost last. Read by SamplingProfiler
+_active_spans = {}
+
+
+class Histogram(object):
+    """
+    Aggregates the durations of a span. Durations are counted in logarithmic buckets, with
+    BUCKETS_PER_OCTAVE buckets per doubling from 1 microsecond on, so percentiles are accurate
+    to about 10% regardless of the number of recorded durations.
+
+    Attributes:
+        count: The number of recorded durations
+        total: The sum of the durations in seconds
+        min: The shortest duration in seconds
+        max: The longest duration in seconds
+
+    Methods:
+        add: Records a duration
+        percentile: Returns an approximate percentile of the durations
+        summary: Returns the statistics of the durations as a dictionary
+    """
+    BUCKETS_PER_OCTAVE = 8
+    MIN_DURATION = 1e-6
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self._buckets = Counter()
+
+    def _bucket(self, duration):
+        if duration <= self.MIN_DURATION:
+            return 0
+        return int(math.log2(duration / self.MIN_DURATION) * self.BUCKETS_PER_OCTAVE) + 1
+
+    def _bucket_value(self, bucket):
+        # The geometric center of a bucket
+        if bucket == 0:
+            return self.MIN_DURATION
+        return self.MIN_DURATION * 2 ** ((bucket - 0.5) / self.BUCKETS_PER_OCTAVE)
+
+    def add(self, duration):
+        """
+        Records a duration
+        :param duration: The duration in seconds
+        """
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        self._buckets[self._bucket(duration)] += 1
+
+    def percentile(self, q):
+        """
+        Returns an approximate percentile of the durations
+        :param q: The percentile in [0, 100]
+        :return: The percentile in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100. * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(max(self._bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Returns the statistics of the durations
+        :return: A dictionary with the count and the total, mean, min, max, p50, p90 and p99
+                 durations in seconds
+        """
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'min': self.min if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._stack = _active_spans.setdefault(threading.get_ident(), [])
+        self._stack.append(self.name)
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self._start_time
+        self._stack.pop()
+        with _lock:
+            histogram = _histograms.get(self.name)
+            if histogram is None:
+                histogram = _histograms[self.name] = Histogram()
+            histogram.add(duration)
+        return False
+
+
+def enable():
+    """
+    Enables the recording of spans and counters
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    Disables the recording of spans and counters. Recorded data is kept until reset()
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """
+    :return: Whether spans and counters are recorded
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Clears all recorded spans and counters
+    """
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def span(name):
+    """
+    Times a block of code, e.g.
+        with instrumentation.span('image.decode'):
+            img = load_img(path)
+    Durations are aggregated per name in a Histogram. Spans can be nested
+    :param name: The name of the span, by convention '<stage>.<operation>'
+    :return: A context manager
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, n=1):
+    """
+    Increments a counter, e.g. for cache hits and misses
+    :param name: The name of the counter
+    :param n: The increment
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def timed_iter(iterable, name):
+    """
+    Times how long each item of an iterable takes to arrive, e.g. the time a training loop
+    waits for the input pipeline:
+        for inputs, target in instrumentation.timed_iter(dataset, 'train.next_batch'):
+            ...
+    :param iterable: The iterable
+    :param name: The name of the span
+    :return: An iterator over the items of the iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            item = next(iterator, _NULL_SPAN)
+        if item is _NULL_SPAN:
+            return
+        yield item
+
+
+def snapshot():
+    """
+    Returns the recorded spans and counters
+    :return: A dictionary {'spans': {name: statistics (see Histogram.summary())},
+                           'counters': {name: value}}
+    """
+    with _lock:
+        return {'spans': {name: h.summary() for name, h in sorted(_histograms.items())},
+                'counters': dict(sorted(_counters.items()))}
+
+
+def export_json(path):
+    """
+    Writes the recorded spans and counters to a JSON file (see snapshot())
+    :param path: The path of the file
+    """
+    with open(path, 'w') as fid:
+        json.dump(snapshot(), fid, indent=2)
+
+
+def export_csv(path):
+    """
+    Writes the recorded spans and counters to a CSV file with one row per span or counter.
+    Counters only fill the 'count' column
+    :param path: The path of the file
+    """
+    data = snapshot()
+    fields = ['type', 'name', 'count', 'total', 'mean', 'min', 'max', 'p50', 'p90', 'p99']
+    with open(path, 'w', newline='') as fid:
+        writer = csv.DictWriter(fid, fieldnames=fields)
+        writer.writeheader()
+        for name, stats in data['spans'].items():
+            writer.writerow(dict(stats, type='span', name=name))
+        for name, value in data['counters'].items():
+            writer.writerow({'type': 'counter', 'name': name, 'count': value})
+
+
+def report():
+    """
+    Prints the recorded spans, sorted by their total time, and the counters
+    """
+    data = snapshot()
+    print('\n#####################################')
+    print('Instrumentation report')
+    print('#####################################')
+    print('{:<32}{:>10}{:>12}{:>12}{:>12}{:>12}'.format('span', 'count', 'total(s)', 'mean(ms)',
+                                                      'p50(ms)', 'p99(ms)'))
+    for name, stats in sorted(data['spans'].items(), key=lambda item: -item[1]['total']):
+        print('{:<32}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            name, stats['count'], stats['total'], 1e3 * stats['mean'], 1e3 * stats['p50'],
+            1e3 * stats['p99']))
+    for name, value in data['counters'].items():
+        print('{:<32}{:>10}'.format(name, value))
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler for the hot loops. A background thread samples the Python call
+    stacks of the profiled threads at a fixed interval. Each sample is counted for the full
+    stack, in the collapsed format of flame graph tools, and for the innermost open span of the
+    sampled thread, which attributes the time of code without spans to its enclosing stage.
+    Call stacks of worker processes are not sampled.
+
+    Attributes:
+        interval: The sampling interval in seconds
+        thread_ids: The ids of the profiled threads. All threads if None
+
+    Methods:
+        start: Starts sampling
+        stop: Stops sampling
+        top: Returns the most frequently sampled functions
+        span_samples: Returns the number of samples of each span
+        export_collapsed: Writes the sampled stacks in the collapsed stack format
+    """
+    def __init__(self, interval=0.005, thread_ids=None):
+        """
+        :param interval: The sampling interval in seconds
+        :param thread_ids: The ids of the profiled threads (see threading.get_ident()). All
+                           threads except the sampling thread if None
+        """
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.num_samples = 0
+        self._stacks = Counter()
+        self._functions = Counter()
+        self._spans = Counter()
+        # Guards the counters, which the sampling thread updates while the caller reads them
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def start(self):
+        """
+        Starts sampling in a background thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                # The span list is modified by its thread while it is read, so its last span is
+                # taken in a single slice
+                last_span = _active_spans.get(thread_id, [])[-1:]
+                with self._lock:
+                    self.num_samples += 1
+                    self._stacks[';'.join(reversed(stack))] += 1
+                    self._functions[stack[0]] += 1
+                    self._spans[last_span[0] if last_span else '<no span>'] += 1
+
+    def top(self, n=20):
+        """
+        Returns the most frequently sampled functions, i.e. the functions at the top of the
+        sampled stacks
+        :param n: The number of functions
+        :return: A list of ('<file>:<function>', fraction of samples) tuples
+        """
+        with self._lock:
+            num_samples = self.num_samples
+            functions = self._functions.most_common(n)
+        return [(function, samples / max(num_samples, 1)) for function, samples in functions]
+
+    def span_samples(self):
+        """
+        Returns the number of samples taken while each span was the innermost open span
+        :return: A dictionary {span name: number of samples}
+        """
+        with self._lock:
+            return dict(self._spans)
+
+    def export_collapsed(self, path):
+        """
+        Writes the sampled stacks in the collapsed stack format ('frame;frame;frame count'),
+        which is read by flame graph tools such as flamegraph.pl and speedscope
+        :param path: The path of the file
+        """
+        with self._lock:
+            stacks = self._stacks.most_common()
+        with open(path, 'w') as fid:
+            for stack, samples in stacks:
+                fid.write('{} {}\n'.format(stack, samples))
@@ -0,0 +1,528 @@
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from input_pipeline import box_features
+
+
+class TubeletEmbedding(layers.Layer):
+    def __init__(self, embed_dim, patch_size, **kwargs):
+        super().__init__(**kwargs)
+        self.embed_dim =embed_dim
+        self.patch_size = patch_size
+        self.projection = layers.Conv3D(
+            filters=self.embed_dim,
+            kernel_size= self.patch_size,
+            strides= self.patch_size,
+            padding="VALID",kernel_initializer=keras.initializers.HeNormal(seed=123), activity_regularizer = keras.regularizers.L1(l1=1e-5)
+        )
+        # Unrolled over the (fixed) sequence length, so Keras never picks the cuDNN kernel and the
+        # graph has no while loop (see generic_rnn_kernels())
+        self.projection2 = layers.GRU(self.embed_dim, return_sequences=True, return_state=True, unroll=True)
+        self.flatten = layers.Reshape(target_shape=(-1, embed_dim))
+
+    def call(self, videos, vid):
+        if vid==0:
+          projected_patches = self.projection(videos)
+
+        elif vid==1:
+          projected_patches,_ = self.projection2(videos)
+
+
+        flattened_patches = self.flatten(projected_patches)
+        return flattened_patches
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "embed_dim": self.embed_dim,
+            "patch_size": self.patch_size,
+        })
+        return config
+
+
+class PositionalEncoder(layers.Layer):
+    def __init__(self, embed_dim, **kwargs):
+        super().__init__(**kwargs)
+        self.embed_dim = embed_dim
+
+    def build(self, input_shape):
+        _, num_tokens, _ = input_shape
+        self.position_embedding = layers.Embedding(
+            input_dim=num_tokens, output_dim=self.embed_dim
+        )
+        self.positions = tf.range(start=0, limit=num_tokens, delta=1)
+
+    def call(self, encoded_tokens):
+        # Encode the positions and add it to the encoded tokens
+        encoded_positions = self.position_embedding(self.positions)
+        encoded_tokens = encoded_tokens + encoded_positions
+        return encoded_tokens
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "embed_dim": self.embed_dim
+
+        })
+        return config
+
+
+class PositionalEncoder2(PositionalEncoder):
+    pass
+
+
+class Custom_CE_Loss(keras.layers.Layer):
+    def __init__(self, **kwargs):
+        super(Custom_CE_Loss, self).__init__(**kwargs)
+        self.w1 = tf.Variable(0.2,name='w1',trainable=True)
+        self.w2 = tf.Variable(0.3,name='w2',trainable=True)
+        self.w3 = tf.Variable(0.5,name='w3',trainable=True)
+
+    def call(self, y_true, y_pred1, y_pred2, y_pred3):
+        # Means over the batch. Keras loss objects do not average under a distribution strategy
+        loss_r = tf.reduce_mean(keras.losses.sparse_categorical_crossentropy(y_true, y_pred1))
+        loss_rs = tf.reduce_mean(keras.losses.sparse_categorical_crossentropy(y_true, y_pred2))
+        loss_rst = tf.reduce_mean(keras.losses.sparse_categorical_crossentropy(y_true, y_pred3))
+        return tf.cast(self.w1, float)*loss_r +  tf.cast(self.w2, float)*loss_rs +  tf.cast(self.w3, float)* loss_rst
+
+
+CUSTOM_OBJECTS = {'TubeletEmbedding': TubeletEmbedding,
+                  'PositionalEncoder': PositionalEncoder,
+                  'PositionalEncoder2': PositionalEncoder2}
+
+
+def _build_layers(num_tokens, embed_dim, num_heads, patch_size, layer_norm_eps, seed):
+    """
+    Creates the layers of IntentFormer that hold weights. Every layer is named, so the layers
+    of a built model can be retrieved with model.get_layer()
+    :return: A dictionary of layers keyed by their names
+    """
+    model_layers = [
+        TubeletEmbedding(embed_dim=embed_dim, patch_size=patch_size, name='tubelet_embedding'),
+        PositionalEncoder(embed_dim=embed_dim, name='positional_encoder'),
+        PositionalEncoder2(embed_dim=embed_dim, name='positional_encoder2'),
+        keras.Sequential(
+            [
+                layers.Dense(units=embed_dim * 4, activation=tf.nn.gelu, kernel_initializer=keras.initializers.HeNormal(seed=seed),kernel_regularizer= tf.keras.regularizers.L2(1e-6) ),
+                layers.Dropout(0.5),
+                layers.Dense(units=embed_dim, activation=tf.nn.gelu, kernel_initializer=keras.initializers.HeNormal(seed=seed),kernel_regularizer= tf.keras.regularizers.L2(1e-6) ),
+            ], name='shared_mlp'),
+        # Shared weight attention of the co-learning stages (MHSWA)
+        layers.MultiHeadAttention(num_heads=num_heads, key_dim=embed_dim // num_heads, dropout=0.5,
+                                  name='shared_attention1'),
+        layers.MultiHeadAttention(num_heads=num_heads, key_dim=embed_dim // num_heads, dropout=0.5,
+                                  name='shared_attention2'),
+        layers.MultiHeadAttention(num_heads=num_heads, key_dim=embed_dim // num_heads, dropout=0.5,
+                                  name='rgb_attention'),
+        layers.LayerNormalization(epsilon=1e-6, name='rgb_norm1'),
+        layers.LayerNormalization(epsilon=1e-6, name='rgb_norm2'),
+    ]
+    for stage in ('seg', 'traj'):
+        model_layers += [layers.LayerNormalization(epsilon=1e-6, name=stage + '_norm1'),
+                         layers.LayerNormalization(epsilon=1e-6, name=stage + '_norm_kv'),
+                         layers.LayerNormalization(epsilon=1e-6, name=stage + '_norm2'),
+                         layers.Conv1D(num_tokens, 1, name=stage + '_mix')]
+    for stage in ('rgb', 'seg', 'traj'):
+        model_layers += [layers.LayerNormalization(epsilon=layer_norm_eps, name=stage + '_norm_out'),
+                         # The heads compute in float32 under a mixed precision policy, so the
+                         # probabilities fed to the loss keep their precision
+                         layers.Dense(units=2, activation='Softmax', name=stage + '_o', dtype='float32',
+                                      kernel_initializer=keras.initializers.HeNormal(seed=seed))]
+    # Embeds per-frame backbone features in the 'features' input mode. Like the tubelets, the
+    # embedding is shared by the RGB and mask streams
+    model_layers.append(layers.Dense(embed_dim, kernel_initializer=keras.initializers.HeNormal(seed=123),
+                                     name='feature_embedding'))
+    return {l.name: l for l in model_layers}
+
+
+def _classify(model_layers, stage, encoded_patches):
+    representation = model_layers[stage + '_norm_out'](encoded_patches)
+    representation = layers.GlobalAvgPool1D()(representation)
+    representation = layers.Dropout(0.5)(representation)
+    return model_layers[stage + '_o'](representation)
+
+
+def _fold_windows(tokens, grid, window_size):
+    # (batch, t * h * w, dim) -> (batch * num_windows, window tokens, dim)
+    (t, h, w), (wt, wh, ww) = grid, window_size
+    dim = tokens.shape[-1]
+    x = tf.reshape(tokens, (-1, t // wt, wt, h // wh, wh, w // ww, ww, dim))
+    x = tf.transpose(x, (0, 1, 3, 5, 2, 4, 6, 7))
+    return tf.reshape(x, (-1, wt * wh * ww, dim))
+
+
+def _unfold_windows(tokens, grid, window_size):
+    # Inverse of _fold_windows()
+    (t, h, w), (wt, wh, ww) = grid, window_size
+    dim = tokens.shape[-1]
+    x = tf.reshape(tokens, (-1, t // wt, h // wh, w // ww, wt, wh, ww, dim))
+    x = tf.transpose(x, (0, 1, 4, 2, 5, 3, 6, 7))
+    return tf.reshape(x, (-1, t * h * w, dim))
+
+
+class GridAttention(object):
+    """
+    Applies attention between two token sequences laid out on the same (time, height, width)
+    tubelet grid, in one of the following modes:
+        full: Every token attends to every token
+        factorized: Tokens attend to the tokens of the same time step, then to the tokens at the
+                    same spatial position
+        window: Tokens attend to the tokens in the same window of window_size tubelets
+        pooled: Tokens attend to the tokens average pooled over pool_size tubelets
+    All modes use the weights of the given attention layer, so shared attention layers (MHSWA)
+    stay shared, and return one output token per query token.
+
+    Methods:
+        __call__: Applies an attention layer to query and value tokens
+    """
+    def __init__(self, attention_mode='full', grid=None, window_size=(7, 7, 7), pool_size=(1, 2, 2)):
+        """
+        :param attention_mode: One of 'full', 'factorized', 'window' or 'pooled'
+        :param grid: The shape of the tubelet grid as (time, height, width)
+        :param window_size: The size of the attention windows in tubelets
+        :param pool_size: The size of the pooled tubelets
+        """
+        assert attention_mode in ['full', 'factorized', 'window', 'pooled'], \
+            'Attention mode {} is invalid'.format(attention_mode)
+        if attention_mode == 'window' and any(g % s for g, s in zip(grid, window_size)):
+            raise ValueError('Tubelet grid {} is not divisible into windows of {}'.format(grid, window_size))
+        if attention_mode == 'pooled' and any(g % s for g, s in zip(grid, pool_size)):
+            raise ValueError('Tubelet grid {} is not divisible into pools of {}'.format(grid, pool_size))
+        self.attention_mode = attention_mode
+        self.grid = tuple(grid) if grid is not None else None
+        self.window_size = tuple(window_size)
+        self.pool_size = tuple(pool_size)
+
+    def __call__(self, attention, query, value):
+        if self.attention_mode == 'full':
+            return attention(query, value)
+
+        t, h, w = self.grid
+        dim = query.shape[-1]
+        if self.attention_mode == 'pooled':
+            value = layers.Reshape((t, h, w, dim))(value)
+            value = layers.AveragePooling3D(self.pool_size)(value)
+            return attention(query, layers.Reshape((-1, dim))(value))
+
+        if self.attention_mode == 'window':
+            output = attention(_fold_windows(query, self.grid, self.window_size),
+                               _fold_windows(value, self.grid, self.window_size))
+            return _unfold_windows(output, self.grid, self.window_size)
+
+        # Spatial attention within each time step
+        output = attention(tf.reshape(query, (-1, h * w, dim)), tf.reshape(value, (-1, h * w, dim)))
+        # Temporal attention at each spatial position
+        to_temporal = lambda x: tf.reshape(tf.transpose(tf.reshape(x, (-1, t, h * w, dim)), (0, 2, 1, 3)),
+                                           (-1, t, dim))
+        output = attention(to_temporal(output), to_temporal(value))
+        output = tf.transpose(tf.reshape(output, (-1, h * w, t, dim)), (0, 2, 1, 3))
+        return tf.reshape(output, (-1, t * h * w, dim))
+
+
+def _co_attention(model_layers, stage, attention, encoded_patches, encoded_other, attend):
+    """
+    A co-learning stage. Tokens of the current encoding and of another modality attend to each
+    other with shared attention weights
+    """
+    x1 = model_layers[stage + '_norm1'](encoded_patches)
+    xn = model_layers[stage + '_norm_kv'](encoded_other)
+
+    attention_output1 = attend(attention, x1, xn)
+    attention_output2 = attend(attention, xn, x1)
+
+    # Maps the attended tokens of the other modality onto the tokens of the current encoding
+    attention = layers.Permute((2, 1))(attention_output2)
+    attention = model_layers[stage + '_mix'](attention)
+    attention = layers.Permute((2, 1))(attention)
+    attention_output = layers.Add()([attention_output1, attention])
+
+    # Skip connection
+    x2 = layers.Add()([attention_output, encoded_patches])
+
+    # Layer Normalization and MLP
+    x3 = model_layers[stage + '_norm2'](x2)
+    x3 = model_layers['shared_mlp'](x3)
+
+    # Skip connection
+    return layers.Add()([x3, x2])
+
+
+def _encode(model_layers, patches_0, patches_1, patches_2, attend):
+    """
+    Applies the transformer encoders to the embedded RGB, mask and box tokens
+    :param attend: The GridAttention of the RGB self-attention and the RGB-mask co-attention.
+                   The box tokens are not on the tubelet grid and always use full attention
+    :return: The outputs of the three heads
+    """
+    encoded_patches_0 = model_layers['positional_encoder'](patches_0)
+    encoded_patches_1 = model_layers['positional_encoder'](patches_1)
+    encoded_patches_2 = model_layers['positional_encoder2'](patches_2)
+
+    encoded_patches = encoded_patches_0
+    x1 = model_layers['rgb_norm1'](encoded_patches)
+    attention_output = attend(model_layers['rgb_attention'], x1, x1)
+    x2 = layers.Add()([attention_output, encoded_patches])
+
+    # Layer Normalization and MLP
+    x3 = model_layers['rgb_norm2'](x2)
+    x3 = model_layers['shared_mlp'](x3)
+
+    # Skip connection
+    encoded_patches = layers.Add(name='encoded_R')([x3, x2])
+    output_r = _classify(model_layers, 'rgb', encoded_patches)
+
+    encoded_patches = _co_attention(model_layers, 'seg', model_layers['shared_attention1'],
+                                    encoded_patches, encoded_patches_1, attend)
+    output_s = _classify(model_layers, 'seg', encoded_patches)
+
+    encoded_patches = _co_attention(model_layers, 'traj', model_layers['shared_attention2'],
+                                    encoded_patches, encoded_patches_2, GridAttention('full'))
+    outputs = _classify(model_layers, 'traj', encoded_patches)
+    return output_r, output_s, outputs
+
+
+def build_intentformer(input_shape=(14, 224, 224, 3),
+                       box_shape=(14, 4),
+                       label_shape=(14, 1),
+                       patch_size=(2, 8, 8),
+                       embed_dim=64,
+                       num_heads=4,
+                       layer_norm_eps=1e-6,
+                       seed=42,
+                       attention_mode='full',
+                       window_size=(7, 7, 7),
+                       pool_size=(1, 2, 2),
+                       input_mode='video'):
+    """
+    Builds the IntentFormer model. The model takes [RGB, mask, box, target] and returns the
+    predictions of the RGB ('rgb_o'), RGB + segmentation ('seg_o') and RGB + segmentation +
+    trajectory ('traj_o') heads
+    :param input_shape: The shape of the RGB and mask videos, or (seq_length, feature_dim) of the
+                        per-frame features in the 'features' input mode
+    :param box_shape: The shape of the bounding box sequences
+    :param label_shape: The shape of the target input
+    :param patch_size: The size of the tubelets
+    :param embed_dim: The dimension of the token embeddings
+    :param num_heads: The number of attention heads
+    :param layer_norm_eps: Epsilon of the layer normalization before the heads
+    :param seed: The random seed of the initializers
+    :param attention_mode: The attention of the RGB and mask tokens (see GridAttention).
+                           'full' is the original model
+    :param window_size: The size of the attention windows in tubelets for attention_mode 'window'
+    :param pool_size: The size of the pooled key tubelets for attention_mode 'pooled'
+    :param input_mode: 'video' for RGB and mask videos, or 'features' for sequences of per-frame
+                       backbone features of the RGB and segmentation crops, e.g. the 'local_box'
+                       and 'seg_box' features of PREPROCESS.get_data(). Features are embedded
+                       as one token per frame
+    :return: A keras Model
+    """
+    assert input_mode in ['video', 'features'], 'Input mode {} is invalid'.format(input_mode)
+    if input_mode == 'features':
+        grid = [input_shape[0], 1, 1]
+    else:
+        grid = [s // p for s, p in zip(input_shape, patch_size)]
+    num_tokens = int(np.prod(grid))
+    model_layers = _build_layers(num_tokens, embed_dim, num_heads, patch_size, layer_norm_eps, seed)
+
+    input_0 = layers.Input(shape=input_shape, name='RGB')
+    input_1 = layers.Input(shape=input_shape, name='mask')
+    input_2 = layers.Input(shape=box_shape, name='box')
+    label = layers.Input(shape=label_shape, name='target')
+
+    tubelet_embedder = model_layers['tubelet_embedding']
+    if input_mode == 'features':
+        patches_0 = model_layers['feature_embedding'](input_0)
+        patches_1 = model_layers['feature_embedding'](input_1)
+    else:
+        patches_0 = tubelet_embedder(input_0, 0)
+        patches_1 = tubelet_embedder(input_1, 0)
+    outputs = _encode(model_layers, patches_0, patches_1,
+                      tubelet_embedder(input_2, 1),
+                      GridAttention(attention_mode, grid, window_size, pool_size))
+    return keras.Model(inputs=[input_0, input_1, input_2, label], outputs=list(outputs))
+
+
+@contextmanager
+def generic_rnn_kernels(model, unroll=False):
+    """
+    Checks that the RNN layers of a model are unrolled while a graph is traced, e.g.
+        with generic_rnn_kernels(model):
+            concrete_function = train_step.get_concrete_function(*specs)
+    The cuDNN kernel of GRU/LSTM layers and the while loop of the generic RNN kernel cannot be
+    lowered to XLA or to TFLite builtin operators. Keras only picks the cuDNN kernel for layers
+    that are not unrolled, so the box GRU of IntentFormer is built with unroll=True. GRU/LSTM
+    layers that are not unrolled raise a ValueError
+    :param model: A keras Model
+    :param unroll: Whether the other RNN loops are also unrolled over the (fixed) sequence length
+    """
+    rnn_layers = [m for m in model.submodules if isinstance(m, layers.RNN)]
+    fused = [m.name for m in rnn_layers if isinstance(m, (layers.GRU, layers.LSTM)) and not m.unroll]
+    if fused:
+        raise ValueError('The RNN layers {} may use the fused kernels. Build them with unroll=True'.format(fused))
+    rnn_unroll = [rnn.unroll for rnn in rnn_layers]
+    for rnn in rnn_layers:
+        rnn.unroll = rnn.unroll or unroll
+    try:
+        yield
+    finally:
+        for rnn, unrolled in zip(rnn_layers, rnn_unroll):
+            rnn.unroll = unrolled
+
+
+class _Track(object):
+    def __init__(self, tubelet_length, seq_length):
+        # The last frames, to form the tubelet that ends at the next frame
+        self.rgb = deque(maxlen=tubelet_length)
+        self.mask = deque(maxlen=tubelet_length)
+        self.boxes = deque(maxlen=seq_length)
+        # Embeddings of the tubelets ending at each of the last frames
+        self.rgb_tokens = deque(maxlen=seq_length - tubelet_length + 1)
+        self.mask_tokens = deque(maxlen=seq_length - tubelet_length + 1)
+        self.last_seen = 0
+
+
+class IntentPredictor(object):
+    """
+    Online crossing intention prediction for tracked pedestrians. Frames arrive one at a
+    time per track, and a prediction is emitted for every track with a full observation window.
+
+    The embedding of a tubelet does not depend on the window it is part of, so the tubelet ending
+    at each frame is embedded once, when the frame arrives, and cached with the track. The windows
+    ending at the following frames reuse the cached embeddings. The box GRU and the transformer
+    encoders depend on the whole window and are recomputed for every prediction. Tubelets and
+    windows of all tracks in a step are processed in batches.
+
+    Attributes:
+        model: The IntentFormer model (see build_intentformer())
+        seq_length: The number of frames in an observation window
+        batch_size: The number of tracks processed in one batch
+        max_tracks: The maximum number of tracks kept. The least recently seen tracks are evicted
+        max_age: Tracks not seen for this number of steps are evicted
+
+    Methods:
+        step: Adds the current frame of a number of tracks and predicts their crossing probability
+        remove: Removes a track
+        reset: Removes all tracks
+    """
+    def __init__(self, model, batch_size=16, max_tracks=256, max_age=15, output='traj_o'):
+        """
+        :param model: The IntentFormer model (see build_intentformer())
+        :param batch_size: The number of tracks processed in one batch
+        :param max_tracks: The maximum number of tracks kept
+        :param max_age: Tracks not seen for this number of steps are evicted
+        :param output: The name of the head used for predictions
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_tracks = max_tracks
+        self.max_age = max_age
+
+        input_shape = tuple(model.get_layer('RGB').output.shape[1:])
+        if len(input_shape) != 4:
+            raise ValueError('IntentPredictor requires a model with video inputs, got inputs of shape {}'.format(
+                input_shape))
+        tubelet_embedder = model.get_layer('tubelet_embedding')
+        self.seq_length = input_shape[0]
+        self._tubelet_length = tubelet_embedder.patch_size[0]
+        self._frame_shape = input_shape[1:]
+
+        clips = layers.Input(shape=(self._tubelet_length,) + self._frame_shape)
+        self._tubelet_model = keras.Model(clips, tubelet_embedder(clips, 0))
+
+        # The encoders of the model, taking the embedded RGB and mask tubelets of a window
+        self._encoder_model = keras.Model([tubelet_embedder.get_output_at(0),
+                                           tubelet_embedder.get_output_at(1),
+                                           model.get_layer('box').output],
+                                          model.get_layer(output).output)
+
+        self._tracks = OrderedDict()
+        self._step = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def _predict(self, model, inputs):
+        # Runs a model in fixed size batches
+        num_samples = len(inputs[0])
+        outputs = []
+        for start in range(0, num_samples, self.batch_size):
+            batch = [x[start:start + self.batch_size] for x in inputs]
+            num_padding = self.batch_size - len(batch[0])
+            batch = [np.concatenate([x, np.zeros((num_padding,) + x.shape[1:], dtype=x.dtype)])
+                     for x in batch]
+            outputs.append(model.predict_on_batch(batch if len(batch) > 1 else batch[0])[:len(batch[0]) - num_padding])
+        return np.concatenate(outputs)
+
+    def step(self, frames):
+        """
+        Adds the current frame of a number of tracks and predicts their crossing probability
+        :param frames: A dictionary mapping track ids to (rgb, mask, box) of the current frame.
+                       rgb and mask are uint8 images in the model input size, as produced by
+                       input_pipeline.load_rgb_crop() and load_mask(), and box is [x1, y1, x2, y2]
+        :return: A dictionary mapping the ids of tracks with a full observation window to their
+                 crossing probability
+        """
+        self._step += 1
+        new_tubelets = []
+        for track_id, (rgb, mask, box) in frames.items():
+            track = self._tracks.pop(track_id, None)
+            if track is None:
+                track = _Track(self._tubelet_length, self.seq_length)
+            self._tracks[track_id] = track
+            track.last_seen = self._step
+            track.rgb.append(np.asarray(rgb, dtype=np.float32) / 255)
+            track.mask.append(np.asarray(mask, dtype=np.float32) / 255)
+            track.boxes.append(box_features(box[:4]))
+            if len(track.rgb) == self._tubelet_length:
+                new_tubelets.append(track)
+
+        if new_tubelets:
+            # RGB and mask tubelets share the embedding, so they are embedded in one pass
+            clips = np.stack([np.stack(t.rgb) for t in new_tubelets] +
+                             [np.stack(t.mask) for t in new_tubelets])
+            tokens = self._predict(self._tubelet_model, [clips])
+            for i, track in enumerate(new_tubelets):
+                track.rgb_tokens.append(tokens[i])
+                track.mask_tokens.append(tokens[len(new_tubelets) + i])
+
+        # A window consists of the non-overlapping tubelets ending at every tubelet_length-th frame
+        ready = [track_id for track_id in frames
+                 if len(self._tracks[track_id].rgb_tokens) == self._tracks[track_id].rgb_tokens.maxlen]
+        predictions = {}
+        if ready:
+            window = range(0, self.seq_length - self._tubelet_length + 1, self._tubelet_length)
+            tracks = [self._tracks[track_id] for track_id in ready]
+            rgb_tokens = np.stack([np.concatenate([t.rgb_tokens[i] for i in window]) for t in tracks])
+            mask_tokens = np.stack([np.concatenate([t.mask_tokens[i] for i in window]) for t in tracks])
+            boxes = np.stack([np.stack(t.boxes) for t in tracks])
+            probabilities = self._predict(self._encoder_model, [rgb_tokens, mask_tokens, boxes])
+            predictions = dict(zip(ready, probabilities[:, 1]))
+
+        self._evict()
+        return predictions
+
+    def _evict(self):
+        for track_id in [k for k, t in self._tracks.items() if self._step - t.last_seen >= self.max_age]:
+            del self._tracks[track_id]
+        while len(self._tracks) > self.max_tracks:
+            self._tracks.popitem(last=False)
+
+    def remove(self, track_id):
+        """
+        Removes a track
+        :param track_id: The id of the track
+        """
+        self._tracks.pop(track_id, None)
+
+    def reset(self):
+        """
+        Removes all tracks
+        """
+        self._tracks.clear()
+        self._step = 0
@@ -1,22 +1,34 @@
 
-import time
-import pickle
 import json
 
 from utils import *
-import tensorflow as tf
-from PIL import Image, ImageDraw
-from keras.layers import Input, Concatenate, Dense
-from keras.layers import GRU
 from keras.models import Model, load_model
-from keras.applications import vgg16
 # from keras.optimizers import adam_v2
 from keras import regularizers
-from keras_preprocessing.image import img_to_array, load_img
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-from sklearn.metrics import roc_auc_score, roc_curve, precision_recall_curve
 import numpy as np
 import os
+import hashlib
+from collections import deque
+
+from feature_extraction import FeatureExtractor, get_backbone, pool_features
+from feature_store import FeatureStore, feature_config, config_id, source_fingerprint
+from crop_loader import CropLoader
+from track_table import TrackTable, TrackWindows, FrameSequences, unique_frames
+import instrumentation
+
+
+def raw_fingerprint(data_raw):
+    """
+    Computes the fingerprint of the data sequences of a split, i.e. of their images, bounding
+    boxes, pedestrian ids and activities
+    :param data_raw: The data sequences from the dataset
+    :return: The fingerprint as a hex string
+    """
+    digest = hashlib.sha1('\n'.join(np.concatenate(data_raw['image']).tolist()).encode('utf-8'))
+    digest.update(np.asarray([len(t) for t in data_raw['bbox']], dtype=np.int64).tobytes())
+    for key in ['bbox', 'pid', 'activities']:
+        digest.update(np.ascontiguousarray(np.concatenate(data_raw[key])).astype(str).tobytes())
+    return digest.hexdigest()[:16]
 
 
 class PREPROCESS(object):
@@ -29,9 +41,12 @@ class PREPROCESS(object):
         _regularizer: Training regularizer set as L2
         self._global_pooling: The pulling method for visual features. Options are: 'avg', 'max', 'none' (will return
                               flattened output
+        _num_workers: The number of processes used to read and crop images
 
      Methods:
         load_images_crop_and_process: Reads the images and generate feature suquences for training
+        get_unique_frames: Finds the unique frames in a set of sequences
+        load_frame_features: Generates the visual features of a table of unique frames
         get_poses: gets the poses for PIE dataset
         flip_pose: Flips the pose joint coordinates
         get_data_sequence: Generates data sequences
@@ -47,7 +62,8 @@ class PREPROCESS(object):
     def __init__(self,
                  num_hidden_units=256,
                  global_pooling='avg',
-                 regularizer_val=0.0001):
+                 regularizer_val=0.0001,
+                 num_workers=0):
 
         # Network parameters
         self._num_hidden_units = num_hidden_units
@@ -55,6 +71,9 @@ class PREPROCESS(object):
         self._regularizer = regularizers.l2(regularizer_val)
         self._global_pooling = global_pooling
 
+        # Data processing parameters
+        self._num_workers = num_workers
+
     # Processing images anf generate features
     def load_images_crop_and_process(self, img_sequences, bbox_sequences,
                                      ped_ids, save_path,
@@ -62,13 +81,16 @@ class PREPROCESS(object):
                                      crop_type='none',
                                      crop_mode='warp',
                                      crop_resize_ratio=2,
-                                     regen_data=False):
+                                     regen_data=False,
+                                     batch_size=32,
+                                     num_workers=0):
         """
         Generate visual feature seuqences by reading and processing images
         :param img_sequences: Sequences of image names
         :param bbox_sequences: Sequences of bounding boxes
         :param ped_ids: Sequences of pedestrian ids
-        :param save_path: The path to save the features
+        :param save_path: The root folder of the feature stores. Features are stored in a subfolder
+                          named after the hash of all parameters that affect them (see feature_store.py)
         :param data_type: Whether data is for training or testing
         :param crop_type: The method to crop the bounding boxes from the images
                           Options: 'bbox' crops using bounding box coordinats
@@ -84,111 +106,92 @@ class PREPROCESS(object):
                           'pad_resize', 'pad_fit' (see utils.py:img_pad() for more details)
         :param crop_resize_ratio: The ratio by which the image is enlarged to capture the context
                                   Used by crop types 'context' and 'surround'.
-        :param regen_data: Whether regenerate the currently saved data.
+        :param regen_data: Whether regenerate the currently saved data. Frames that are missing,
+                           whose bounding box changed or whose video folder changed (see
+                           feature_store.source_fingerprint()) are always regenerated. Set it to
+                           regenerate images that were overwritten in place
+        :param batch_size: The number of images passed through the backbone in each forward pass
+        :param num_workers: The number of processes used to read, crop and pad the images. 0 processes
+                            the images in the calling process
         :return: Sequences of visual features
         """
+        backbone = 'efficientnetb4'
+        if np.size(img_sequences) == 0:
+            # e.g. a split without tracks for the time to event. The features have the shape of
+            # the pooled feature map of the backbone
+            convnet, _ = get_backbone(backbone)
+            feature_shape = pool_features(np.zeros((1,) + tuple(convnet.output_shape[1:]), dtype=np.float32),
+                                          self._global_pooling).shape
+            seq_length = np.shape(img_sequences)[1] if np.ndim(img_sequences) > 1 else 0
+            return np.zeros((len(img_sequences), seq_length) + feature_shape, dtype=np.float32)
+
+        store = FeatureStore.for_config(save_path, feature_config(backbone, crop_type, crop_mode,
+                                                                  crop_resize_ratio, self._global_pooling))
+
         # load the feature files if exists
         print("Generating {} features crop_type={} crop_mode={}\
               \nsave_path={}, ".format(data_type, crop_type, crop_mode,
-              save_path))
-        convnet = tf.keras.applications.efficientnet.EfficientNetB4(input_shape=(224, 224, 3),
-                              include_top=False, weights='imagenet')
-        
-      
-        sequences = []
+              store.root))
+        extractor = FeatureExtractor(backbone=backbone, batch_size=batch_size)
+
+        def store_features(set_id, vid_id, key, fingerprint):
+            # Pools the feature map and queues it for writing to the store
+            def callback(img_features):
+                store.put(set_id, vid_id, key, pool_features(img_features, self._global_pooling),
+                          fingerprint)
+            return callback
+
+        frames = []
+        queued = set()
+        tasks = []
+        task_frames = []
+        num_stale = 0
+        folder_stats = {}
         bbox_seq = bbox_sequences.copy()
-        i = -1
-        for seq, pid in zip(img_sequences, ped_ids):
-            i += 1
-            update_progress(i / len(img_sequences))
-            img_seq = []
-            prev_img_save_path=None 
-            
+        for i, (seq, pid) in enumerate(zip(img_sequences, ped_ids)):
+            # Previously read images of the sequence, used in place of corrupted images
+            fallback_paths = deque(maxlen=8)
+
             for imp, b, p in zip(seq, bbox_seq[i], pid):
-                flip_image = False
-               
                 set_id = imp.split('/')[-3]
                 vid_id = imp.split('/')[-2]
                 img_name = imp.split('/')[-1].split('.')[0]
-                img_save_folder = os.path.join(save_path, set_id, vid_id)
                 if crop_type == 'none':
-                    img_save_path = os.path.join(img_save_folder, img_name + '.pkl')
+                    key = img_name
                 else:
-                    img_save_path = os.path.join(img_save_folder, img_name + '_' + p[0] + '.pkl')
-              
-                if os.path.exists(img_save_path) and not regen_data:
-                    with open(img_save_path, 'rb') as fid:
-                        try:
-                            img_features = pickle.load(fid)
-                        except:
-                            img_features = pickle.load(fid, encoding='bytes')
-            
-                else:    
-                    if 'flip' in imp:
-                        imp = imp.replace('_flip', '')
-                        flip_image = True
-                        
-                    if crop_type == 'none':
-                        img_data = load_img(imp, target_size=(224, 224))
-                        if flip_image:
-                            img_data = img_data.transpose(Image.FLIP_LEFT_RIGHT)
-                    else:
-                      
-                      try:
-                        
-                        img_data = load_img(imp)  
-                        prev_img_save_path=imp
+                    key = img_name + '_' + p[0]
+                frame = (set_id, vid_id, key)
+                frames.append(frame)
+                if frame in queued:
+                    continue
+
+                fingerprint = source_fingerprint(imp, b if crop_type != 'none' else None, folder_stats)
+                if not regen_data:
+                    if store.lookup(*frame, fingerprint=fingerprint) is not None:
+                        instrumentation.count('feature_store.hits')
+                        continue
+                    num_stale += store.lookup(*frame) is not None
+                instrumentation.count('feature_store.misses')
+                tasks.append((imp, b, tuple(fallback_paths)))
+                task_frames.append(frame + (fingerprint,))
+                fallback_paths.appendleft(imp.replace('_flip', ''))
+                queued.add(frame)
+
+        print('{} frames to process ({} missing, {} stale)'.format(len(tasks), len(tasks) - num_stale, num_stale))
+        loader = CropLoader(crop_type=crop_type, crop_mode=crop_mode, num_workers=num_workers)
+        for i, (frame, img_data) in enumerate(zip(task_frames, loader.imap(tasks))):
+            update_progress(i / len(tasks))
+            extractor.add(img_data, store_features(*frame))
+        extractor.flush()
+        store.flush()
+        update_progress(1)
+
+        if extractor.num_frames:
+            print('\nExtracted features for {} frames in {:.2f}s ({:.1f} frames/sec)'.format(
+                extractor.num_frames, extractor.elapsed, extractor.fps()))
+        features = store.gather(frames)
+        sequences = features.reshape((len(img_sequences), -1) + features.shape[1:])
 
-    
-                      except (IOError, SyntaxError) as e:
-                        imp = prev_img_save_path
-                        img_data = load_img(imp) 
-                      except Exception as e:
- 
-                        imp = prev_img_save_path
-                        img_data = load_img(imp)
-
-                        
-                      if flip_image:
-                          img_data = img_data.transpose(Image.FLIP_LEFT_RIGHT)
-                      if crop_type == 'bbox':
-                        
-                        try:
-                          
-                          cropped_image = img_data.crop(list(map(int, b[0:4])))
-                          
-                        except OSError as err:  
-                          imp = prev_img_save_path
-                          img_data = load_img(imp)
-
-                        img_data = img_pad(cropped_image, mode=crop_mode, size=224)
-                        
-                        
-                      else:
-                            raise ValueError('ERROR: Undefined value for crop_type {}!'.format(crop_type))
-  
-                    image_array = img_to_array(img_data)
-                    preprocessed_img = tf.keras.applications.efficientnet.preprocess_input(image_array)
-                    expanded_img = np.expand_dims(preprocessed_img, axis=0)
-                    img_features = convnet.predict(expanded_img)
-
-                    if not os.path.exists(img_save_folder):
-                        os.makedirs(img_save_folder)
-                    with open(img_save_path, 'wb') as fid:
-                        pickle.dump(img_features, fid, pickle.HIGHEST_PROTOCOL)  
-                    img_features = np.squeeze(img_features)
-                  
-                    img_features = np.average(img_features, axis=0)
-                
-                    img_features = np.average(img_features, axis=0)
-                  
-             
-                  
-                img_seq.append(img_features)
-            sequences.append(img_seq)
-           
-        sequences = np.array(sequences)
-        
         return sequences
 
     
@@ -204,69 +207,36 @@ class PREPROCESS(object):
         print('\n#####################################')
         print('Generating raw data')
         print('#####################################')
-        d = {'center': data_raw['center'].copy(),
-             'box': data_raw['bbox'].copy(),
-             'box_org': data_raw['bbox'].copy(),
-             'ped_id': data_raw['pid'].copy(),
-             'acts': data_raw['activities'].copy(),
-             'image': data_raw['image'].copy()}
-        try:
-            d['speed'] = data_raw['obd_speed'].copy()
-        except:
-            d['speed'] = data_raw['vehicle_act'].copy()
+        with instrumentation.span('preprocessing.track_table'):
+            tracks = TrackTable.from_raw(data_raw)
+        if 'obd_speed' not in data_raw:
             print('Jaad dataset does not have speed information')
             print('Vehicle actions are used instead')
-        
-
-        for i in range(len(d['box'])):
-            d['box'][i] = d['box'][i][- obs_length - time_to_event:-time_to_event]
-            d['center'][i] = d['center'][i][- obs_length - time_to_event:-time_to_event]
-            if normalize:
-                d['box'][i] = np.subtract(d['box'][i][1:], d['box'][i][0]).tolist()
-                d['center'][i] = np.subtract(d['center'][i][1:], d['center'][i][0]).tolist()
 
+        d = {'center': tracks.window('center', obs_length, time_to_event),
+             'box': tracks.window('box', obs_length, time_to_event)}
         if normalize:
+            d['box'] = d['box'][:, 1:] - d['box'][:, :1]
+            d['center'] = d['center'][:, 1:] - d['center'][:, :1]
             obs_length -= 1
 
-        for k in d.keys():
-            if k != 'box' and k != 'center':
-                for i in range(len(d[k])):
-                    d[k][i] = d[k][i][- obs_length - time_to_event:-time_to_event]
-                d[k] = np.array(d[k])
-            else:
-                d[k] = np.array(d[k])
-        d['acts'] = d['acts'][:, 0, :]
+        d['box_org'] = tracks.window('box', obs_length, time_to_event)
+        d['ped_id'] = tracks.window('ped_id', obs_length, time_to_event)
+        d['acts'] = tracks.window('acts', obs_length, time_to_event)[:, 0, :]
+        d['image'] = tracks.window_images(obs_length, time_to_event)
+        d['speed'] = tracks.window('speed', obs_length, time_to_event)
         return d
 
-    def get_data_sequence_balance(self, data_raw, obs_length, time_to_event, normalize):
+    def balance_tracks(self, tracks, img_width):
         """
-        Generates data sequences according to the length of the observation and time to event.
-        The number of positive and negative sequences are balanced. Add flipped version of underrepresented
-        sequences and subsamples from the overrepresented samples to match the number of samples.
-        :param dataset: The data sequences from the dataset
-        :param obs_length: Observation length
-        :param time_to_event: Time (number of frames) to event
-        :param normalize: Whether to normalize the bounding box coordinates
-        :return: Processed data sequences
+        Balances the number of positive and negative tracks. Adds flipped versions of the
+        underrepresented tracks and subsamples the overrepresented tracks to match the number of tracks.
+        :param tracks: A TrackTable
+        :param img_width: The width of the images
+        :return: The balanced TrackTable
         """
-        print('\n#####################################')
-        print('Generating balanced raw data')
-        print('#####################################')
-        d = {'center': data_raw['center'].copy(),
-             'box': data_raw['bbox'].copy(),
-             'ped_id': data_raw['pid'].copy(),
-             'acts': data_raw['activities'].copy(),
-             'image': data_raw['image'].copy()}
-
-        try:
-            d['speed'] = data_raw['obd_speed'].copy()
-        except:
-            d['speed'] = data_raw['vehicle_act'].copy()
-            print('Jaad dataset does not have speed information')
-            print('Vehicle actions are used instead')
-
-        gt_labels = [gt[0] for gt in d['acts']]
-        num_pos_samples = np.count_nonzero(np.array(gt_labels))
+        gt_labels = tracks.labels()
+        num_pos_samples = np.count_nonzero(gt_labels)
         num_neg_samples = len(gt_labels) - num_pos_samples
 
         # finds the indices of the samples with larger quantity
@@ -279,35 +249,15 @@ class PREPROCESS(object):
             else:
                 gt_augment = 0
 
-            img_width = data_raw['image_dimension'][0]
-            num_samples = len(d['ped_id'])
-            for i in range(num_samples):
-                if d['acts'][i][0][0] == gt_augment:
-                    flipped = d['center'][i].copy()
-                    flipped = [[img_width - c[0], c[1]]
-                               for c in flipped]
-                    d['center'].append(flipped)
-                    flipped = d['box'][i].copy()
-
-                    flipped = [np.array([img_width - c[2], c[1], img_width - c[0], c[3]])
-                               for c in flipped]
-                    d['box'].append(flipped)
-
-                    d['ped_id'].append(data_raw['pid'][i].copy())
-                    d['acts'].append(d['acts'][i].copy())
-                    flipped = d['image'][i].copy()
-                    flipped = [c.replace('.png', '_flip.png') for c in flipped]
-
-                    d['image'].append(flipped)
-                    if 'speed' in d.keys():
-                        d['speed'].append(d['speed'][i].copy())
-            gt_labels = [gt[0] for gt in d['acts']]
-            num_pos_samples = np.count_nonzero(np.array(gt_labels))
+            tracks = tracks.append_flipped(np.where(gt_labels == gt_augment)[0], img_width)
+
+            gt_labels = tracks.labels()
+            num_pos_samples = np.count_nonzero(gt_labels)
             num_neg_samples = len(gt_labels) - num_pos_samples
             if num_neg_samples > num_pos_samples:
-                rm_index = np.where(np.array(gt_labels) == 0)[0]
+                rm_index = np.where(gt_labels == 0)[0]
             else:
-                rm_index = np.where(np.array(gt_labels) == 1)[0]
+                rm_index = np.where(gt_labels == 1)[0]
 
             # Calculate the difference of sample counts
             dif_samples = abs(num_neg_samples - num_pos_samples)
@@ -318,48 +268,139 @@ class PREPROCESS(object):
             rm_index = rm_index[0:dif_samples]
 
             # update the data
-            for k in d:
-                seq_data_k = d[k]
-                d[k] = [seq_data_k[i] for i in range(0, len(seq_data_k)) if i not in rm_index]
+            keep = np.ones(len(tracks), dtype=bool)
+            keep[rm_index] = False
+            tracks = tracks.select(keep)
 
-            new_gt_labels = [gt[0] for gt in d['acts']]
-            num_pos_samples = np.count_nonzero(np.array(new_gt_labels))
+            num_pos_samples = np.count_nonzero(tracks.labels())
             print('Balanced:\t Positive: %d  \t Negative: %d\n'
-                  % (num_pos_samples, len(d['acts']) - num_pos_samples))
+                  % (num_pos_samples, len(tracks) - num_pos_samples))
+        return tracks
 
-        d['box_org'] = d['box'].copy()
+    def get_data_sequence_balance(self, data_raw, obs_length, time_to_event, normalize):
+        """
+        Generates data sequences according to the length of the observation and time to event.
+        The number of positive and negative sequences are balanced. Add flipped version of underrepresented
+        sequences and subsamples from the overrepresented samples to match the number of samples.
+        :param dataset: The data sequences from the dataset
+        :param obs_length: Observation length
+        :param time_to_event: Time (number of frames) to event
+        :param normalize: Whether to normalize the bounding box coordinates
+        :return: Processed data sequences
+        """
+        print('\n#####################################')
+        print('Generating balanced raw data')
+        print('#####################################')
+        with instrumentation.span('preprocessing.track_table'):
+            tracks = TrackTable.from_raw(data_raw)
+        if 'obd_speed' not in data_raw:
+            print('Jaad dataset does not have speed information')
+            print('Vehicle actions are used instead')
 
-        for i in range(len(d['box'])):
-            # d['box'][i] = d['box'][i][- obs_length - time_to_event:-time_to_event]
-            # d['center'][i] = d['center'][i][- obs_length - time_to_event:-time_to_event]
-            if normalize:
-                d['box'][i] = np.subtract(d['box'][i][1:], d['box'][i][0]).tolist()
-                d['center'][i] = np.subtract(d['center'][i][1:], d['center'][i][0]).tolist()
+        with instrumentation.span('preprocessing.balance'):
+            tracks = self.balance_tracks(tracks, data_raw['image_dimension'][0])
+
+        # Boxes and centers cover the full tracks
+        d = {'center': tracks.full('center'),
+             'box': tracks.full('box')}
         if normalize:
-            obs_length -= 1
-        for k in d.keys():
-            if k != 'box' and k != 'center':
-                for i in range(len(d[k])):
-                    d[k][i] = d[k][i][- obs_length - time_to_event:-time_to_event]
-                try:
-                    d[k] = np.array(d[k])
-                except ValueError as e:
-                    if "inhomogeneous" in str(e).lower():
-                      # Inhomogeneous shape detected, print the key and value
-                      print(d[k])   
-                 
+            if isinstance(d['box'], list):
+                d['box'] = [b[1:] - b[:1] for b in d['box']]
+                d['center'] = [c[1:] - c[:1] for c in d['center']]
             else:
-                
-                try:
-                    d[k] = np.array(d[k])
-                except ValueError as e:
-                    if "inhomogeneous" in str(e).lower():
-                      # Inhomogeneous shape detected, print the key and value
-                      print(d[k])   
-
-        d['acts'] = d['acts'][:, 0, :].copy()
+                d['box'] = d['box'][:, 1:] - d['box'][:, :1]
+                d['center'] = d['center'][:, 1:] - d['center'][:, :1]
+            obs_length -= 1
+
+        d['ped_id'] = tracks.window('ped_id', obs_length, time_to_event)
+        d['acts'] = tracks.window('acts', obs_length, time_to_event)[:, 0, :]
+        d['image'] = tracks.window_images(obs_length, time_to_event)
+        d['speed'] = tracks.window('speed', obs_length, time_to_event)
+        d['box_org'] = tracks.window('box', obs_length, time_to_event)
         return d
 
+    def get_unique_frames(self, img_sequences, bbox_sequences, ped_ids):
+        """
+        Finds the unique frames in a set of (possibly overlapping) sequences. A frame is
+        identified by its image, bounding box and pedestrian id. Flipped frames are told apart
+        by their '_flip' image names
+        :param img_sequences: Sequences of image names
+        :param bbox_sequences: Sequences of bounding boxes
+        :param ped_ids: Sequences of pedestrian ids
+        :return: A dictionary with the 'image', 'box' and 'ped_id' of the unique frames, and an
+                 array of shape (num_sequences, seq_length) with the index of each frame in it
+        """
+        first_index, frame_index = unique_frames(img_sequences, bbox_sequences, ped_ids)
+        num_frames = frame_index.size
+        frames = {'image': np.asarray(img_sequences).ravel()[first_index],
+                  'box': np.asarray(bbox_sequences).reshape(num_frames, -1)[first_index],
+                  'ped_id': np.asarray(ped_ids).reshape(num_frames, -1)[first_index]}
+        return frames, frame_index
+
+    def load_frame_features(self, frames, save_path, data_type='train'):
+        """
+        Generates the visual features of a table of unique frames
+        :param frames: A dictionary with the 'image', 'box' and 'ped_id' of each frame
+                       (see get_unique_frames())
+        :param save_path: The root folder of the feature store
+        :param data_type: Whether data is for training or testing
+        :return: Features of shape (num_frames, feature_dim)
+        """
+        # Frames are passed as a single sequence, so a corrupted image can fall back to
+        # the previous frame, which is sorted next to it
+        features = self.load_images_crop_and_process(frames['image'][np.newaxis],
+                                                     frames['box'][np.newaxis],
+                                                     frames['ped_id'][np.newaxis],
+                                                     data_type=data_type,
+                                                     save_path=save_path,
+                                                     crop_type='bbox',
+                                                     crop_mode='pad_resize',
+                                                     num_workers=self._num_workers)
+        return features[0]
+
+    def get_visual_features(self, sequences, obs_input_type, dataset, data_type='train'):
+        """
+        Generates the visual features of a set of sequences. Every unique frame is decoded,
+        cropped and processed once, and its features are held once in memory. The sequences
+        refer to the features of their frames, which are gathered per batch (see
+        input_pipeline.FeatureDataset)
+        :param sequences: A dictionary with the 'image', 'box_org' and 'ped_id' sequences
+        :param obs_input_type: The types of features to be used. Visual features are generated
+                               for 'local_box' and 'seg_box'
+        :param dataset: Name of the dataset
+        :param data_type: Whether data is for training or testing
+        :return: A dictionary of FrameSequences of shape (num_sequences, seq_length, feature_dim)
+                 over the unique frames, and an array of shape (num_sequences, seq_length) with the index of each frame
+                 into the unique frames
+        """
+        features = {}
+        frames, frame_index = self.get_unique_frames(sequences['image'],
+                                                     sequences['box_org'], sequences['ped_id'])
+        print('{} unique frames in {} sequences'.format(len(frames['image']), len(frame_index)))
+
+        # crop only bounding boxes
+        if {'local_box', 'ped_id', 'box'}.intersection(obs_input_type):
+            print('\n#####################################')
+            print('Generating local box %s' % data_type)
+            print('#####################################')
+            path_to_local_boxes, _ = get_path(save_folder='local_box',
+                                              dataset=dataset,
+                                              save_root_folder='data/features')
+            local_box = self.load_frame_features(frames, save_path=path_to_local_boxes, data_type=data_type)
+            features['local_box'] = FrameSequences(local_box, frame_index)
+
+        if 'seg_box' in obs_input_type:
+            print('\n#####################################')
+            print('Generating seg box %s' % data_type)
+            print('#####################################')
+            path_to_seg_boxes, _ = get_path(save_folder='seg_box',
+                                            dataset=dataset,
+                                            save_root_folder='data/features')
+            seg_frames = dict(frames, image=np.char.replace(frames['image'], 'images', 'seg_images'))
+            seg_box = self.load_frame_features(seg_frames, save_path=path_to_seg_boxes, data_type=data_type)
+            features['seg_box'] = FrameSequences(seg_box, frame_index)
+        return features, frame_index
+
     def get_model_opts(self, model_opts):
         default_opts =  {'obs_input_type': ['local_box', 'local_context', 'box', 'speed'],
                       'enlarge_ratio': 1.5,
@@ -367,7 +408,8 @@ class PREPROCESS(object):
                       'obs_length': 15,
                       'time_to_event': 60,
                       'dataset': 'pie',
-                      'normalize_boxes': True}
+                      'normalize_boxes': True,
+                      'balance_data': True}
         default_opts.update(model_opts)
         return default_opts
     def get_data(self, data_raw, model_opts):
@@ -378,13 +420,18 @@ class PREPROCESS(object):
                             'obs_input_type': The types of features to be used for train/test. The order
                                             in which features are named in the list defines at what level
                                             in the network the features are processed. e.g. ['local_context',
-                                            pose] would behave different to ['pose', 'local_context']
+                                            pose] would behave different to ['pose', 'local_context'].
+                                            'image' returns the image paths of the sequences
                             'enlarge_ratio': The ratio (with respect to bounding boxes) that is used for processing
                                            context surrounding pedestrians.
                             'pred_target_type': Learning target objective. Currently only supports 'crossing'
                             'obs_length': Observation length prior to reasoning
                             'time_to_event': Number of frames until the event occurs
                             'dataset': Name of the dataset
+                            'balance_data': Whether the train/val sequences are balanced by adding
+                                            flipped copies (see get_data_sequence_balance()). Set to
+                                            False to balance while sampling, with a
+                                            sampler.BalancedSampler
 
         :return: Train/Test data
         """
@@ -400,84 +447,41 @@ class PREPROCESS(object):
         data_type_keys = sorted(data_raw.keys())
 
         for k in data_type_keys:
-            if k == 'test':
-                data[k] = self.get_data_sequence(data_raw[k], obs_length, time_to_event, model_opts['normalize_boxes'])
+            if k == 'test' or not model_opts['balance_data']:
+                data[k] = self.get_data_sequence(data_raw[k], obs_length=obs_length, time_to_event=time_to_event,
+                                                 normalize=model_opts['normalize_boxes'])
             else:
-                data[k] = self.get_data_sequence_balance(data_raw[k], obs_length, time_to_event, model_opts['normalize_boxes'])
+                data[k] = self.get_data_sequence_balance(data_raw[k], obs_length=obs_length, time_to_event=time_to_event,
+                                                         normalize=model_opts['normalize_boxes'])
             data[k]['box_org'] = data[k]['box_org']
             data_type_sizes_dict['box_org'] = data[k]['box_org'].shape[1:]
             if 'speed' in data[k].keys():
                 data_type_sizes_dict['speed'] = data[k]['speed'].shape[1:]
            
         
-            # crop only bounding boxes
-            if 'local_box' in model_opts['obs_input_type']:
-                print('\n#####################################')
-                print('Generating local box %s' % k)
-                print('#####################################')
-                path_to_local_boxes, _ = get_path(save_folder='local_box',
-                                                  dataset=dataset,
-                                                  save_root_folder='data/features')
-                data[k]['local_box'] = data[k]['image']
-                data[k]['local_box'] = self.load_images_crop_and_process(data[k]['image'],
-                                                                         data[k]['box_org'], data[k]['ped_id'],
-                                                                         data_type=k,
-                                                                         save_path=path_to_local_boxes,
-                                                                         crop_type='bbox',
-                                                                         crop_mode='pad_resize')
-                data_type_sizes_dict['local_box'] = data[k]['local_box'].shape[1:]
-
-            if 'seg_box' in model_opts['obs_input_type']:
-                print('\n#####################################')
-                print('Generating seg box %s' % k)
-                print('#####################################')
-                path_to_local_boxes, _ = get_path(save_folder='seg_box',
-                                                  dataset=dataset,
-                                                  save_root_folder='data/features')
-                data[k]['seg_box'] = data[k]['image']
-                new_path = data[k]['image'].replace("images", "seg_images")
-                data[k]['seg_box'] = self.load_images_crop_and_process(new_path,
-                                                                         data[k]['box_org'], data[k]['ped_id'],
-                                                                         data_type=k,
-                                                                         save_path=path_to_local_boxes,
-                                                                         crop_type='bbox',
-                                                                         crop_mode='pad_resize')
-                data_type_sizes_dict['seg_box'] = data[k]['seg_box'].shape[1:]    
+            features, data[k]['frame_index'] = self.get_visual_features(data[k], model_opts['obs_input_type'],
+                                                                        dataset, data_type=k)
+            for feature_type, feature_sequences in features.items():
+                data[k][feature_type] = feature_sequences
+                data_type_sizes_dict[feature_type] = feature_sequences.shape[1:]
             if 'ped_id' in model_opts['obs_input_type']:
-                print('\n#####################################')
-                print('Generating local box %s' % k)
-                print('#####################################')
-                path_to_local_boxes, _ = get_path(save_folder='local_box',
-                                                  dataset=dataset,
-                                                  save_root_folder='data/features')
-                data[k]['ped_id'] = data[k]['ped_id']
-                data[k]['local_box'] = self.load_images_crop_and_process(data[k]['image'],
-                                                                         data[k]['box_org'], data[k]['ped_id'],
-                                                                         data_type=k,
-                                                                         save_path=path_to_local_boxes,
-                                                                         crop_type='bbox',
-                                                                         crop_mode='pad_resize')
-                data_type_sizes_dict['ped_id'] = data[k]['ped_id'].shape[1:]   
+                data_type_sizes_dict['ped_id'] = data[k]['ped_id'].shape[1:]
             if 'box' in model_opts['obs_input_type']:
-                
-                data[k]['box'] = data[k]['box']
-                data[k]['local_box'] = self.load_images_crop_and_process(data[k]['image'],
-                                                                         data[k]['box_org'], data[k]['ped_id'],
-                                                                         data_type=k,
-                                                                         save_path=path_to_local_boxes,
-                                                                         crop_type='bbox',
-                                                                         crop_mode='pad_resize')
-                data_type_sizes_dict['box'] = data[k]['box'].shape[1:]        
-            
+                data_type_sizes_dict['box'] = data[k]['box'].shape[1:]
             if 'speed' in model_opts['obs_input_type']:
-                data[k]['speed'] = data[k]['speed']
-                # data[k]['local_box'] = self.load_images_crop_and_process(data[k]['image'],
-                #                                                          data[k]['box_org'], data[k]['ped_id'],
-                #                                                          data_type=k,
-                #                                                          save_path=path_to_local_boxes,
-                #                                                          crop_type='bbox',
-                #                                                          crop_mode='pad_resize')
                 data_type_sizes_dict['speed'] = data[k]['speed'].shape[1:]
+            # image paths for models that read the raw frames (see input_pipeline.py)
+            if 'image' in model_opts['obs_input_type']:
+                data_type_sizes_dict['image'] = data[k]['image'].shape[1:]
+        return self._assemble_data(data, model_opts['obs_input_type'], data_type_sizes_dict)
+
+ 
+
+    def _assemble_data(self, data, obs_input_type, data_type_sizes_dict):
+        """
+        Collects the data sequences of each data split in the order of obs_input_type
+        :return: The data of each split as ([sequences], labels), the data types and their sizes
+        """
         # Create a empty dict for storing the data
         train_test_data = {}
         data_final_keys = sorted(data.keys())
@@ -488,7 +492,7 @@ class PREPROCESS(object):
         data_sizes = []
         data_types = []
 
-        for d_type in model_opts['obs_input_type']:
+        for d_type in obs_input_type:
             for k in data.keys():
                 train_test_data[k].append(data[k][d_type])
             data_sizes.append(data_type_sizes_dict[d_type])
@@ -500,4 +504,82 @@ class PREPROCESS(object):
 
         return train_test_data, data_types, data_sizes
 
- 
+    def get_track_data(self, data_raw, model_opts, track_length=None, save_path=None):
+        """
+        Generates the data sequences and visual features of the last track_length frames of
+        every track. Any observation length, time to event and box normalization can then be
+        selected with get_window_data() without regenerating the data. Balancing does not depend
+        on the window, so train/val tracks are balanced here as in get_data()
+        :param data_raw: The sequences received from the dataset interface
+        :param model_opts: Model options (see get_data()). Only 'obs_input_type', 'dataset' and
+                           'balance_data' are used
+        :param track_length: The number of frames kept at the end of each track. Defaults to the
+                             length of the shortest track, i.e. min_track_size of the dataset
+        :param save_path: If given, the track data of each split is saved to and, in later
+                          calls, memory mapped from <save_path>/<split>/<config id>, where the id is
+                          the hash of the sequences of the split and of all options that affect the
+                          track data. The configuration is recorded in the folder's manifest.json,
+                          which is written last, so track data that was not completely saved is
+                          generated again
+        :return: A dictionary of TrackWindows per data split
+        """
+        model_opts = self.get_model_opts(model_opts)
+        track_data = {}
+        for k in sorted(data_raw.keys()):
+            split_path = None
+            if save_path is not None:
+                config = {'split': k,
+                          'data': raw_fingerprint(data_raw[k]),
+                          'obs_input_type': sorted(model_opts['obs_input_type']),
+                          'dataset': model_opts['dataset'],
+                          'balance_data': k != 'test' and model_opts['balance_data'],
+                          'track_length': None if track_length is None else int(track_length),
+                          'features': feature_config('efficientnetb4', 'bbox', 'pad_resize',
+                                                     global_pooling=self._global_pooling)}
+                split_path = os.path.join(save_path, k, config_id(config))
+                manifest_path = os.path.join(split_path, 'manifest.json')
+                if os.path.exists(manifest_path):
+                    with open(manifest_path, 'r') as fid:
+                        manifest = json.load(fid)
+                    if manifest.get('config') == config:
+                        print('Loading track data from {}'.format(split_path))
+                        track_data[k] = TrackWindows.load(split_path)
+                        continue
+
+            print('\n#####################################')
+            print('Generating track data %s' % k)
+            print('#####################################')
+            tracks = TrackTable.from_raw(data_raw[k])
+            if k != 'test' and model_opts['balance_data']:
+                tracks = self.balance_tracks(tracks, data_raw[k]['image_dimension'][0])
+            windows = TrackWindows.from_table(tracks, track_length)
+            sequences = {'image': windows.columns['image'],
+                         'box_org': windows.columns['box'],
+                         'ped_id': windows.columns['ped_id']}
+            features, _ = self.get_visual_features(sequences, model_opts['obs_input_type'],
+                                                   model_opts['dataset'], data_type=k)
+            windows.columns.update(features)
+            if split_path is not None:
+                windows.save(split_path)
+                with open(os.path.join(split_path, 'manifest.json'), 'w') as fid:
+                    json.dump({'config_id': config_id(config), 'config': config}, fid, indent=2, sort_keys=True)
+            track_data[k] = windows
+        return track_data
+
+    def get_window_data(self, track_data, model_opts):
+        """
+        Generates train/test data from the track data of get_track_data(). The sequences are
+        views of the track data, except for normalized boxes and centers
+        :param track_data: A dictionary of TrackWindows per data split
+        :param model_opts: Model options (see get_data())
+        :return: Train/Test data, in the format of get_data()
+        """
+        model_opts = self.get_model_opts(model_opts)
+        data = {}
+        data_type_sizes_dict = {}
+        for k in sorted(track_data.keys()):
+            data[k] = track_data[k].sequences(model_opts['obs_length'], model_opts['time_to_event'],
+                                              model_opts['normalize_boxes'])
+            for d_type in model_opts['obs_input_type']:
+                data_type_sizes_dict[d_type] = data[k][d_type].shape[1:]
+        return self._assemble_data(data, model_opts['obs_input_type'], data_type_sizes_dict)
@@ -0,0 +1,93 @@
+
+import numpy as np
+
+
+class BalancedSampler(object):
+    """
+    Draws class balanced epochs as indices into the original samples, instead of materializing
+    balanced copies of the data. Samples of the underrepresented classes can also be drawn
+    horizontally flipped, which is marked by a flip bit per drawn index and applied when the
+    sample is loaded. This replaces the flipped '_flip.png' copies of get_data_sequence_balance().
+
+    The candidates of a class are its samples, plus their flipped versions if the class is
+    smaller than the largest class and flip is enabled. Every epoch draws the same number of
+    candidates from each class, the size of the smallest candidate set, in one of the modes:
+        exact: Candidates are drawn without replacement. Each class is drawn from a shuffled
+               order that continues across epochs, so all samples of the larger classes are
+               used equally often
+        weighted: Candidates are drawn with replacement, with the probability of each class
+                  inversely proportional to its number of candidates
+
+    Attributes:
+        labels: The label of each sample
+        mode: 'exact' or 'weighted'
+        flip: Whether samples of the underrepresented classes are also drawn flipped
+        seed: The random seed
+
+    Methods:
+        flippable: Returns the indices of the samples that can be drawn flipped
+        sample_epoch: Draws the samples of the next epoch
+    """
+    def __init__(self, labels, mode='exact', flip=True, seed=42):
+        """
+        :param labels: The label of each sample, of shape (num_samples,) or (num_samples, 1)
+        :param mode: 'exact' or 'weighted'
+        :param flip: Whether samples of the underrepresented classes are also drawn flipped
+        :param seed: The random seed
+        """
+        assert mode in ['exact', 'weighted'], 'Sampling mode {} is invalid'.format(mode)
+        self.labels = np.asarray(labels).reshape(-1)
+        self.mode = mode
+        self.flip = flip
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+
+        classes, counts = np.unique(self.labels, return_counts=True)
+        self._candidates = []
+        for c, count in zip(classes, counts):
+            index = np.where(self.labels == c)[0]
+            flips = np.zeros(len(index), dtype=bool)
+            if flip and count < counts.max():
+                index = np.concatenate([index, index])
+                flips = np.concatenate([flips, np.ones(len(flips), dtype=bool)])
+            self._candidates.append((index, flips))
+        self._samples_per_class = min(len(index) for index, _ in self._candidates)
+        self._orders = [np.empty(0, dtype=np.int64) for _ in self._candidates]
+
+    def __len__(self):
+        return self._samples_per_class * len(self._candidates)
+
+    def flippable(self):
+        """
+        Returns the indices of the samples that can be drawn flipped
+        :return: An array of sample indices
+        """
+        return np.unique(np.concatenate([index[flips] for index, flips in self._candidates]))
+
+    def _draw_exact(self, c):
+        # Takes the next candidates of the class from its shuffled order. When the order runs
+        # out, the epoch is filled from a new order, skipping the candidates already drawn
+        drawn, self._orders[c] = self._orders[c][:self._samples_per_class], self._orders[c][self._samples_per_class:]
+        if len(drawn) < self._samples_per_class:
+            order = self._rng.permutation(len(self._candidates[c][0]))
+            fill = np.where(~np.isin(order, drawn))[0][:self._samples_per_class - len(drawn)]
+            drawn = np.concatenate([drawn, order[fill]])
+            self._orders[c] = np.delete(order, fill)
+        return drawn
+
+    def sample_epoch(self):
+        """
+        Draws the samples of the next epoch
+        :return: The sample indices and the flip bits of the epoch, each of shape (len(self),),
+                 in random order
+        """
+        indices, flips = [], []
+        for c, (index, flip) in enumerate(self._candidates):
+            if self.mode == 'exact':
+                drawn = self._draw_exact(c)
+            else:
+                drawn = self._rng.integers(0, len(index), self._samples_per_class)
+            indices.append(index[drawn])
+            flips.append(flip[drawn])
+        order = self._rng.permutation(len(self))
+        return np.concatenate(indices)[order], np.concatenate(flips)[order]
@@ -0,0 +1,210 @@
+
+import os
+import json
+import pickle
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from utils import update_progress
+from feature_store import source_fingerprint
+from input_pipeline import load_mask
+import instrumentation
+
+# Labels are stored as uint8
+MAX_LABELS = 256
+
+
+def _pack_colors(colors):
+    # Packs uint8 RGB colors of shape (..., 3) into int32 codes
+    colors = colors.astype(np.int32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+
+def _unpack_colors(codes):
+    codes = np.asarray(codes, dtype=np.int32)
+    return np.stack([(codes >> 16) & 255, (codes >> 8) & 255, codes & 255], axis=-1).astype(np.uint8)
+
+
+def _encode_mask(args):
+    # Reads a segmentation map at the model resolution and encodes it with its own colors. The
+    # colors are mapped to the labels of the store by the calling process
+    path, size = args
+    mask = load_mask(path, size)
+    with instrumentation.span('seg_store.encode'):
+        codes, labels = np.unique(_pack_colors(mask).ravel(), return_inverse=True)
+    if len(codes) > MAX_LABELS:
+        raise ValueError('The segmentation map of {} has {} colors, more than {}'.format(path, len(codes), MAX_LABELS))
+    return codes, labels.reshape(size, size).astype(np.uint8)
+
+
+class SegmentationStore(object):
+    """
+    A packed archive of the segmentation maps of a set of frames at the model resolution.
+    Segmentation maps are color-coded class images with few colors, so every map is stored as a
+    single-channel uint8 image of labels into a shared palette of colors. The labels of all
+    frames are kept in one memory mapped array (<root>/labels.npy) of shape
+    (num_frames, size, size), together with the palette (<root>/palette.npy) and a manifest
+    with the image path and the source fingerprint of every frame (<root>/manifest.json).
+
+    A map is a third of the size of the RGB map and is read without decoding an image. The
+    labels are expanded to RGB by a palette lookup (see decode()), which gives exactly the maps
+    of input_pipeline.load_mask(). Label 0 is always black, the color of the areas outside of
+    rotated frames in augmentation. Paths with '_flip' refer to the flipped segmentation map.
+
+    Attributes:
+        root: The folder of the archive
+        size: The size of the segmentation maps
+        palette: The colors of the labels, of shape (num_labels, 3)
+
+    Methods:
+        build: Converts the segmentation maps of a set of frames into an archive
+        rows: Returns the rows of a set of frames
+        labels: Returns the labels of a frame
+        decode: Expands labels to RGB segmentation maps
+    """
+    def __init__(self, root):
+        """
+        Opens an archive created with build()
+        :param root: The folder of the archive
+        """
+        self.root = root
+        with open(os.path.join(root, 'manifest.json'), 'r') as fid:
+            manifest = json.load(fid)
+        self.size = manifest['size']
+        self._paths = manifest['paths']
+        self._fingerprints = manifest['fingerprints']
+        self._rows = {path: row for row, path in enumerate(self._paths)}
+        self.palette = np.load(os.path.join(root, 'palette.npy'))
+        self._labels = np.load(os.path.join(root, 'labels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._paths)
+
+    @classmethod
+    def build(cls, root, images, size=224, num_workers=0):
+        """
+        Converts the segmentation maps of a set of frames into an archive. Frames that are already
+        in the archive at root and whose segmentation map has not changed are not converted again
+        :param root: The folder of the archive
+        :param images: The paths to the RGB images of the frames, e.g. the image sequences of
+                       PREPROCESS.get_data(). The segmentation maps are read from 'seg_images'
+        :param size: The size of the segmentation maps, i.e. the model input size
+        :param num_workers: The number of processes used to read the segmentation maps. 0 reads
+                            them in the calling process
+        :return: A SegmentationStore
+        """
+        paths = np.unique(np.asarray(images).ravel()).tolist()
+        folder_stats = {}
+        fingerprints = [source_fingerprint(path.replace('images', 'seg_images'), folder_stats=folder_stats)
+                        for path in paths]
+
+        existing = None
+        if os.path.exists(os.path.join(root, 'manifest.json')):
+            existing = cls(root)
+            if existing.size != size:
+                existing = None
+        # Label 0 is black
+        palette = [0] if existing is None else _pack_colors(existing.palette).tolist()
+        palette_labels = {code: label for label, code in enumerate(palette)}
+
+        if not os.path.exists(root):
+            os.makedirs(root)
+        labels = np.lib.format.open_memmap(os.path.join(root, 'labels.npy.tmp'), mode='w+',
+                                           dtype=np.uint8, shape=(len(paths), size, size))
+        tasks = []
+        task_rows = []
+        for row, (path, fingerprint) in enumerate(zip(paths, fingerprints)):
+            if existing is not None and path in existing._rows and \
+                    existing._fingerprints[existing._rows[path]] == fingerprint:
+                labels[row] = existing._labels[existing._rows[path]]
+                continue
+            tasks.append((path, size))
+            task_rows.append(row)
+        print('Converting {} segmentation maps ({} kept)'.format(len(tasks), len(paths) - len(tasks)))
+
+        # Forking a process with initialized TensorFlow thread pools can deadlock the children
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        pool = context.Pool(num_workers) if num_workers > 0 and tasks else None
+        try:
+            results = pool.imap(_encode_mask, tasks, chunksize=8) if pool else map(_encode_mask, tasks)
+            for i, (row, (codes, frame_labels)) in enumerate(zip(task_rows, results)):
+                update = [c for c in codes.tolist() if c not in palette_labels]
+                if len(palette) + len(update) > MAX_LABELS:
+                    raise ValueError('The segmentation maps have more than {} colors'.format(MAX_LABELS))
+                for code in update:
+                    palette_labels[code] = len(palette)
+                    palette.append(code)
+                lookup = np.array([palette_labels[c] for c in codes.tolist()], dtype=np.uint8)
+                labels[row] = lookup[frame_labels]
+                update_progress(i / max(len(tasks), 1))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        labels.flush()
+        del labels
+        update_progress(1)
+
+        # The labels of the previous archive are no longer read once the new archive replaces it
+        del existing
+        np.save(os.path.join(root, 'palette.npy'), _unpack_colors(palette))
+        os.replace(os.path.join(root, 'labels.npy.tmp'), os.path.join(root, 'labels.npy'))
+        with open(os.path.join(root, 'manifest.json'), 'w') as fid:
+            json.dump({'size': size, 'paths': paths, 'fingerprints': fingerprints}, fid)
+        store = cls(root)
+        print('\nStored {} segmentation maps with {} labels in {} ({:.1f}MB)'.format(
+            len(store), len(store.palette), root, store._labels.nbytes / 2 ** 20))
+        return store
+
+    def rows(self, images):
+        """
+        Returns the rows of a set of frames
+        :param images: The paths to the RGB images of the frames
+        :return: The row of each frame in the archive, of the shape of images
+        """
+        images = np.asarray(images)
+        rows = np.empty(images.size, dtype=np.int64)
+        for i, path in enumerate(images.ravel().tolist()):
+            row = self._rows.get(path)
+            if row is None:
+                raise KeyError('The segmentation map of {} is not in {}. Add it with '
+                               'SegmentationStore.build()'.format(path, self.root))
+            rows[i] = row
+        return rows.reshape(images.shape)
+
+    def labels(self, row):
+        """
+        Returns the labels of a frame
+        :param row: The row of the frame (see rows())
+        :return: The labels as a uint8 array of shape (size, size)
+        """
+        with instrumentation.span('seg_store.read'):
+            return np.array(self._labels[row])
+
+    def decode(self, labels):
+        """
+        Expands labels to RGB segmentation maps
+        :param labels: Labels of any shape
+        :return: The segmentation maps as uint8 arrays of shape labels.shape + (3,)
+        """
+        return self.palette[labels]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the segmentation maps of a data split into a '
+                                                 'SegmentationStore')
+    parser.add_argument('data', help='Training and validation data saved with distributed.save_data(), i.e. a '
+                                     'pickle of {split: (x, y)} in the format of PREPROCESS.get_data(), with the '
+                                     'image paths in x[0]. The CLI follows that format')
+    parser.add_argument('output', help='The root folder of the stores, one per split')
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--num_workers', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.data, 'rb') as fid:
+        data = pickle.load(fid)
+    for split, (x, _) in data.items():
+        SegmentationStore.build(os.path.join(args.output, split), x[0], size=args.size, num_workers=args.num_workers)
@@ -0,0 +1,335 @@
+
+import os
+
+import numpy as np
+
+
+def _stack_tracks(tracks, lengths):
+    """
+    Stacks per-track sequences of different lengths into a dense array padded at the end
+    :param tracks: A list of per-track sequences
+    :param lengths: The length of each track
+    :return: An array of shape (num_tracks, max_length, ...)
+    """
+    flat = np.concatenate([np.asarray(t) for t in tracks])
+    stacked = np.zeros((len(tracks), lengths.max()) + flat.shape[1:], dtype=flat.dtype)
+    stacked[np.arange(lengths.max()) < lengths[:, np.newaxis]] = flat
+    return stacked
+
+
+def unique_frames(img_sequences, *frame_values):
+    """
+    Finds the unique frames in a set of sequences
+    :param img_sequences: Sequences of image names of shape (num_sequences, seq_length)
+    :param frame_values: Other per-frame values that identify a frame, e.g. bounding boxes,
+                         each of shape (num_sequences, seq_length, ...)
+    :return: The flat index of the first occurrence of each unique frame, and an array of
+             shape (num_sequences, seq_length) with the index of each frame into the unique frames
+    """
+    images = np.asarray(img_sequences)
+    num_frames = images.size
+    _, codes = np.unique(images.ravel(), return_inverse=True)
+    frame_codes = [codes.ravel()]
+    for values in frame_values:
+        _, codes = np.unique(np.asarray(values).reshape(num_frames, -1), axis=0, return_inverse=True)
+        frame_codes.append(codes.ravel())
+    _, first_index, frame_index = np.unique(np.stack(frame_codes, axis=1), axis=0,
+                                            return_index=True, return_inverse=True)
+    return first_index, frame_index.reshape(images.shape[:2])
+
+
+class FrameSequences(object):
+    """
+    Sequences of per-frame values kept as a table of the values of the unique frames and the
+    index of every frame of every sequence into the table, so frames shared by overlapping
+    sequences are held once. Indexing selects sequences and frames of the index and does not
+    copy the table. The dense sequences are gathered by numpy.asarray(), e.g. per batch.
+
+    Attributes:
+        table: The values of the unique frames, of shape (num_frames, ...)
+        index: The index of each frame into the table, of shape (num_sequences, seq_length)
+    """
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def shape(self):
+        return self.index.shape + self.table.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.table.dtype
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+        return FrameSequences(self.table, self.index[item])
+
+    def __array__(self, dtype=None):
+        values = self.table[self.index]
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+
+def window_index(lengths, obs_length, time_to_event):
+    """
+    Computes the frame indices of the [-obs_length - time_to_event:-time_to_event] window of each
+    track, following Python's slicing rules
+    :param lengths: The length of each track
+    :param obs_length: Observation length
+    :param time_to_event: Time (number of frames) to event
+    :return: An array of shape (num_tracks, window_length)
+    """
+    start = np.maximum(lengths - obs_length - time_to_event, 0)
+    if time_to_event > 0:
+        stop = np.maximum(lengths - time_to_event, 0)
+    else:
+        # [-n:-0] is an empty slice
+        stop = np.zeros_like(lengths)
+    window_lengths = np.maximum(stop - start, 0)
+    if np.any(window_lengths != window_lengths[0]):
+        raise ValueError('Tracks of lengths {}-{} are too short for obs_length={} time_to_event={}'.format(
+            lengths.min(), lengths.max(), obs_length, time_to_event))
+    return start[:, np.newaxis] + np.arange(window_lengths[0])
+
+
+class TrackTable(object):
+    """
+    A columnar representation of the track sequences returned by the dataset interface.
+    Per-frame values are kept in dense arrays of shape (num_tracks, max_track_length, ...),
+    padded at the end, along with the length of each track. Image names are integer-coded
+    into a table of unique paths.
+
+    Attributes:
+        columns: A dictionary of per-frame arrays ('center', 'box', 'ped_id', 'acts', 'speed')
+        lengths: The length of each track
+        image_table: The unique image paths
+        image_codes: The index of each frame's image in image_table, -1 for padding
+
+    Methods:
+        from_raw: Creates a table from the data sequences of the dataset interface
+        labels: Returns the label of each track
+        select: Returns a table with a subset of the tracks
+        append_flipped: Returns a table with horizontally flipped copies of some tracks appended
+        full: Returns the full tracks of a column
+        window: Returns a fixed-length window of every track of a column
+        window_images: Returns a fixed-length window of image paths of every track
+    """
+    def __init__(self, columns, lengths, image_table, image_codes):
+        self.columns = columns
+        self.lengths = lengths
+        self.image_table = image_table
+        self.image_codes = image_codes
+
+    @classmethod
+    def from_raw(cls, data_raw):
+        """
+        Creates a table from the data sequences of the dataset interface
+        :param data_raw: The data sequences from the dataset. Uses 'obd_speed' for speed if
+                         available and 'vehicle_act' otherwise
+        :return: A TrackTable
+        """
+        lengths = np.array([len(t) for t in data_raw['bbox']])
+        raw_keys = {'center': 'center', 'box': 'bbox', 'ped_id': 'pid', 'acts': 'activities',
+                    'speed': 'obd_speed' if 'obd_speed' in data_raw else 'vehicle_act'}
+        columns = {k: _stack_tracks(data_raw[raw_k], lengths) for k, raw_k in raw_keys.items()}
+
+        image_table, codes = np.unique(np.concatenate(data_raw['image']), return_inverse=True)
+        image_codes = np.full((len(lengths), lengths.max()), -1, dtype=np.int64)
+        image_codes[np.arange(lengths.max()) < lengths[:, np.newaxis]] = codes.ravel()
+        return cls(columns, lengths, image_table, image_codes)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def labels(self):
+        """
+        Returns the label of each track, i.e. the activity of its first frame
+        :return: An array of shape (num_tracks,)
+        """
+        return self.columns['acts'][:, 0, 0]
+
+    def select(self, index):
+        """
+        Selects a subset of the tracks
+        :param index: An index or boolean mask over the tracks
+        :return: A TrackTable
+        """
+        return TrackTable({k: v[index] for k, v in self.columns.items()},
+                          self.lengths[index], self.image_table, self.image_codes[index])
+
+    def append_flipped(self, index, img_width):
+        """
+        Appends horizontally flipped copies of tracks. Flipped frames refer to '_flip.png' versions
+        of the original images
+        :param index: The indices of the tracks to flip
+        :param img_width: The width of the images
+        :return: A TrackTable
+        """
+        flipped = {k: v[index].copy() for k, v in self.columns.items()}
+        flipped['center'][..., 0] = img_width - flipped['center'][..., 0]
+        flipped['box'][..., [0, 2]] = img_width - self.columns['box'][index][..., [2, 0]]
+
+        # Flipped images are coded into a second copy of the image table
+        num_images = len(self.image_table)
+        image_table = np.concatenate([self.image_table,
+                                      np.char.replace(self.image_table, '.png', '_flip.png')])
+        flipped_codes = self.image_codes[index]
+        flipped_codes = np.where(flipped_codes >= 0, flipped_codes + num_images, -1)
+
+        columns = {k: np.concatenate([v, flipped[k]]) for k, v in self.columns.items()}
+        return TrackTable(columns, np.concatenate([self.lengths, self.lengths[index]]),
+                          image_table, np.concatenate([self.image_codes, flipped_codes]))
+
+    def full(self, key):
+        """
+        Returns the full tracks of a column
+        :param key: The name of the column
+        :return: An array of shape (num_tracks, track_length, ...) if all tracks have the same length,
+                 otherwise a list of per-track arrays
+        """
+        column = self.columns[key]
+        if np.all(self.lengths == self.lengths[0]):
+            return column[:, :self.lengths[0]]
+        return [column[i, :n] for i, n in enumerate(self.lengths)]
+
+    def window(self, key, obs_length, time_to_event):
+        """
+        Returns the [-obs_length - time_to_event:-time_to_event] window of every track of a column
+        :param key: The name of the column
+        :param obs_length: Observation length
+        :param time_to_event: Time (number of frames) to event
+        :return: An array of shape (num_tracks, window_length, ...)
+        """
+        index = window_index(self.lengths, obs_length, time_to_event)
+        return self.columns[key][np.arange(len(self))[:, np.newaxis], index]
+
+    def window_images(self, obs_length, time_to_event):
+        """
+        Returns the [-obs_length - time_to_event:-time_to_event] window of image paths of every track
+        :param obs_length: Observation length
+        :param time_to_event: Time (number of frames) to event
+        :return: An array of shape (num_tracks, window_length)
+        """
+        index = window_index(self.lengths, obs_length, time_to_event)
+        return self.image_table[self.image_codes[np.arange(len(self))[:, np.newaxis], index]]
+
+
+class TrackWindows(object):
+    """
+    The last track_length frames of a set of tracks, with all per-frame values in dense arrays
+    of shape (num_tracks, track_length, ...), and visual features as FrameSequences over the
+    unique frames. As all tracks have the same length, the
+    [-obs_length - time_to_event:-time_to_event] window of a column is a basic slice, i.e. a view
+    that does not copy the data. Observation length and time to
+    event can be changed without regenerating the tracks or their features.
+
+    Attributes:
+        columns: A dictionary of per-frame arrays ('center', 'box', 'ped_id', 'acts', 'speed',
+                 'image' and visual features)
+
+    Methods:
+        from_table: Creates the windows from a TrackTable
+        window: Returns a view of a fixed-length window of a column
+        sequences: Returns the data sequences of a window
+        save: Saves the columns to a folder
+        load: Loads the columns from a folder, optionally memory mapped
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_table(cls, tracks, track_length=None):
+        """
+        Creates the windows from a TrackTable
+        :param tracks: A TrackTable
+        :param track_length: The number of frames kept at the end of each track. Defaults to the
+                             length of the shortest track, i.e. min_track_size of the dataset
+        :return: A TrackWindows
+        """
+        if track_length is None:
+            track_length = tracks.lengths.min()
+        if track_length > tracks.lengths.min():
+            raise ValueError('track_length {} is longer than the shortest track ({})'.format(
+                track_length, tracks.lengths.min()))
+        index = (tracks.lengths - track_length)[:, np.newaxis] + np.arange(track_length)
+        rows = np.arange(len(tracks))[:, np.newaxis]
+        columns = {k: v[rows, index] for k, v in tracks.columns.items()}
+        columns['image'] = tracks.image_table[tracks.image_codes[rows, index]]
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns['box'])
+
+    @property
+    def track_length(self):
+        return self.columns['box'].shape[1]
+
+    def window(self, key, obs_length, time_to_event):
+        """
+        Returns the [-obs_length - time_to_event:-time_to_event] window of a column. Unlike
+        the slice, time_to_event=0 returns the last obs_length frames
+        :param key: The name of the column
+        :param obs_length: Observation length
+        :param time_to_event: Time (number of frames) to event
+        :return: A view of shape (num_tracks, obs_length, ...)
+        """
+        start = self.track_length - obs_length - time_to_event
+        if start < 0 or time_to_event < 0:
+            raise ValueError('Tracks of length {} are too short for obs_length={} time_to_event={}'.format(
+                self.track_length, obs_length, time_to_event))
+        return self.columns[key][:, start:start + obs_length]
+
+    def sequences(self, obs_length, time_to_event, normalize):
+        """
+        Returns the data sequences of a window, as PREPROCESS.get_data_sequence() does
+        :param obs_length: Observation length
+        :param time_to_event: Time (number of frames) to event
+        :param normalize: Whether to normalize the bounding box coordinates
+        :return: A dictionary of data sequences. All sequences except normalized boxes and centers
+                 are views of the columns
+        """
+        d = {'center': self.window('center', obs_length, time_to_event),
+             'box': self.window('box', obs_length, time_to_event)}
+        if normalize:
+            d['box'] = d['box'][:, 1:] - d['box'][:, :1]
+            d['center'] = d['center'][:, 1:] - d['center'][:, :1]
+            obs_length -= 1
+
+        for key in self.columns:
+            if key not in ['center', 'box']:
+                d[key] = self.window(key, obs_length, time_to_event)
+        d['box_org'] = self.window('box', obs_length, time_to_event)
+        d['acts'] = d['acts'][:, 0, :]
+        return d
+
+    def save(self, path):
+        """
+        Saves the columns to a folder, one .npy file per column, or a '.table.npy' and an
+        '.index.npy' file per FrameSequences column
+        :param path: The folder
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for key, values in self.columns.items():
+            if isinstance(values, FrameSequences):
+                np.save(os.path.join(path, key + '.table.npy'), values.table)
+                np.save(os.path.join(path, key + '.index.npy'), values.index)
+            else:
+                np.save(os.path.join(path, key + '.npy'), values)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Loads the columns from a folder
+        :param path: The folder
+        :param mmap_mode: The memory map mode of the columns (see numpy.load()). None reads the
+                          columns into memory
+        :return: A TrackWindows
+        """
+        columns = {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+                   for f in sorted(os.listdir(path)) if f.endswith('.npy')}
+        for key in [k[:-len('.table')] for k in columns if k.endswith('.table')]:
+            columns[key] = FrameSequences(columns.pop(key + '.table'), columns.pop(key + '.index'))
+        return cls(columns)
@@ -0,0 +1,241 @@
+
+import tensorflow as tf
+from tensorflow import keras
+
+import instrumentation
+from intentformer import Custom_CE_Loss, generic_rnn_kernels
+
+HEADS = ['rgb_o', 'seg_o', 'traj_o']
+
+
+class Trainer(object):
+    """
+    A training loop for IntentFormer with the composite CAC loss of the three heads,
+        loss = w1 * CE(rgb_o) + w2 * CE(seg_o) + w3 * CE(traj_o) + regularization losses
+    computed by Custom_CE_Loss inside the compiled train step.
+
+    Train steps can be compiled with XLA (jit_compile). On CPU, the oneDNN kernels of the
+    uncompiled graph are faster than XLA's, so XLA is only used by default when a GPU is
+    available.
+
+    For mixed precision, set the policy before the model is built, e.g.
+    keras.mixed_precision.set_global_policy('mixed_bfloat16'). Weights, gradients and the
+    optimizer stay in float32 and the heads and the loss compute in float32, so bfloat16, which
+    has the range of float32, needs no loss scaling.
+
+    With accumulation_steps > 1, the gradients of accumulation_steps batches are averaged before
+    the weights are updated. The effective batch size is then batch_size * accumulation_steps,
+    while memory stays that of a single batch.
+
+    Under a tf.distribute strategy, e.g. the MultiWorkerMirroredStrategy of distributed.py, the
+    steps run on every replica and the gradients are all-reduced. Build the model and create the
+    optimizer in strategy.scope(), and pass distributed datasets of per-replica batches.
+
+    fit() takes keras callbacks, e.g. ModelCheckpoint, LearningRateScheduler, ReduceLROnPlateau
+    and EarlyStopping, and logs the loss and the accuracy of each head ('loss', 'traj_o_accuracy',
+    'val_traj_o_accuracy', ...) like model.fit().
+
+    Attributes:
+        model: The IntentFormer model (see build_intentformer())
+        optimizer: The keras optimizer
+        loss: The Custom_CE_Loss layer holding the head weights w1, w2 and w3
+        accumulation_steps: The number of batches per weight update
+
+    Methods:
+        train_step: Runs a training step on a batch
+        test_step: Evaluates a batch
+        fit: Trains the model
+        evaluate: Evaluates the model on a dataset
+    """
+    def __init__(self, model, optimizer, accumulation_steps=1, jit_compile=None, train_loss_weights=False):
+        """
+        :param model: The IntentFormer model
+        :param optimizer: The keras optimizer
+        :param accumulation_steps: The number of batches whose gradients are averaged per update
+        :param jit_compile: Whether the steps are compiled with XLA. Defaults to True if a GPU is
+                            available
+        :param train_loss_weights: Whether the head weights w1, w2 and w3 of the loss are trained.
+                                   The gradient of the loss with respect to a head weight is the
+                                   (positive) loss of the head, so trained weights keep decreasing.
+                                   By default the weights are fixed at 0.2, 0.3 and 0.5
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        if jit_compile is None:
+            jit_compile = len(tf.config.list_physical_devices('GPU')) > 0
+        # The distribution strategy the model was built in, or the default strategy
+        self._strategy = model.distribute_strategy
+        with self._strategy.scope():
+            # The loss computes in float32 regardless of the global policy
+            self.loss = Custom_CE_Loss(dtype='float32', trainable=train_loss_weights)
+            # Attaches the optimizer to the model, which callbacks such as LearningRateScheduler
+            # use. The per-head cross entropy lets saved checkpoints be evaluated with
+            # model.evaluate()
+            self.model.compile(optimizer=optimizer, loss=keras.losses.SparseCategoricalCrossentropy(),
+                               metrics=[keras.metrics.SparseCategoricalAccuracy(name='accuracy')])
+
+            self._variables = self.model.trainable_variables + self.loss.trainable_variables
+            # Variables without a gradient, e.g. the feature embedding of a video model, are not
+            # updated. Set when the train step is traced
+            self._has_gradient = None
+            # Gradients are accumulated per replica and all-reduced when they are applied
+            self._num_accumulated = 0
+            if accumulation_steps > 1:
+                self._gradients = [tf.Variable(tf.zeros_like(v), trainable=False,
+                                               synchronization=tf.VariableSynchronization.ON_READ,
+                                               aggregation=tf.VariableAggregation.SUM) for v in self._variables]
+
+            self._metrics = [keras.metrics.Mean(name='loss')] + \
+                            [keras.metrics.SparseCategoricalAccuracy(name=head + '_accuracy') for head in HEADS]
+
+        # XLA compiles the forward and backward pass of a replica. The gradient all-reduce and the
+        # update run outside of it
+        self._compute_gradients = tf.function(self._compute_gradients_fn, jit_compile=jit_compile)
+        self._evaluate = tf.function(self._evaluate_fn, jit_compile=jit_compile)
+        self._train_step = tf.function(self._train_step_fn)
+        self._apply_gradients = tf.function(self._apply_gradients_fn)
+        self._test_step = tf.function(self._test_step_fn)
+
+    def _forward(self, inputs, target, training):
+        outputs = self.model(inputs, training=training)
+        outputs = [tf.cast(o, tf.float32) for o in outputs]
+        loss = self.loss(target, *outputs)
+        if self.model.losses:
+            loss += tf.add_n([tf.cast(l, tf.float32) for l in self.model.losses])
+        for metric in self._metrics[1:]:
+            metric.update_state(target, outputs[HEADS.index(metric.name[:-len('_accuracy')])])
+        self._metrics[0].update_state(loss)
+        return loss
+
+    def _compute_gradients_fn(self, inputs, target):
+        # Runs when the step is traced
+        with generic_rnn_kernels(self.model), tf.GradientTape() as tape:
+            loss = self._forward(inputs, target, training=True)
+            # The gradients of the replicas are summed, so the loss of a replica is scaled to
+            # give the gradient of the mean loss over the global batch
+            scaled_loss = loss / self._strategy.num_replicas_in_sync
+        return loss, tape.gradient(scaled_loss, self._variables)
+
+    def _replica_train_step(self, inputs, target):
+        loss, gradients = self._compute_gradients(inputs, target)
+        self._has_gradient = [g is not None for g in gradients]
+        if self.accumulation_steps == 1:
+            self.optimizer.apply_gradients([(g, v) for g, v in zip(gradients, self._variables) if g is not None])
+            return loss
+        for accumulated, g in zip(self._gradients, gradients):
+            if g is not None:
+                accumulated.assign_add(g)
+        return loss
+
+    def _train_step_fn(self, inputs, target):
+        loss = self._strategy.run(self._replica_train_step, args=(inputs, target))
+        return self._strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+
+    def _replica_apply_gradients(self, num_accumulated):
+        self.optimizer.apply_gradients([(g / num_accumulated, v)
+                                        for g, v, has_gradient in zip(self._gradients, self._variables,
+                                                                      self._has_gradient) if has_gradient])
+        for accumulated in self._gradients:
+            accumulated.assign(tf.zeros_like(accumulated))
+
+    def _apply_gradients_fn(self, num_accumulated):
+        self._strategy.run(self._replica_apply_gradients, args=(num_accumulated,))
+
+    def _evaluate_fn(self, inputs, target):
+        with generic_rnn_kernels(self.model):
+            return self._forward(inputs, target, training=False)
+
+    def _test_step_fn(self, inputs, target):
+        loss = self._strategy.run(self._evaluate, args=(inputs, target))
+        return self._strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+
+    def train_step(self, inputs, target):
+        """
+        Runs a training step. With gradient accumulation, the weights are updated every
+        accumulation_steps steps
+        :param inputs: The model inputs [RGB, mask, box, target]
+        :param target: The labels of shape (batch_size, 1)
+        :return: The loss of the batch
+        """
+        loss = self._train_step(inputs, target)
+        if self.accumulation_steps > 1:
+            self._num_accumulated += 1
+            if self._num_accumulated == self.accumulation_steps:
+                self._flush_gradients()
+        return loss
+
+    def test_step(self, inputs, target):
+        """
+        Evaluates a batch in inference mode
+        :param inputs: The model inputs [RGB, mask, box, target]
+        :param target: The labels of shape (batch_size, 1)
+        :return: The loss of the batch
+        """
+        return self._test_step(inputs, target)
+
+    def _flush_gradients(self):
+        # Applies the accumulated gradients, also those of a partial accumulation at the end of
+        # an epoch
+        if self._num_accumulated > 0:
+            self._apply_gradients(tf.constant(self._num_accumulated, tf.float32))
+            self._num_accumulated = 0
+
+    def _results(self):
+        return {m.name: float(m.result()) for m in self._metrics}
+
+    def _reset_metrics(self):
+        for metric in self._metrics:
+            metric.reset_state()
+
+    def evaluate(self, dataset):
+        """
+        Evaluates the model on a dataset
+        :param dataset: A dataset of ((RGB, mask, box, target), target) batches
+        :return: A dictionary with the mean loss and the accuracy of each head
+        """
+        self._reset_metrics()
+        for inputs, target in dataset:
+            self.test_step(inputs, target)
+        return self._results()
+
+    def fit(self, dataset, epochs=1, validation_data=None, callbacks=None, initial_epoch=0, verbose=1):
+        """
+        Trains the model
+        :param dataset: A dataset of ((RGB, mask, box, target), target) batches, e.g.
+                        IntentDataset(train=True).as_dataset()
+        :param epochs: The number of epochs
+        :param validation_data: A dataset of validation batches, evaluated after every epoch
+        :param callbacks: A list of keras callbacks
+        :param initial_epoch: The epoch to start from, when resuming training
+        :param verbose: 0 for silent, 1 for a progress bar
+        :return: A keras History object
+        """
+        callbacks = list(callbacks or [])
+        if verbose:
+            # The logged metrics are already averaged over the epoch
+            callbacks.append(keras.callbacks.ProgbarLogger('steps', stateful_metrics=[m.name for m in self._metrics]))
+        callbacks = keras.callbacks.CallbackList(callbacks, add_history=True, model=self.model,
+                                                 verbose=verbose, epochs=epochs, steps=None)
+        self.model.stop_training = False
+        callbacks.on_train_begin()
+        logs = {}
+        for epoch in range(initial_epoch, epochs):
+            self._reset_metrics()
+            callbacks.on_epoch_begin(epoch)
+            for step, (inputs, target) in enumerate(instrumentation.timed_iter(dataset, 'train.next_batch')):
+                callbacks.on_train_batch_begin(step)
+                with instrumentation.span('train.step'):
+                    self.train_step(inputs, target)
+                # Reading the metrics of a distributed model is a collective operation, so every
+                # worker reads them after every batch, whether it logs them or not
+                callbacks.on_train_batch_end(step, self._results())
+            self._flush_gradients()
+            logs = self._results()
+            if validation_data is not None:
+                logs.update({'val_' + k: v for k, v in self.evaluate(validation_data).items()})
+            callbacks.on_epoch_end(epoch, logs)
+            if self.model.stop_training:
+                break
+        callbacks.on_train_end(logs)
+        return self.model.history